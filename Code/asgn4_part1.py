@@ -1,124 +1,241 @@
 import networkx as nx
-import ndlib.models.epidemics as ep
-import ndlib.models.ModelConfig as mc
-from bokeh.io import output_notebook, show
-from ndlib.viz.bokeh.DiffusionTrend import DiffusionTrend
+import numpy as np
+import random
+from multiprocessing import Pool
+from compiled_graph import CompiledGraph
+from generators import undirected_scale_free_graph
 
-# A convenient function to create an undirected scale free graph.
-def undirected_scale_free_graph(n):
+# ndlib and bokeh are imported by the functions that use them, so importing
+# this module does not load them
+
+# A function to get any graph into the form ndlib expects.
+def get_ndlib_graph(g):
     """
-    Create an undirected scale free networkx graph.
-    :param n: Number of nodes
-    :return: A networkx graph
+    Convert a graph for use with ndlib.  Compiled graphs are exported to
+    networkx, and node labels are replaced by contiguous integers.
+    :param g: A networkx graph or a CompiledGraph
+    :return: A networkx graph with nodes 0..n-1
     """
-    H = nx.scale_free_graph(n)
-    G = nx.Graph()
-    for (u, v) in H.edges():
-        G.add_edge(u, v)
-    del H
-    return G
+    if isinstance(g, CompiledGraph):
+        g = g.to_networkx()
+    return nx.convert_node_labels_to_integers(g)
 
-# A function to run a typical SIR model.
-def run_SIR():
+# The ndlib class of each epidemic model
+MODELS = {'sir': 'SIRModel', 'seir': 'SEIRModel', 'sis': 'SISModel', 'seis': 'SEISModel'}
 
-    # Network topology
-    g = nx.watts_strogatz_graph(1000, 4, 0.01)
+# Compartments that keep an epidemic going; once they are empty nothing changes
+ACTIVE = ['Exposed', 'Infected']
 
-    model = ep.SIRModel(g)
+def make_model(g, name, params):
+    """
+    Create and configure an ndlib epidemic model
+    :param g: A networkx graph or a CompiledGraph
+    :param name: 'sir', 'seir', 'sis' or 'seis'
+    :param params: A dictionary of model parameters, e.g. beta, gamma and fraction_infected
+    :return: The ndlib model, with its initial status set
+    """
+    import ndlib.models.epidemics as ep
+    import ndlib.models.ModelConfig as mc
 
+    model = getattr(ep, MODELS[name])(get_ndlib_graph(g))
     config = mc.Configuration()
-    # Beta is the probability of transitioning from S to I
-    config.add_model_parameter('beta', .01)
-    # Gamma is the probability of transitioning from I to R
-    config.add_model_parameter('gamma', .01)
-    config.add_model_parameter("fraction_infected", 0.05)
+    for key, value in params.items():
+        config.add_model_parameter(key, value)
     model.set_initial_status(config)
+    return model
 
-    iterations = model.iteration_bunch(1000)
-    trends = model.build_trends(iterations)
+def stream_counts(model, iterations, stop=True):
+    """
+    Run a model one iteration at a time, writing the node count of every
+    status straight into a preallocated array.  Unlike iteration_bunch, the
+    per-iteration status dictionaries are dropped as soon as they are read,
+    so memory does not grow with the number of iterations.
+    :param model: A configured ndlib model
+    :param iterations: The number of iterations to run
+    :param stop: If True, stop once no node is exposed or infected, and keep
+                 the final counts for the remaining iterations
+    :return: A tuple (names, counts): the status names, and a
+             (len(names) x iterations) array of node counts
+    """
+    names = list(model.available_statuses)
+    codes = [model.available_statuses[name] for name in names]
+    active = [i for i, name in enumerate(names) if name in ACTIVE]
+    counts = np.zeros((len(names), iterations), dtype=np.int64)
+    for t in range(iterations):
+        node_count = model.iteration(node_status=False)['node_count']
+        counts[:, t] = [node_count[code] for code in codes]
+        if stop and t > 0 and not counts[active, t].any():
+            counts[:, t + 1:] = counts[:, t:t + 1]
+            break
+    return names, counts
+
+def get_trends(model, names, counts):
+    """
+    Rebuild ndlib's trend description from stream_counts, for ndlib's plots
+    :param model: The ndlib model
+    :param names: The status names from stream_counts
+    :param counts: The node counts from stream_counts
+    :return: A trend description, as from model.build_trends
+    """
+    deltas = np.diff(counts, axis=1, prepend=counts[:, :1])
+    node_count, status_delta = {}, {}
+    for i, name in enumerate(names):
+        code = model.available_statuses[name]
+        node_count[code] = counts[i].tolist()
+        status_delta[code] = deltas[i].tolist()
+    return [{'trends': {'node_count': node_count, 'status_delta': status_delta}}]
+
+def run_model(g, name, params, iterations=1000, plot=True, stop=True):
+    """
+    Run an ndlib epidemic model
+    :param g: A networkx graph or a CompiledGraph
+    :param name: 'sir', 'seir', 'sis' or 'seis'
+    :param params: A dictionary of model parameters, e.g. beta, gamma and fraction_infected
+    :param iterations: The number of iterations to run
+    :param plot: Whether to show the diffusion trend with bokeh
+    :param stop: If True, stop early once the epidemic dies out, see stream_counts
+    :return: A tuple (x, counts): the iterations, and a dictionary from status
+             names to arrays of node counts
+    """
+    model = make_model(g, name, params)
+    names, counts = stream_counts(model, iterations, stop)
 
-    viz = DiffusionTrend(model, trends)
-    p = viz.plot(width=400, height=400)
-    show(p)
+    if plot:
+        from bokeh.io import show
+        from ndlib.viz.bokeh.DiffusionTrend import DiffusionTrend
 
-# A function to run a typical SEIR model.
-def run_SEIR():
+        viz = DiffusionTrend(model, get_trends(model, names, counts))
+        p = viz.plot(width=400, height=400)
+        show(p)
 
-    # Network topology
-    g = nx.watts_strogatz_graph(1000, 4, 0.1)
+    return np.arange(iterations), dict(zip(names, counts))
 
-    # Model selection
-    model = ep.SEIRModel(g)
+_worker_graph = None
 
-    # Model Configuration
-    cfg = mc.Configuration()
+def _init_worker(g):
+    """
+    Process pool initializer: keep the graph, so it is sent once per worker
+    rather than once per replica
+    :param g: A networkx graph with nodes 0..n-1
+    :return: None
+    """
+    global _worker_graph
+    _worker_graph = g
 
-    # Beta is the probability of transitioning from S to E
-    cfg.add_model_parameter('beta', 0.01)
-    # alpha is the probability of transitioning from E to I
-    cfg.add_model_parameter('alpha', 0.01)
-    # Gamma is the probability of transitioning from I to R
-    cfg.add_model_parameter('gamma', 0.01)
-    cfg.add_model_parameter("fraction_infected", 0.05)
-    model.set_initial_status(cfg)
+def _run_replica(task):
+    """
+    Process pool task: run one replica on the worker's graph
+    :param task: A tuple (name, params, iterations, seed)
+    :return: The tuple (names, counts) from stream_counts
+    """
+    name, params, iterations, seed = task
 
-    # Simulation execution
-    iterations = model.iteration_bunch(1000)
-    trends = model.build_trends(iterations)
+    # ndlib draws from both the random module and numpy's global generator
+    random.seed(seed)
+    np.random.seed(seed)
+    return stream_counts(make_model(_worker_graph, name, params), iterations)
 
-    viz = DiffusionTrend(model, trends)
-    p = viz.plot(width=400, height=400)
-    show(p)
+def run_ensemble(g, name, params, iterations=1000, runs=100, processes=None, seed=0):
+    """
+    Run many replicas of an ndlib epidemic model over a process pool
+    :param g: A networkx graph or a CompiledGraph
+    :param name: 'sir', 'seir', 'sis' or 'seis'
+    :param params: A dictionary of model parameters, e.g. beta, gamma and fraction_infected
+    :param iterations: The number of iterations of each replica
+    :param runs: The number of replicas
+    :param processes: Number of worker processes.  Runs in this process if 1, uses every core if None.
+    :param seed: Seed of the first replica; replica i uses seed + i
+    :return: A tuple (x, bands): the iterations, and a dictionary from status
+             names to a (3 x iterations) array of the median, lower quartile
+             and upper quartile of the node counts
+    """
+    g = get_ndlib_graph(g)
+    tasks = [(name, params, iterations, seed + i) for i in range(runs)]
+    if processes == 1:
+        _init_worker(g)
+        results = [_run_replica(task) for task in tasks]
+    else:
+        with Pool(processes, initializer=_init_worker, initargs=(g,)) as pool:
+            results = pool.map(_run_replica, tasks)
+
+    names = results[0][0]
+    counts = np.stack([counts for (names, counts) in results], axis=2)
+    bands = {status: np.percentile(counts[i], [50, 25, 75], axis=1) for i, status in enumerate(names)}
+    return np.arange(iterations), bands
 
-# A function to run a typical SIS model.
-def run_SIS():
+# A function to run a typical SIR model.
+def run_SIR(g=None, plot=True):
 
     # Network topology
-    g = nx.watts_strogatz_graph(1000, 4, 0.1)
+    if g is None:
+        g = nx.watts_strogatz_graph(1000, 4, 0.01)
+
+    params = {
+        # Beta is the probability of transitioning from S to I
+        'beta': .01,
+        # Gamma is the probability of transitioning from I to R
+        'gamma': .01,
+        'fraction_infected': 0.05,
+    }
+    return run_model(g, 'sir', params, 1000, plot)
 
-    model = ep.SISModel(g)
+# A function to run a typical SEIR model.
+def run_SEIR(g=None, plot=True):
 
-    config = mc.Configuration()
-    # Beta is the probability of transitioning from S to I
-    config.add_model_parameter('beta', 0.01)
-    # Lambda is the probability of transitioning from I to S
-    config.add_model_parameter('lambda', 0.01)
-    config.add_model_parameter("fraction_infected", 0.05)
-    model.set_initial_status(config)
+    # Network topology
+    if g is None:
+        g = nx.watts_strogatz_graph(1000, 4, 0.1)
 
-    iterations = model.iteration_bunch(1000)
-    trends = model.build_trends(iterations)
+    # Model Configuration
+    params = {
+        # Beta is the probability of transitioning from S to E
+        'beta': 0.01,
+        # alpha is the probability of transitioning from E to I
+        'alpha': 0.01,
+        # Gamma is the probability of transitioning from I to R
+        'gamma': 0.01,
+        'fraction_infected': 0.05,
+    }
 
-    viz = DiffusionTrend(model, trends)
-    p = viz.plot(width=400, height=400)
-    show(p)
+    # Simulation execution
+    return run_model(g, 'seir', params, 1000, plot)
 
-# A function to run a typical SEIS model.
-def run_SEIS():
+# A function to run a typical SIS model.
+def run_SIS(g=None, plot=True):
 
     # Network topology
-    g = nx.watts_strogatz_graph(1000, 8, 0.1)
-
-    model = ep.SEISModel(g)
+    if g is None:
+        g = nx.watts_strogatz_graph(1000, 4, 0.1)
+
+    params = {
+        # Beta is the probability of transitioning from S to I
+        'beta': 0.01,
+        # Lambda is the probability of transitioning from I to S
+        'lambda': 0.01,
+        'fraction_infected': 0.05,
+    }
+    return run_model(g, 'sis', params, 1000, plot)
 
-    config = mc.Configuration()
-    # Beta is the probability of transitioning from S to E
-    config.add_model_parameter('beta', 0.02)
-    # alpha is the probability of transitioning from E to I
-    config.add_model_parameter('alpha', 0.01)
-    # Gamma is the probability of transitioning from I to S
-    config.add_model_parameter('lambda', 0.01)
-    config.add_model_parameter("fraction_infected", 0.05)
-    model.set_initial_status(config)
-
-    iterations = model.iteration_bunch(1000)
-    trends = model.build_trends(iterations)
-
-    viz = DiffusionTrend(model, trends)
-    p = viz.plot(width=400, height=400)
-    show(p)
+# A function to run a typical SEIS model.
+def run_SEIS(g=None, plot=True):
 
-run_SIR()
-# run_SEIR()
-# run_SIS()
-# run_SEIS()
+    # Network topology
+    if g is None:
+        g = nx.watts_strogatz_graph(1000, 8, 0.1)
+
+    params = {
+        # Beta is the probability of transitioning from S to E
+        'beta': 0.02,
+        # alpha is the probability of transitioning from E to I
+        'alpha': 0.01,
+        # Gamma is the probability of transitioning from I to S
+        'lambda': 0.01,
+        'fraction_infected': 0.05,
+    }
+    return run_model(g, 'seis', params, 1000, plot)
+
+if __name__ == '__main__':
+    run_SIR()
+    # run_SEIR()
+    # run_SIS()
+    # run_SEIS()
@@ -1,35 +1,283 @@
-import networkx as nx
-import matplotlib.pyplot as plt
+import numpy as np
 import random
+import weakref
+from collections import deque
+from math import inf, log, log1p
+from centrality import top_nodes
+from compiled_graph import CompiledGraph, row_positions
+from generators import undirected_scale_free_graph
+from sumtree import SumTree
 
-# A convenient function to create an undirected scale free graph.
-def undirected_scale_free_graph(n):
+# Compartment codes of the int8 state array, and their names in the string export
+S, I, R = 0, 1, 2
+STATE_NAMES = ['S', 'I', 'R']
+
+class SIRState():
     """
-    Create an undirected scale free networkx graph.
-    :param n: Number of nodes
-    :return: A networkx graph
+    Array-backed SIR/SIRS state of a graph, see get_sir.
+
+    Node states are an int8 array over the compiled node ids, the S/I/R
+    counts are kept up to date by every change, and resistance is a packed
+    bitmask.  The infected nodes (and, for SIRS, the recovered ones) are
+    kept as id arrays, so a step only visits them and the neighbors of the
+    infected, never all N nodes.
     """
-    H = nx.scale_free_graph(n)
-    G = nx.Graph()
-    for (u, v) in H.edges():
-        G.add_edge(u, v)
-    del H
-    return G
 
-def set_parameters(G, beta, gamma):
+    def __init__(self, G):
+        """
+        Constructor for the state of a graph, with every node susceptible
+        :param G: A networkx graph, or a CompiledGraph such as one from graph_store.load_graph
+        """
+        self.compiled = G if isinstance(G, CompiledGraph) else CompiledGraph.from_networkx(G)
+        n = self.compiled.num_nodes
+        self.states = np.zeros(n, dtype=np.int8)
+        self.counts = [n, 0, 0]
+        self.infected = np.empty(0, dtype=np.int64)
+        # Only SIRS steps use the recovered ids; None until they are needed
+        self.recovered = None
+        self.resistance = np.zeros((n + 7) // 8, dtype=np.uint8)
+
+        # Seeded from the random module, so random.seed makes runs repeatable
+        self.rng = np.random.default_rng(random.getrandbits(64))
+
+    def set_states(self, infected):
+        """
+        Make the given nodes infected and every other node susceptible
+        :param infected: An array of node ids
+        :return: None
+        """
+        self.infected = np.unique(np.asarray(infected, dtype=np.int64))
+        self.recovered = None
+        self.states[:] = S
+        self.states[self.infected] = I
+        self.counts = [self.compiled.num_nodes - len(self.infected), len(self.infected), 0]
+
+    def is_resistant(self, ids):
+        """
+        Look up nodes in the resistance bitmask
+        :param ids: An array of node ids
+        :return: A boolean array
+        """
+        return (self.resistance[ids >> 3] >> (7 - (ids & 7)).astype(np.uint8)) & 1 == 1
+
+    def step(self, beta, gamma, delta=0.):
+        """
+        Run one synchronous step.  Every infected node infects each of its
+        susceptible, non-resistant neighbors with probability beta, then
+        recovers with probability gamma.  With delta > 0, recovered nodes
+        lose their immunity with probability delta (SIRS).  Nodes infected
+        this step do not recover until the next one.
+        :param beta: Probability of transitioning from S -> I along an edge
+        :param gamma: Probability of transitioning from I -> R
+        :param delta: Probability of transitioning from R -> S
+        :return: None
+        """
+        indptr = self.compiled.out_indptr
+        indices = self.compiled.out_indices
+        states = self.states
+
+        # Gather the edges leaving the infected nodes
+        targets = indices[row_positions(indptr, self.infected)[1]].astype(np.int64)
+
+        # Flip a coin for every edge into a susceptible node that can be infected
+        targets = targets[states[targets] == S]
+        targets = targets[~self.is_resistant(targets)]
+        fresh = np.unique(targets[self.rng.random(len(targets)) < beta])
+
+        # Recoveries and loss of immunity among the nodes infected or recovered before this step
+        heal = self.rng.random(len(self.infected)) < gamma
+        cured, still = self.infected[heal], self.infected[~heal]
+        if delta > 0:
+            if self.recovered is None:
+                self.recovered = np.flatnonzero(states == R)
+            lapse = self.rng.random(len(self.recovered)) < delta
+            lapsed = self.recovered[lapse]
+            self.recovered = np.concatenate([self.recovered[~lapse], cured])
+        else:
+            # Without loss of immunity the recovered nodes are never visited
+            lapsed = cured[:0]
+            self.recovered = None
+
+        states[fresh] = I
+        states[cured] = R
+        states[lapsed] = S
+        self.infected = np.concatenate([still, fresh])
+        self.counts[S] += len(lapsed) - len(fresh)
+        self.counts[I] += len(fresh) - len(cured)
+        self.counts[R] += len(cured) - len(lapsed)
+
+    def run_gillespie(self, beta, gamma, delta=0., max_time=250, block=1 << 14):
+        """
+        Run the continuous-time version of step event by event.  Each edge
+        from an infected node to a susceptible one carries infections at
+        rate -log(1 - beta), and infected (recovered) nodes recover (lose
+        immunity) at rate -log(1 - gamma) (-log(1 - delta)), so each
+        transition has the same chance of happening within one time unit
+        as within one step.  A probability of 1 makes the transition happen
+        at once.  This differs from step for gamma == 1: step lets every
+        infected node try to infect its neighbors once before it recovers,
+        but here it recovers at once and infects no one unless beta == 1.
+        Per-node rates live in a SumTree, so each event
+        costs O(degree * log N) and nothing happens between events.
+        :param beta: Probability of transitioning from S -> I along an edge in one time unit
+        :param gamma: Probability of transitioning from I -> R in one time unit
+        :param delta: Probability of transitioning from R -> S in one time unit
+        :param max_time: Time to stop at
+        :param block: Number of uniform random numbers to draw at once
+        :return: A tuple (times, counts) of numpy arrays: the time of every
+                 event (starting with 0) and the S/I/R counts right after it
+        """
+        # A transition with probability 1 has an infinite rate, so it happens
+        # at once.  Nodes due such a transition wait in a queue, outside the
+        # tree, and are moved before time goes on.
+        infect = -log1p(-beta) if beta < 1 else inf
+        recover = -log1p(-gamma) if gamma < 1 else inf
+        lapse = (-log1p(-delta) if delta < 1 else inf) if delta > 0 else 0.
+        indptr = self.compiled.out_indptr.tolist()
+        indices = self.compiled.out_indices.tolist()
+        n = self.compiled.num_nodes
+        states = self.states.tolist()
+        resistant = self.is_resistant(np.arange(n)).tolist()
+
+        # pressure[v] is the number of infected nodes with an edge into v
+        pressure = np.zeros(n, dtype=np.int64)
+        sources = np.repeat(np.arange(n), np.diff(self.compiled.out_indptr))
+        np.add.at(pressure, self.compiled.out_indices, self.states[sources] == I)
+        pressure = pressure.tolist()
+
+        def rate(v):
+            state = states[v]
+            if state == S:
+                return 0. if resistant[v] or pressure[v] == 0 else infect * pressure[v]
+            return recover if state == I else lapse
+
+        due = deque()
+        queued = [False] * n
+
+        def set_rate(v):
+            r = rate(v)
+            if r == inf:
+                tree.update(v, 0.)
+                if not queued[v]:
+                    queued[v] = True
+                    due.append(v)
+            else:
+                tree.update(v, r)
+
+        tree = SumTree([0.] * n)
+        for v in range(n):
+            set_rate(v)
+        counts = self.counts
+        time = 0.
+        times, history = [0.], [tuple(counts)]
+        us = []
+        while True:
+            if due:
+                v = due.popleft()
+                queued[v] = False
+                if rate(v) != inf:
+                    # An infection whose infected neighbors have all recovered
+                    continue
+            else:
+                total = tree.total()
+                if total <= 0:
+                    break
+                if len(us) < 2:
+                    us = self.rng.random(block).tolist()
+                time -= log(1. - us.pop()) / total
+                if time > max_time:
+                    break
+                v = tree.sample(us.pop())
+
+            # Move a node to its next compartment
+            old = states[v]
+            new = (old + 1) % 3
+            states[v] = new
+            counts[old] -= 1
+            counts[new] += 1
+
+            # Infections and recoveries change the pressure on the out-neighbors.
+            # These are queued before v's own next move, so with beta == 1 an
+            # infected node whose recovery is immediate still infects first.
+            if old == S or new == R:
+                change = 1 if new == I else -1
+                for j in range(indptr[v], indptr[v + 1]):
+                    w = indices[j]
+                    pressure[w] += change
+                    if states[w] == S and not resistant[w]:
+                        set_rate(w)
+            set_rate(v)
+            times.append(time)
+            history.append(tuple(counts))
+
+        self.states[:] = states
+        self.infected = np.flatnonzero(self.states == I)
+        self.recovered = None
+        return np.array(times), np.array(history)
+
+def resample_counts(times, counts, grid):
+    """
+    Resample event-time counts onto fixed times, such as the steps used by run_sim
+    :param times: Array of event times, increasing and starting at 0
+    :param counts: Array of the counts right after each event
+    :param grid: Array of times to sample at
+    :return: The counts in effect at each time of the grid
+    """
+    return counts[np.searchsorted(times, grid, side='right') - 1]
+
+def run_gillespie(G, max_time=250):
+    """
+    Run the event-driven SIR/SIRS engine with the graph's parameters
+    :param G: A networkx graph
+    :param max_time: Time to stop at
+    :return: A tuple (times, counts), see SIRState.run_gillespie
+    """
+    return get_sir(G).run_gillespie(G.graph['beta'], G.graph['gamma'], G.graph.get('delta', 0.), max_time)
+
+# The SIRState of each graph and the number of edges it was made for.  It
+# is kept by graph object rather than in G.graph, which G.copy() shares.
+_states = weakref.WeakKeyDictionary()
+
+def get_sir(G, check=True):
+    """
+    Get the array-backed state of a graph, making it on first use, and
+    again if nodes or edges were added or removed since
+    :param G: A networkx graph or a CompiledGraph
+    :param check: If False, only the number of nodes is compared, since
+                  counting the edges of a networkx graph takes O(N)
+    :return: The SIRState of G
+    """
+    entry = _states.get(G)
+    if entry is not None and entry[0].compiled.num_nodes == G.number_of_nodes():
+        if not check or entry[1] == G.number_of_edges():
+            return entry[0]
+    sir = SIRState(G)
+    _states[G] = (sir, G.number_of_edges())
+    return sir
+
+def export_states(G):
+    """
+    Write the state of every node to its 'state' attribute as 'S', 'I' or 'R'
+    :param G: A networkx graph
+    :return: None
+    """
+    sir = get_sir(G)
+    labels = sir.compiled.labels
+    for i, state in enumerate(sir.states.tolist()):
+        G.nodes[labels[i]]['state'] = STATE_NAMES[state]
+
+def set_parameters(G, beta, gamma, delta=0.):
     """
 
     :param G: A networkx graph
     :param beta: Probability of transitioning from S -> I
     :param gamma: Probability of transitioning from I -> R
+    :param delta: Probability of transitioning from R -> S.  0 gives the SIR model, more gives SIRS.
     :return: None
     """
-
-    # Give the graph properties 'gamma' and 'beta' here
-    # Set a graph property by using
-    #    graphName.graph['propertyName'] = someValue
-    # TODO: Task 1
-    pass
+    G.graph['beta'] = beta
+    G.graph['gamma'] = gamma
+    G.graph['delta'] = delta
 
 def set_initial_states(G, perc_inf=0.1):
     """
@@ -39,23 +287,27 @@ def set_initial_states(G, perc_inf=0.1):
     :param perc_inf: The percentage of the network to infect initially
     :return: None
     """
-    # TODO: Task 2
-    pass
+    sir = get_sir(G)
+    n = sir.compiled.num_nodes
+    sir.set_states(random.sample(range(n), int(perc_inf * n)))
 
 # Returns the number of nodes in state S
 def get_num_s(G):
-    return len([G.nodes[i]['state'] for i in range(G.number_of_nodes()) if
-                G.nodes[i]['state'] == 'S'])
+    if G in _states:
+        return get_sir(G, check=False).counts[S]
+    return len([i for i, state in G.nodes(data='state') if state == 'S'])
 
 # Returns the number of nodes in state I
 def get_num_i(G):
-    return len([G.nodes[i]['state'] for i in range(G.number_of_nodes()) if
-                G.nodes[i]['state'] == 'I'])
+    if G in _states:
+        return get_sir(G, check=False).counts[I]
+    return len([i for i, state in G.nodes(data='state') if state == 'I'])
 
 # Returns the number of nodes in state R
 def get_num_r(G):
-    return len([G.nodes[i]['state'] for i in range(G.number_of_nodes()) if
-                G.nodes[i]['state'] == 'R'])
+    if G in _states:
+        return get_sir(G, check=False).counts[R]
+    return len([i for i, state in G.nodes(data='state') if state == 'R'])
 
 def set_resistance(G, nodelist=[]):
     """
@@ -64,18 +316,23 @@ def set_resistance(G, nodelist=[]):
     :param nodelist: A list of nodes to give resistance to
     :return: None
     """
-    # TODO: Task 5
-    pass
+    sir = get_sir(G)
+    resistant = np.zeros(sir.compiled.num_nodes, dtype=bool)
+    resistant[sir.compiled.to_index(nodelist)] = True
+    sir.resistance = np.packbits(resistant)
 
-def get_influential_nodes(G):
+def get_influential_nodes(G, k=10, metric='degree', **params):
     """
     A function to determine the 10 most 'influential' nodes in the network
     The number of nodes can be changed for the last task
+    Scores are cached on disk per graph, so sweeps over k only compute them once.
     :param G: A networkx graph
+    :param k: The number of nodes to return
+    :param metric: 'degree', 'kcore', 'pagerank', 'betweenness' or 'collective_influence'
+    :param params: Keyword parameters of the metric, e.g. pivots for betweenness
     :return: A list of nodes
     """
-    # TODO: Task 6
-    pass
+    return top_nodes(get_sir(G).compiled, k, metric, **params)
 
 def update(G):
     """
@@ -83,40 +340,133 @@ def update(G):
     :param G: A networkx graph
     :return: None
     """
-    # TODO: Task 3
-    # TODO: Task 7
-    pass
+    get_sir(G, check=False).step(G.graph['beta'], G.graph['gamma'], G.graph.get('delta', 0.))
+
+def run_ensemble(G, replicas=100, numsteps=250, perc_inf=0.1, stop=True):
+    """
+    Run many replicas of the discrete SIR/SIRS model at once.  States are
+    an (N x replicas) int8 matrix, and each step computes the number of
+    infected in-neighbors of every node in every replica with one sparse
+    adjacency product, so a susceptible node with m of them is infected
+    with probability 1 - (1 - beta)^m, as in update.
+    :param G: A networkx graph with parameters from set_parameters
+    :param replicas: Number of replicas
+    :param numsteps: The number of steps to run the simulation for
+    :param perc_inf: The percentage of the network each replica infects initially
+    :param stop: If True, stop once no replica has any infected node left,
+                 and keep the final counts for the remaining steps
+    :return: A tuple (x, bands): the steps, and a dictionary from 'S', 'I'
+             and 'R' to a (3 x numsteps) array of the median, lower quartile
+             and upper quartile of the counts after each step
+    """
+    from scipy.sparse import csr_array
+
+    sir = get_sir(G)
+    beta, gamma, delta = G.graph['beta'], G.graph['gamma'], G.graph.get('delta', 0.)
+    rng = sir.rng
+    n = sir.compiled.num_nodes
+    indptr, indices = sir.compiled.out_indptr, sir.compiled.out_indices
+    incoming = csr_array((np.ones(len(indices), dtype=np.float32), indices, indptr),
+                         shape=(n, n)).T.tocsr()
+    susceptible = ~sir.is_resistant(np.arange(n))[:, None]
+
+    # Every replica starts from its own random spreaders
+    states = np.zeros((n, replicas), dtype=np.int8)
+    seeds = np.argsort(rng.random((n, replicas)), axis=0)[:int(perc_inf * n)]
+    states[seeds, np.arange(replicas)] = I
+
+    counts = np.zeros((3, numsteps, replicas), dtype=np.int64)
+    log_escape = log1p(-beta) if beta < 1 else None
+    for t in range(numsteps):
+        infected = states == I
+        pressure = incoming @ infected.astype(np.float32)
+        draws = rng.random((n, replicas))
+        if log_escape is None:
+            # With beta == 1 one infected neighbor is enough (0 * -inf would be NaN)
+            catch = (states == S) & susceptible & (pressure > 0)
+        else:
+            catch = (states == S) & susceptible & (draws < -np.expm1(pressure * log_escape))
+        draws = rng.random((n, replicas))
+        heal = infected & (draws < gamma)
+        lapse = (states == R) & (draws < delta) if delta > 0 else None
+
+        states[catch] = I
+        states[heal] = R
+        if lapse is not None:
+            states[lapse] = S
+        for state in (S, I, R):
+            counts[state, t] = np.count_nonzero(states == state, axis=0)
+        if stop and not counts[I, t].any():
+            counts[:, t + 1:] = counts[:, t:t + 1]
+            break
+
+    x = np.arange(numsteps)
+    bands = {}
+    for state, name in enumerate(STATE_NAMES):
+        bands[name] = np.percentile(counts[state], [50, 25, 75], axis=1)
+    return x, bands
+
+def plot_ensemble(x, bands):
+    """
+    Plot the median SIR curves of run_ensemble with their interquartile bands
+    :param x: The steps returned by run_ensemble
+    :param bands: The bands returned by run_ensemble
+    :return: None
+    """
+    import matplotlib.pyplot as plt
 
-def run_sim(G, numsteps=250):
+    for name, label in zip(STATE_NAMES, ['Susceptible', 'Infected', 'Recovered']):
+        median, low, high = bands[name]
+        line, = plt.plot(x, median, label=label)
+        plt.fill_between(x, low, high, color=line.get_color(), alpha=0.3)
+    plt.legend()
+    plt.show()
+
+def run_sim(G, numsteps=250, gillespie=False, plot=True):
     """
     Run a simulation for numsteps steps, then plot the SIR curves
     :param G: A networkx graph
     :param numsteps: The number of steps to run the simulation for
-    :return: None
+    :param gillespie: If True, run the event-driven engine for numsteps time units
+                      and plot its counts at the same times
+    :param plot: If False, only return the counts, without importing matplotlib
+    :return: A tuple (x, counts): the steps and a (3 x numsteps) array of the S, I and R counts
     """
     num_s = []
     num_i = []
     num_r = []
 
-    for i in range(numsteps):
-        update(G)
-        num_s.append(get_num_s(G))
-        num_i.append(get_num_i(G))
-        num_r.append(get_num_r(G))
+    if gillespie:
+        times, counts = run_gillespie(G, numsteps)
+        counts = resample_counts(times, counts, np.arange(1, numsteps + 1))
+        num_s, num_i, num_r = counts.T.tolist()
+    else:
+        for i in range(numsteps):
+            update(G)
+            num_s.append(get_num_s(G))
+            num_i.append(get_num_i(G))
+            num_r.append(get_num_r(G))
 
     x = list(range(numsteps))
-    plt.plot(x, num_s, label='Susceptible')
-    plt.plot(x, num_i, label='Infected')
-    plt.plot(x, num_r, label='Recovered')
-    plt.legend()
-    plt.show()
+    if plot:
+        import matplotlib.pyplot as plt
+
+        plt.plot(x, num_s, label='Susceptible')
+        plt.plot(x, num_i, label='Infected')
+        plt.plot(x, num_r, label='Recovered')
+        plt.legend()
+        plt.show()
+    return np.array(x), np.array([num_s, num_i, num_r])
 
 def main():
     # Create your graph called G
+    G = undirected_scale_free_graph(1000)
     # Set your parameters to their desired values
+    set_parameters(G, .05, .1)
     # Set your nodes' initial states
+    set_initial_states(G, .01)
     # Run the simulation
-    # TODO: Task 4
+    run_sim(G)
 
 if __name__ == '__main__':
     main()
@@ -1,8 +1,12 @@
 # CSC 486 Assignment 8
 
 import networkx as nx
-import matplotlib.pyplot as plt
-from random import choice, random, shuffle
+import numpy as np
+from math import comb, log
+from random import random, randrange, shuffle
+from compiled_graph import CompiledGraph, row_positions
+from sumtree import SumTree
+from trajectory import TrajectoryRecorder
 
 
 def get_binary_opinions(n):
@@ -23,20 +27,363 @@ def get_continuous_opinions(n):
     """
     return [random() for i in range(n)]
 
+def flip_opinion(graph, op, v, new):
+    """
+    Give node v the binary opinion new, which must differ from its current one.
+    :param graph: a tuple (indptr, indices, in_indptr, in_indices) of CSR lists
+    :param op: list of binary opinions, updated in place
+    :param v: the node to flip
+    :param new: the new opinion of v
+    :return: the change in the number of discordant CSR entries (edges whose
+             endpoints disagree; undirected edges are stored twice)
+    """
+    indptr, indices, in_indptr, in_indices = graph
+    nbrs = indices[indptr[v]:indptr[v + 1]]
+    change = discordant_change(op, nbrs, v, new)
+    if in_indices is indices:
+        # Undirected: every in-entry of v mirrors an out-entry
+        change *= 2
+    else:
+        change += discordant_change(op, in_indices[in_indptr[v]:in_indptr[v + 1]], v, new)
+    op[v] = new
+    return change
+
+def discordant_change(op, nbrs, v, new):
+    """
+    Get the change in the number of neighbors that disagree with v when v
+    switches to the binary opinion new.  The counting runs in C through
+    sum and map instead of a Python loop over the neighbors.
+    :param op: list of binary opinions, with v still holding its old opinion
+    :param nbrs: list of neighbors of v, possibly including v itself
+    :param v: the node that flips
+    :param new: the new opinion of v
+    :return: the number of neighbors that disagree after the flip minus before
+    """
+    ones = sum(map(op.__getitem__, nbrs))
+    agree = ones if new else len(nbrs) - ones
+    # Self loops never disagree, and v's old opinion is not counted in agree
+    return len(nbrs) - nbrs.count(v) - 2 * agree
+
+def voter_steps(graph, op, q, nodes, us, stats, track=True):
+    """
+    Apply voter model updates: each node copies a random neighbor.
+    :param graph: a tuple (indptr, indices, in_indptr, in_indices) of CSR lists
+    :param op: list of binary opinions, updated in place
+    :param q: unused
+    :param nodes: list of nodes to update, in order
+    :param us: list of uniform random numbers, one per update
+    :param stats: list [ones, discordant, flips] of observables, updated in place
+    :param track: if False, leave the discordant count alone, which makes flips cheaper
+    :return: None
+    """
+    indptr, indices = graph[0], graph[1]
+    ones, discordant, flips = stats
+    for t in range(len(nodes)):
+        node = nodes[t]
+        start = indptr[node]
+        deg = indptr[node + 1] - start
+        if deg == 0:
+            continue
+        new = op[indices[start + int(us[t] * deg)]]
+        if new != op[node]:
+            if track:
+                discordant += flip_opinion(graph, op, node, new)
+            else:
+                op[node] = new
+            ones += 1 if new else -1
+            flips += 1
+    stats[:] = ones, discordant, flips
+
+def qvoter_steps(graph, op, q, nodes, us, stats, track=True):
+    """
+    Apply q-voter model updates: a node adopts the opinion of q random
+    neighbors (drawn with repetition) if they all agree.
+    :param q: number of neighbors drawn per update
+    :param us: list of uniform random numbers, q per update
+    :return: None
+    """
+    indptr, indices = graph[0], graph[1]
+    ones, discordant, flips = stats
+    for t in range(len(nodes)):
+        node = nodes[t]
+        start = indptr[node]
+        deg = indptr[node + 1] - start
+        if deg == 0:
+            continue
+        k = t * q
+        new = op[indices[start + int(us[k] * deg)]]
+        if new == op[node]:
+            continue
+        for k in range(k + 1, k + q):
+            if op[indices[start + int(us[k] * deg)]] != new:
+                break
+        else:
+            if track:
+                discordant += flip_opinion(graph, op, node, new)
+            else:
+                op[node] = new
+            ones += 1 if new else -1
+            flips += 1
+    stats[:] = ones, discordant, flips
+
+def majority_steps(graph, op, q, nodes, us, stats, track=True):
+    """
+    Apply majority rule updates: a node adopts the strict majority opinion
+    of q random neighbors (drawn with repetition), and keeps its own on a tie.
+    :param q: number of neighbors drawn per update
+    :param us: list of uniform random numbers, q per update
+    :return: None
+    """
+    indptr, indices = graph[0], graph[1]
+    ones, discordant, flips = stats
+    for t in range(len(nodes)):
+        node = nodes[t]
+        start = indptr[node]
+        deg = indptr[node + 1] - start
+        if deg == 0:
+            continue
+        count = 0
+        for k in range(t * q, t * q + q):
+            count += op[indices[start + int(us[k] * deg)]]
+        if 2 * count > q:
+            new = 1
+        elif 2 * count < q:
+            new = 0
+        else:
+            continue
+        if new != op[node]:
+            if track:
+                discordant += flip_opinion(graph, op, node, new)
+            else:
+                op[node] = new
+            ones += 1 if new else -1
+            flips += 1
+    stats[:] = ones, discordant, flips
+
+def snazjd_steps(graph, op, q, nodes, us, stats, track=True):
+    """
+    Apply Snazjd model updates: if a node and a random neighbor agree, all
+    of their neighbors adopt their opinion.
+    :param q: unused
+    :param us: list of uniform random numbers, one per update
+    :return: None
+    """
+    indptr, indices = graph[0], graph[1]
+    ones, discordant, flips = stats
+    for t in range(len(nodes)):
+        node = nodes[t]
+        start = indptr[node]
+        deg = indptr[node + 1] - start
+        if deg == 0:
+            continue
+        nbr = indices[start + int(us[t] * deg)]
+        new = op[node]
+        if op[nbr] != new:
+            continue
+        for i in (node, nbr):
+            for j in range(indptr[i], indptr[i + 1]):
+                v = indices[j]
+                if op[v] != new:
+                    if track:
+                        discordant += flip_opinion(graph, op, v, new)
+                    else:
+                        op[v] = new
+                    ones += 1 if new else -1
+                    flips += 1
+    stats[:] = ones, discordant, flips
+
+def flip_rate(method, q, d, k):
+    """
+    Get the probability that an update of a node changes its opinion
+    :param method: 'voter', 'qvoter' or 'majority'
+    :param q: number of neighbors drawn per update
+    :param d: number of the node's neighbors that disagree with it
+    :param k: the node's degree
+    :return: the probability that the node flips when it is picked
+    """
+    if k == 0 or d == 0:
+        return 0.
+    f = d / k
+    if method == 'voter':
+        return f
+    if method == 'qvoter':
+        return f ** q
+    # A strict majority of the q draws must disagree
+    return sum(comb(q, j) * f ** j * (1 - f) ** (q - j) for j in range(q // 2 + 1, q + 1))
+
+# The block update function used by DiffusionModel.run_async for each model
+ASYNC_RULES = {'voter': voter_steps, 'qvoter': qvoter_steps,
+               'majority': majority_steps, 'snazjd': snazjd_steps}
+
 class DiffusionModel:
 
-    def __init__(self, g, method='voter'):
+    def __init__(self, g, method='voter', q=None, epsilon=.3, mu=.5, seed=None,
+                 dtype=np.float64, complete=None):
         """
         The diffusion model class
-        :param g: a networkx graph
+        :param g: a networkx graph or a CompiledGraph, with any node labels
         :param method: a string representing the type of model to use
+        :param q: group size for the 'qvoter' and 'majority' models (3 and 5 if None)
+        :param epsilon: confidence bound for the 'hk' and 'dw' models
+        :param mu: convergence rate for the 'dw' model
+        :param seed: seed for the random number generator used by run
+        :param dtype: numpy float type of the continuous opinions, e.g. np.float32
+        :param complete: if True, the 'hk' model treats everyone as neighbors and
+                         only uses g for the number of nodes.  Detected from g if None.
         """
         self.g = g
         self.method = method
+        if q is None:
+            q = 5 if method == 'majority' else 3
+        self.q = q
+        self.epsilon = epsilon
+        self.mu = mu
+        self.rng = np.random.default_rng(seed)
+
+        # Work on contiguous node ids and CSR adjacency; opinions[i] is the
+        # opinion of the node labelled self.compiled.labels[i]
+        if isinstance(g, CompiledGraph):
+            self.compiled = g
+        else:
+            self.compiled = CompiledGraph.from_networkx(g)
+
+        # Python list copies of the CSR arrays for the rules that loop in
+        # Python, made on first use by get_lists
+        self.lists = None
+
         if self.method in ['voter', 'qvoter', 'majority', 'snazjd']:
-            self.opinions = get_binary_opinions(self.g.number_of_nodes())
+            self.opinions = get_binary_opinions(self.compiled.num_nodes)
         else:
-            self.opinions = get_continuous_opinions(self.g.number_of_nodes())
+            self.opinions = np.array(get_continuous_opinions(self.compiled.num_nodes), dtype=dtype)
+
+        # Work arrays for the synchronous Hegselmann-Krause sweep, made on first use
+        self.complete = complete
+        self.hk_buffers = None
+
+        # Observables kept up to date as opinions change
+        self.reset_observables()
+
+    def get_lists(self):
+        """
+        Get the adjacency as Python lists, which are faster than numpy arrays
+        to index one entry at a time.  Only the binary models need them, so
+        they are built on first use instead of copying every graph.
+        :return: a tuple (indptr, indices, in_indptr, in_indices) of CSR lists
+        """
+        if self.lists is None:
+            indptr = self.compiled.out_indptr.tolist()
+            indices = self.compiled.out_indices.tolist()
+            if self.compiled.directed:
+                self.lists = (indptr, indices, self.compiled.in_indptr.tolist(),
+                              self.compiled.in_indices.tolist())
+            else:
+                self.lists = (indptr, indices, indptr, indices)
+        return self.lists
+
+    def get_opinion(self, node):
+        """
+        Get the opinion of a node
+        :param node: a node label
+        :return: the node's opinion
+        """
+        return self.opinions[self.compiled.node_id(node)]
+
+    def reset_observables(self):
+        """
+        Recount the observables from scratch.  The binary models then keep
+        self.ones (agents with opinion 1), self.discordant (CSR entries whose
+        endpoints disagree) and self.flips (opinion changes so far) up to date
+        on every flip.  The continuous models keep self.change, the largest
+        opinion change since the last convergence check.
+        :return: None
+        """
+        self.flips = 0
+        self.checked_flips = 0
+        self.change = np.inf
+        self.snapshot = None
+        if self.method not in ['voter', 'qvoter', 'majority', 'snazjd']:
+            self.ones = self.discordant = None
+            return
+
+        self.ones = int(np.sum(self.opinions))
+        self.discordant = self.count_discordant()
+
+    def count_discordant(self):
+        """
+        Count the discordant CSR entries of the binary opinions from scratch
+        :return: the number of CSR entries whose endpoints disagree
+        """
+        op = np.array(self.opinions, dtype=np.int8)
+        rows, cols = self.compiled.get_edge_arrays()
+        return int(np.count_nonzero((op[rows] != op[cols]) & (rows != cols)))
+
+    def set_opinion(self, node, new):
+        """
+        Set the opinion of a node by id, keeping the observables up to date
+        :param node: a node id
+        :param new: the node's new opinion
+        :return: None
+        """
+        if self.ones is None:
+            self.opinions[node] = new
+        elif new != self.opinions[node]:
+            self.discordant += flip_opinion(self.get_lists(), self.opinions, node, new)
+            self.ones += 1 if new else -1
+            self.flips += 1
+
+    def get_counts(self):
+        """
+        Get the number of agents holding each binary opinion, in O(1)
+        :return: a tuple (zeros, ones)
+        """
+        return self.compiled.num_nodes - self.ones, self.ones
+
+    def get_discordant_edges(self):
+        """
+        Get the number of edges whose endpoints disagree, in O(1)
+        :return: the number of discordant edges.  Undirected edges count once.
+        """
+        return self.discordant if self.compiled.directed else self.discordant // 2
+
+    def get_clusters(self, gap=None):
+        """
+        Split the continuous opinions into clusters: sorted opinions further
+        than gap apart are in different clusters.  Once a Hegselmann-Krause
+        or Deffuant-Weisbuch run has converged, clusters are more than
+        epsilon apart, so gap defaults to epsilon.
+        :param gap: the smallest distance between two clusters
+        :return: a list of (mean opinion, size) tuples, in increasing opinion order
+        """
+        if gap is None:
+            gap = self.epsilon
+        xs = np.sort(self.opinions)
+        cuts = np.flatnonzero(np.diff(xs) > gap) + 1
+        return [(float(c.mean()), len(c)) for c in np.split(xs, cuts)]
+
+    def is_converged(self, tol=1e-6, window=None):
+        """
+        Check whether a run has converged.  A binary model has converged at
+        consensus or in a frozen state with no discordant edges, or when no
+        agent has changed its opinion since the last check if window is set.
+        A continuous model has converged when no opinion moved more than tol
+        since the last check.  Call this once every window updates.
+        :param tol: largest opinion change of a converged continuous model
+        :param window: if True, also stop binary models that did not flip since the last check
+        :return: True if the run has converged
+        """
+        if self.ones is not None:
+            quiet = window and self.flips == self.checked_flips
+            self.checked_flips = self.flips
+            return self.discordant == 0 or bool(quiet)
+
+        # Compare with a copy kept from the last check
+        if self.snapshot is None:
+            self.snapshot = self.opinions.copy()
+            return False
+        np.subtract(self.opinions, self.snapshot, out=self.snapshot)
+        self.change = float(np.max(np.abs(self.snapshot), initial=0.))
+        self.snapshot[:] = self.opinions
+        return self.change < tol
 
     def update(self):
         """
@@ -46,17 +393,31 @@ class DiffusionModel:
         """
         if self.method == 'voter':
             self.update_voter()
-
-        # TODO: Task 7 Fill in the remaining cases here with elif statements
+        elif self.method == 'qvoter':
+            self.update_qvoter(self.q)
+        elif self.method == 'majority':
+            self.update_majority(self.q)
+        elif self.method == 'snazjd':
+            self.update_snazjd()
+        elif self.method == 'hk':
+            self.update_hk(self.epsilon)
+        elif self.method == 'dw':
+            self.update_dw(self.epsilon, self.mu)
+        elif self.method == 'mymodel':
+            self.update_mymodel()
 
     def update_voter(self):
         """
         Update opinions based on the Voter model
         :return: None
         """
-        node = choice(list(range(self.g.number_of_nodes())))
-        nbr = choice(list(self.g.neighbors(node)))
-        self.opinions[node] = self.opinions[nbr]
+        indptr, indices = self.get_lists()[:2]
+        node = randrange(self.compiled.num_nodes)
+        start, end = indptr[node], indptr[node + 1]
+        if start == end:
+            return
+        nbr = indices[randrange(start, end)]
+        self.set_opinion(node, self.opinions[nbr])
 
     def update_qvoter(self, q=3):
         """
@@ -64,9 +425,17 @@ class DiffusionModel:
         :param q: the number of neighbors to base opinion update on
         :return: None
         """
+        indptr, indices = self.get_lists()[:2]
+        node = randrange(self.compiled.num_nodes)
+        start, end = indptr[node], indptr[node + 1]
+        if start == end:
+            return
 
-        # TODO: Task 1
-        pass
+        # Adopt the opinion of q random neighbors only if they all agree
+        nbrs = [indices[randrange(start, end)] for i in range(q)]
+        opinion = self.opinions[nbrs[0]]
+        if all(self.opinions[nbr] == opinion for nbr in nbrs):
+            self.set_opinion(node, opinion)
 
     def update_majority(self, q=5):
         """
@@ -74,18 +443,37 @@ class DiffusionModel:
         :param q: the number of nodes to calculate the majority opinion of
         :return: None
         """
+        indptr, indices = self.get_lists()[:2]
+        node = randrange(self.compiled.num_nodes)
+        start, end = indptr[node], indptr[node + 1]
+        if start == end:
+            return
 
-        # TODO: Task 2
-        pass
+        # Adopt the strict majority opinion of q random neighbors
+        ones = sum(self.opinions[indices[randrange(start, end)]] for i in range(q))
+        if 2 * ones > q:
+            self.set_opinion(node, 1)
+        elif 2 * ones < q:
+            self.set_opinion(node, 0)
 
     def update_snazjd(self):
         """
         Update opinions based on the Snazjd model
         :return: None
         """
+        indptr, indices = self.get_lists()[:2]
+        node = randrange(self.compiled.num_nodes)
+        start, end = indptr[node], indptr[node + 1]
+        if start == end:
+            return
+        nbr = indices[randrange(start, end)]
 
-        # TODO: Task 3
-        pass
+        # A pair of neighbors that agree convinces all of their neighbors
+        opinion = self.opinions[node]
+        if self.opinions[nbr] == opinion:
+            for i in (node, nbr):
+                for j in range(indptr[i], indptr[i + 1]):
+                    self.set_opinion(indices[j], opinion)
 
     def update_hk(self, epsilon=.3):
         """
@@ -93,9 +481,110 @@ class DiffusionModel:
         :param epsilon: maximum distance of a neighbor's opinion before it is ignored
         :return: None
         """
+        if self.hk_buffers is None:
+            self.hk_buffers = self.make_hk_buffers()
+        if self.hk_buffers['complete']:
+            self.sweep_hk_complete(epsilon)
+        else:
+            self.sweep_hk(epsilon)
 
-        # TODO: Task 4
-        pass
+    def make_hk_buffers(self):
+        """
+        Allocate the work arrays used by sweep_hk and sweep_hk_complete, so
+        that a sweep does not allocate per-edge arrays.  The next opinions
+        are written to a second buffer that is swapped with self.opinions
+        after every sweep.
+        :return: a dictionary of work arrays
+        """
+        n = self.compiled.num_nodes
+        indptr = self.compiled.out_indptr
+        indices = self.compiled.out_indices
+        m = len(indices)
+        dtype = self.opinions.dtype
+        b = {'next': np.empty(n, dtype=dtype)}
+
+        complete = self.complete
+        rows = np.repeat(np.arange(n, dtype=np.int32), np.diff(indptr))
+        if complete is None:
+            # A graph without self loops where every node sees every other node
+            complete = m == n * (n - 1) and not np.any(indices == rows)
+        b['complete'] = complete
+        if complete:
+            b['sum_prefix'] = np.zeros(n + 1)
+            return b
+
+        b.update({
+            'rows': rows,
+            'starts': indptr[:-1],
+            'ends': indptr[1:],
+            'nbr': np.empty(m, dtype=dtype),
+            'diff': np.empty(m, dtype=dtype),
+            'mask': np.empty(m, dtype=bool),
+            'sum_prefix': np.zeros(m + 1),
+            'count_prefix': np.zeros(m + 1, dtype=np.int64),
+            'sums': np.empty(n),
+            'counts': np.empty(n, dtype=np.int64),
+            'tmp': np.empty(n),
+            'tmp_count': np.empty(n, dtype=np.int64),
+        })
+        return b
+
+    def sweep_hk(self, epsilon):
+        """
+        One synchronous Hegselmann-Krause sweep over CSR adjacency: every
+        agent moves to the average of its own opinion and its neighbors'
+        opinions within epsilon.  The per-node sums are segment reductions,
+        taken as differences of prefix sums over the masked neighbor values.
+        :param epsilon: maximum distance of a neighbor's opinion before it is ignored
+        :return: None
+        """
+        b = self.hk_buffers
+        x = self.opinions
+        nbr, diff, mask = b['nbr'], b['diff'], b['mask']
+
+        # Mask out neighbors further than epsilon away
+        np.take(x, self.compiled.out_indices, out=nbr)
+        np.take(x, b['rows'], out=diff)
+        np.subtract(nbr, diff, out=diff)
+        np.abs(diff, out=diff)
+        np.less_equal(diff, epsilon, out=mask)
+        np.multiply(nbr, mask, out=nbr)
+
+        # Segment sums of opinions and counts, via prefix sums
+        np.cumsum(nbr, dtype=np.float64, out=b['sum_prefix'][1:])
+        np.cumsum(mask, dtype=np.int64, out=b['count_prefix'][1:])
+        np.take(b['sum_prefix'], b['ends'], out=b['sums'])
+        np.take(b['sum_prefix'], b['starts'], out=b['tmp'])
+        np.subtract(b['sums'], b['tmp'], out=b['sums'])
+        np.take(b['count_prefix'], b['ends'], out=b['counts'])
+        np.take(b['count_prefix'], b['starts'], out=b['tmp_count'])
+        np.subtract(b['counts'], b['tmp_count'], out=b['counts'])
+
+        # Every agent also counts its own opinion
+        np.add(b['sums'], x, out=b['sums'])
+        np.add(b['counts'], 1, out=b['counts'])
+        np.divide(b['sums'], b['counts'], out=b['next'], casting='unsafe')
+        self.opinions, b['next'] = b['next'], x
+
+    def sweep_hk_complete(self, epsilon):
+        """
+        One synchronous Hegselmann-Krause sweep on a complete graph.  With
+        the opinions sorted, everyone within epsilon of an agent is a
+        contiguous window, so its average comes from two binary searches
+        and a prefix sum: O(N log N) instead of O(N^2).
+        :param epsilon: maximum distance of a neighbor's opinion before it is ignored
+        :return: None
+        """
+        b = self.hk_buffers
+        x = self.opinions
+        order = np.argsort(x, kind='stable')
+        xs = x[order]
+        lo = np.searchsorted(xs, xs - epsilon, side='left')
+        hi = np.searchsorted(xs, xs + epsilon, side='right')
+        prefix = b['sum_prefix']
+        np.cumsum(xs, dtype=np.float64, out=prefix[1:])
+        b['next'][order] = (prefix[hi] - prefix[lo]) / (hi - lo)
+        self.opinions, b['next'] = b['next'], x
 
     def update_dw(self, epsilon=.3, mu=.5):
         """
@@ -104,9 +593,140 @@ class DiffusionModel:
         :param mu: a float telling how strongly to move towards a neighbor's opinion
         :return: None
         """
+        indptr, indices = self.compiled.out_indptr, self.compiled.out_indices
+        node = randrange(self.compiled.num_nodes)
+        start, end = int(indptr[node]), int(indptr[node + 1])
+        if start == end:
+            return
+        nbr = indices[randrange(start, end)]
 
-        # TODO: Task 5
-        pass
+        # Both agents move towards each other if they are close enough
+        diff = self.opinions[nbr] - self.opinions[node]
+        if abs(diff) < epsilon:
+            self.opinions[node] += mu * diff
+            self.opinions[nbr] -= mu * diff
+
+    def sample_pairs(self, size):
+        """
+        Sample (node, random neighbor) pairs the way the sequential updates
+        do.  Pairs whose node has no neighbors are dropped.
+        :param size: number of pairs to sample
+        :return: a tuple (nodes, neighbors) of numpy arrays
+        """
+        indptr = self.compiled.out_indptr
+        nodes = self.rng.integers(0, self.compiled.num_nodes, size)
+        starts = indptr[nodes]
+        degrees = indptr[nodes + 1] - starts
+        keep = degrees > 0
+        nodes, starts, degrees = nodes[keep], starts[keep], degrees[keep]
+        offsets = (self.rng.random(len(nodes)) * degrees).astype(np.int64)
+        return nodes, self.compiled.out_indices[starts + offsets].astype(np.int64)
+
+    def run_pairs(self, steps, batch=None):
+        """
+        Run steps pair updates of the 'dw' or 'snazjd' model in vectorized
+        batches.  A batch of random pairs is split into conflict-free rounds:
+        a move is applied in the first round in which it is the earliest
+        remaining move touching each of its nodes, so no node is touched
+        twice in a round and every node sees its moves in the sampled order.
+        Since a move only reads and writes the nodes it touches, the result
+        is the same as applying the sampled pairs one at a time.
+        :param steps: number of pair updates to run
+        :param batch: number of pairs sampled at once.  If None, about as many
+                      as can touch each node once.
+        :return: the number of vectorized rounds used
+        """
+        if self.method not in ['dw', 'snazjd']:
+            raise ValueError(f'run_pairs only supports the dw and snazjd models, not {self.method}')
+        n = self.compiled.num_nodes
+        if batch is None:
+            # Aim for each node to be touched about once per batch
+            batch = n
+            if self.method == 'snazjd':
+                batch = max(1, int(n / (2 + 2 * self.compiled.out_degree.mean())))
+        if self.method == 'snazjd':
+            op = np.array(self.opinions, dtype=np.int8)
+        else:
+            op = self.opinions
+
+        # first[v] is the position of the earliest remaining move touching v
+        first = np.full(n, np.iinfo(np.int64).max, dtype=np.int64)
+        rounds = 0
+        done = 0
+        while done < steps:
+            nodes, nbrs = self.sample_pairs(min(batch, steps - done))
+            done += min(batch, steps - done)
+            while len(nodes) > 0:
+                if self.method == 'dw':
+                    ok = self.apply_dw_round(op, nodes, nbrs, first)
+                else:
+                    ok = self.apply_snazjd_round(op, nodes, nbrs, first)
+                nodes, nbrs = nodes[~ok], nbrs[~ok]
+                rounds += 1
+
+        if self.method == 'snazjd':
+            # apply_snazjd_round counted the flips; recount the others
+            self.opinions = op.tolist()
+            self.ones = int(op.sum())
+            self.discordant = self.count_discordant()
+        return rounds
+
+    def apply_dw_round(self, op, nodes, nbrs, first):
+        """
+        Apply the Deffuant-Weisbuch moves of one conflict-free round.
+        :param op: numpy array of opinions, updated in place
+        :param nodes: first agent of each remaining move, in sampled order
+        :param nbrs: second agent of each remaining move
+        :param first: work array of size n, all entries at the maximum int64
+        :return: boolean array marking the moves that were applied
+        """
+        pos = np.arange(len(nodes))
+        np.minimum.at(first, nodes, pos)
+        np.minimum.at(first, nbrs, pos)
+        ok = (first[nodes] == pos) & (first[nbrs] == pos)
+        first[nodes] = first[nbrs] = np.iinfo(np.int64).max
+
+        a, b = nodes[ok], nbrs[ok]
+        diff = op[b] - op[a]
+        diff *= np.abs(diff) < self.epsilon
+        op[a] += self.mu * diff
+        op[b] -= self.mu * diff
+        return ok
+
+    def apply_snazjd_round(self, op, nodes, nbrs, first):
+        """
+        Apply the Snazjd moves of one conflict-free round.  A move touches
+        its pair and every neighbor of the pair.  Adds the number of agents
+        that changed opinion to self.flips.
+        :param op: numpy int8 array of opinions, updated in place
+        :param nodes: first agent of each remaining move, in sampled order
+        :param nbrs: second agent of each remaining move
+        :param first: work array of size n, all entries at the maximum int64
+        :return: boolean array marking the moves that were applied
+        """
+        indptr = self.compiled.out_indptr
+        indices = self.compiled.out_indices
+        m = len(nodes)
+
+        # List the nodes touched by every move
+        pair = np.concatenate([nodes, nbrs])
+        counts, edges = row_positions(indptr, pair)
+        touched = np.concatenate([pair, indices[edges]])
+        moves = np.concatenate([np.tile(np.arange(m), 2), np.repeat(np.tile(np.arange(m), 2), counts)])
+
+        # A move can go if it is the earliest one for all of its nodes
+        np.minimum.at(first, touched, moves)
+        late = first[touched] != moves
+        ok = np.bincount(moves[late], minlength=m) == 0
+        first[touched] = np.iinfo(np.int64).max
+
+        # Agreeing pairs convince everyone they touch
+        agree = ok & (op[nodes] == op[nbrs])
+        spread = agree[moves]
+        targets, values = touched[spread], op[nodes][moves[spread]]
+        self.flips += len(np.unique(targets[op[targets] != values]))
+        op[targets] = values
+        return ok
 
     def update_mymodel(self):
         """
@@ -117,9 +737,12 @@ class DiffusionModel:
         # TODO: Task 6
         pass
 
-    def run_test_discrete(self):
+    def run_test_discrete(self, max_steps=100, window=None):
         """
-        Run a simulation using one of the binary opinion models and plot the results
+        Run a simulation using one of the binary opinion models and plot the
+        results.  The run stops early once the model has converged.
+        :param max_steps: largest number of updates to run
+        :param window: if set, also stop after window updates without any opinion change
         :return: None
         """
         if self.method not in ['voter', 'qvoter', 'majority', 'snazjd']:
@@ -127,43 +750,233 @@ class DiffusionModel:
             return
 
         x, y = [], [[], []]
-        for i in range(100):
+        for i in range(max_steps):
             x.append(i)
-            y[0].append(self.opinions.count(1))
-            y[1].append(self.opinions.count(0))
+            y[0].append(self.compiled.num_nodes - self.ones)
+            y[1].append(self.ones)
+            if self.discordant == 0:
+                break
             self.update()
+            if window and (i + 1) % window == 0 and self.is_converged(window=True):
+                break
+
+        import matplotlib.pyplot as plt
+
         plt.plot(x, y[0], label='Opinion=0')
         plt.plot(x, y[1], label='Opinion=1')
         plt.legend()
         plt.show()
 
-    def run_test_continuous(self):
+    def run_test_continuous(self, max_steps=100, window=None, tol=1e-6, path=None,
+                            stride=1, budget=1 << 27, mode=None, plot=True):
         """
-        Run a simulation using one of the continuous opinion models and plot the results
-        :return: None
+        Run a simulation using one of the continuous opinion models and plot
+        the results.  The run stops early once no opinion moves more than tol
+        over a window of updates.  Opinions are recorded with a
+        TrajectoryRecorder, so large runs stay in bounded memory and can be
+        reloaded later with trajectory.load_trajectory(path).
+        :param max_steps: largest number of updates to run
+        :param window: number of updates between convergence checks.  If None,
+                       one sweep for 'hk' and one update per agent for 'dw'.
+        :param tol: largest opinion change over a window of a converged run
+        :param path: if given, spill the recorded opinions to path.npy
+        :param stride: record the opinions every this many updates
+        :param budget: largest number of bytes of recorded opinions kept in memory
+        :param mode: 'lines', 'density', or None to pick by size
+        :param plot: if False, only record, without importing matplotlib
+        :return: the TrajectoryRecorder
         """
         if self.method not in ['hk', 'dw']:
             print(f'Call run_test_discrete when using model {self.method}')
             return
+        if window is None:
+            window = 1 if self.method == 'hk' else self.compiled.num_nodes
+
+        recorder = TrajectoryRecorder(self.compiled.num_nodes, path=path, stride=stride, budget=budget)
+        self.is_converged(tol)
+        recorder.record(0, self.opinions)
+        steps = 0
+        for steps in range(1, max_steps + 1):
+            self.update()
+            recorder.record(steps, self.opinions)
+            if steps % window == 0 and self.is_converged(tol):
+                break
+        # Keep the final opinions even when the last step is off the stride
+        recorder.record(steps, self.opinions, force=True)
+        recorder.close()
 
-        x, ys = [], []
-        for i in range(self.g.number_of_nodes()):
-            ys.append([])
-
-        for i in range(100):
-            x.append(i)
-            for j in range(self.g.number_of_nodes()):
-                ys[j].append(self.opinions[j])
+        if plot:
+            import matplotlib.pyplot as plt
 
-        for line in ys:
-            plt.plot(x, line, alpha=0.5)
-        plt.show()
+            recorder.plot(mode=mode)
+            plt.show()
+        return recorder
 
-    def run(self):
+    def run_async(self, steps, record_every=1000, block=1 << 16, stop=True):
         """
-        Driver function to run an experiment
-        :return: None
+        Run many asynchronous single-node updates of a binary opinion model.
+        Random node indices and neighbor offsets are drawn from self.rng in
+        blocks, and the observables are kept up to date as opinions change,
+        so each update is a few list lookups.
+        :param steps: number of single-node updates to run
+        :param record_every: record the opinion counts every this many updates
+        :param block: number of updates to draw random numbers for at once
+        :param stop: if True, stop at the first recording point with no
+                     discordant edges (consensus or a frozen state).  If False,
+                     flips skip the discordant bookkeeping, and the count is
+                     redone once at the end.
+        :return: a tuple (x, y) of numpy arrays: update counts (including 0
+                 and the last update run), and the number of agents with
+                 opinion 1 after that many updates
+        """
+        n = self.compiled.num_nodes
+        rule = ASYNC_RULES[self.method]
+        lists = self.get_lists()
+        draws = 1 if self.method in ['voter', 'snazjd'] else self.q
+        stats = [self.ones, self.discordant, self.flips]
+
+        x, y = [0], [stats[0]]
+        done = 0
+        while done < steps and not (stop and stats[1] == 0):
+            size = min(block, steps - done)
+            nodes = self.rng.integers(0, n, size).tolist()
+            us = self.rng.random(size * draws).tolist()
+
+            # Run the block in chunks that end at the recording points
+            t = 0
+            while t < size:
+                chunk = min(size - t, record_every - (done + t) % record_every)
+                rule(lists, self.opinions, self.q, nodes[t:t + chunk],
+                     us[t * draws:(t + chunk) * draws], stats, stop)
+                t += chunk
+                if (done + t) % record_every == 0:
+                    x.append(done + t)
+                    y.append(stats[0])
+                    if stop and stats[1] == 0:
+                        break
+            done += t
+
+        self.ones, self.discordant, self.flips = stats
+        if not stop:
+            # The rules only keep the discordant count up to date for stop
+            self.discordant = self.count_discordant()
+
+        # Always record the final state
+        if x[-1] != done:
+            x.append(done)
+            y.append(stats[0])
+        return np.array(x), np.array(y)
+
+    def run_gillespie(self, steps, record_every=1000, exact=True, block=1 << 14):
+        """
+        Run the 'voter', 'qvoter' or 'majority' model event by event, only
+        simulating the updates that change an opinion.  Every node's chance
+        to flip when picked is kept in a SumTree and changed as its
+        neighbors flip, so each flip is drawn directly in proportion to it.
+        The number of skipped updates in between is drawn from the matching
+        waiting time distribution, so the result is distributed as a run of
+        single-node updates, while near consensus almost no work is done.
+        :param steps: number of single-node updates to run (simulated or skipped)
+        :param record_every: record the opinion counts every this many flips
+        :param exact: if True, waiting times are geometric and the run matches
+                      run_async exactly in distribution.  If False, they are the
+                      exponential waiting times of the continuous-time model.
+        :param block: number of uniform random numbers to draw at once
+        :return: a tuple (x, y) of numpy arrays: update counts (including 0 and
+                 the time the run ended), and the number of agents with opinion
+                 1 at that time
         """
+        if self.method not in ['voter', 'qvoter', 'majority']:
+            raise ValueError(f'run_gillespie does not support the {self.method} model')
+        n = self.compiled.num_nodes
+        method, q = self.method, self.q
+        op = self.opinions
+        indptr, indices, in_indptr, in_indices = self.get_lists()
+
+        # d[i] is the number of out-neighbors of i that disagree with it
+        rows, cols = self.compiled.get_edge_arrays()
+        ops = np.array(op, dtype=np.int8)
+        loops = rows == cols
+        d = np.bincount(rows[(ops[rows] != ops[cols]) & ~loops], minlength=n).tolist()
+        k = np.diff(self.compiled.out_indptr).tolist()
+        k_free = (np.diff(self.compiled.out_indptr) - np.bincount(rows[loops], minlength=n)).tolist()
+        tree = SumTree([flip_rate(method, q, d[i], k[i]) for i in range(n)])
+        update = tree.update
+
+        # The voter and q-voter chances are powers of the disagreeing fraction
+        power = {'voter': 1, 'qvoter': q}.get(method)
+
+        time = 0.
+        flips = 0
+        x, y = [0], [self.ones]
+        us = []
+        while True:
+            rate = tree.total()
+            if rate <= 0:
+                break
+            if len(us) < 2:
+                us = self.rng.random(block).tolist()
+
+            # Updates until the next flip: each one flips with probability rate / n
+            u = 1. - us.pop()
+            if not exact:
+                time += -log(u) * n / rate
+            elif rate >= n:
+                time += 1
+            else:
+                time += int(log(u) / log(1. - rate / n)) + 1
+            if time > steps:
+                break
+
+            # Flip a node, then update the chances of everyone who watches it
+            v = tree.sample(us.pop())
+            new = 1 - op[v]
+            op[v] = new
+            change = k_free[v] - 2 * d[v]
+            d[v] = k_free[v] - d[v]
+            update(v, (d[v] / k[v]) ** power if power else flip_rate(method, q, d[v], k[v]))
+            for j in range(in_indptr[v], in_indptr[v + 1]):
+                w = in_indices[j]
+                if w == v:
+                    continue
+                if op[w] == new:
+                    d[w] -= 1
+                    change -= 1
+                else:
+                    d[w] += 1
+                    change += 1
+                update(w, (d[w] / k[w]) ** power if power else flip_rate(method, q, d[w], k[w]))
+
+            self.discordant += change
+            self.ones += 1 if new else -1
+            self.flips += 1
+            flips += 1
+            if flips % record_every == 0:
+                x.append(time)
+                y.append(self.ones)
+
+        # Record the end of the run: consensus, a frozen state or the step limit
+        end = min(time, steps) if tree.total() > 0 else time
+        if x[-1] != end:
+            x.append(end)
+            y.append(self.ones)
+        return np.array(x), np.array(y)
+
+    def run(self, steps=None, record_every=1000, stop=True):
+        """
+        Driver function to run an experiment.  With steps, runs the binary
+        opinion models with run_async and returns the recorded counts
+        instead of plotting.
+        :param steps: number of single-node updates, or None to run and plot the default test
+        :param record_every: record the opinion counts every this many updates
+        :param stop: if True, stop once there are no discordant edges left
+        :return: None, or the (x, y) arrays from run_async
+        """
+        if steps is not None:
+            if self.method not in ['voter', 'qvoter', 'majority', 'snazjd']:
+                raise ValueError(f'run(steps) only supports binary opinion models, not {self.method}')
+            return self.run_async(steps, record_every, stop=stop)
+
         if self.method in ['voter', 'qvoter', 'majority', 'snazjd']:
             self.run_test_discrete()
         else:
@@ -0,0 +1,338 @@
+# Centrality scores on compiled graphs, with an on-disk cache
+
+import numpy as np
+import hashlib
+import json
+import os
+from math import ceil, log
+from compiled_graph import CompiledGraph, row_positions
+
+# Where get_centrality keeps its cache unless told otherwise
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'centrality')
+
+
+def graph_hash(g):
+    """
+    Hash the structure of a compiled graph.  Graphs with the same edges and
+    the same node order get the same hash, whatever their labels.
+    :param g: A CompiledGraph
+    :return: A hex digest
+    """
+    h = hashlib.sha1()
+    h.update(b'directed' if g.directed else b'undirected')
+    h.update(np.ascontiguousarray(g.out_indptr, dtype=np.int64).tobytes())
+    h.update(np.ascontiguousarray(g.out_indices, dtype=np.int32).tobytes())
+    return h.hexdigest()
+
+def expand(indptr, indices, nodes):
+    """
+    List the out-edges of a set of nodes
+    :param indptr: CSR row pointer array
+    :param indices: CSR neighbor array
+    :param nodes: An array of node ids
+    :return: A tuple (sources, targets) of id arrays, one entry per edge
+    """
+    counts, edges = row_positions(indptr, nodes)
+    return np.repeat(nodes, counts), indices[edges].astype(np.int64)
+
+def undirected_lists(g):
+    """
+    Get the adjacency of a graph with edge directions dropped and self loops removed
+    :param g: A CompiledGraph
+    :return: A tuple (indptr, indices) of numpy CSR arrays
+    """
+    sources, targets = g.get_edge_arrays()
+    if g.directed:
+        sources, targets = np.concatenate([sources, targets]), np.concatenate([targets, sources])
+    keep = sources != targets
+    keys = np.unique(sources[keep].astype(np.int64) * g.num_nodes + targets[keep])
+    sources, targets = keys // g.num_nodes, keys % g.num_nodes
+    indptr = np.zeros(g.num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=g.num_nodes), out=indptr[1:])
+    return indptr, targets
+
+def degree_scores(g):
+    """
+    Degree centrality: the number of out-neighbors of each node
+    :param g: A CompiledGraph
+    :return: A numpy array of scores
+    """
+    return g.out_degree.astype(np.float64)
+
+def core_numbers(g):
+    """
+    The k-core number of each node, with the bucket algorithm of Batagelj
+    and Zaversnik, which runs in O(E).  Edge directions and self loops are ignored.
+    :param g: A CompiledGraph
+    :return: A numpy array of core numbers
+    """
+    indptr, indices = undirected_lists(g)
+    n = g.num_nodes
+    degree = np.diff(indptr)
+
+    # Nodes sorted by degree, with the start of each degree's bucket
+    order = np.argsort(degree, kind='stable')
+    bins = np.zeros(degree.max(initial=0) + 2, dtype=np.int64)
+    np.cumsum(np.bincount(degree, minlength=len(bins) - 1), out=bins[1:])
+    pos = np.empty(n, dtype=np.int64)
+    pos[order] = np.arange(n)
+
+    degree, order, pos, bins = degree.tolist(), order.tolist(), pos.tolist(), bins.tolist()
+    indptr, indices = indptr.tolist(), indices.tolist()
+    for i in range(n):
+        v = order[i]
+        for j in range(indptr[v], indptr[v + 1]):
+            u = indices[j]
+            if degree[u] > degree[v]:
+                # Move u to the front of its bucket, then into the bucket below
+                du = degree[u]
+                w = order[bins[du]]
+                if u != w:
+                    pu, pw = pos[u], pos[w]
+                    order[pu], order[pw] = w, u
+                    pos[u], pos[w] = pw, pu
+                bins[du] += 1
+                degree[u] -= 1
+    return np.array(degree, dtype=np.float64)
+
+def pagerank_scores(g, alpha=.85, tol=1e-10, max_iter=200):
+    """
+    PageRank by power iteration.  Dangling nodes spread their rank evenly,
+    as in networkx.
+    :param g: A CompiledGraph
+    :param alpha: Damping factor
+    :param tol: Stop once the total change of the ranks is below n * tol
+    :param max_iter: Largest number of iterations
+    :return: A numpy array of scores summing to 1
+    """
+    n = g.num_nodes
+    sources, targets = g.get_edge_arrays()
+    out = g.out_degree.astype(np.float64)
+    dangling = out == 0
+    share = np.divide(1., out, out=np.zeros(n), where=~dangling)[sources]
+    x = np.full(n, 1. / n)
+    for i in range(max_iter):
+        last = x
+        x = alpha * np.bincount(targets, weights=last[sources] * share, minlength=n)
+        x += (alpha * last[dangling].sum() + 1 - alpha) / n
+        if np.abs(x - last).sum() < n * tol:
+            break
+    return x
+
+def betweenness_pivots(n, epsilon, delta=.1):
+    """
+    Number of pivots for sampled betweenness.  Each pivot gives an unbiased
+    estimate of a node's normalized betweenness bounded in [0, 1], so by
+    Hoeffding's inequality and a union bound over the n nodes, this many
+    pivots keep every estimate within epsilon with probability 1 - delta.
+    :param n: Number of nodes
+    :param epsilon: Largest error of the normalized betweenness
+    :param delta: Allowed failure probability
+    :return: The number of pivots, at most n
+    """
+    return min(n, int(ceil(log(2 * n / delta) / (2 * epsilon ** 2))))
+
+def betweenness_scores(g, pivots=None, epsilon=None, delta=.1, seed=0, normalized=True):
+    """
+    Shortest-path betweenness with Brandes' algorithm, run from all nodes or
+    from a random sample of pivots and scaled up (Brandes and Pich).  Each
+    breadth-first search and its dependency accumulation are vectorized
+    level by level.
+    :param g: A CompiledGraph
+    :param pivots: Number of sampled source nodes.  Exact if None and epsilon is None.
+    :param epsilon: If given, choose pivots with betweenness_pivots(n, epsilon, delta)
+    :param delta: Failure probability of the epsilon bound
+    :param seed: Seed for sampling pivots
+    :param normalized: If True, scale as networkx.betweenness_centrality does
+    :return: A numpy array of scores
+    """
+    n = g.num_nodes
+    if epsilon is not None:
+        pivots = betweenness_pivots(n, epsilon, delta)
+    if pivots is None or pivots >= n:
+        sources = np.arange(n)
+    else:
+        sources = np.random.default_rng(seed).choice(n, pivots, replace=False)
+    indptr, indices = g.out_indptr, g.out_indices
+
+    scores = np.zeros(n)
+    dist = np.empty(n, dtype=np.int64)
+    for s in sources.tolist():
+        dist[:] = -1
+        dist[s] = 0
+        sigma = np.zeros(n)
+        sigma[s] = 1.
+        frontier = np.array([s])
+        levels = []
+        d = 0
+        while len(frontier) > 0:
+            src, dst = expand(indptr, indices, frontier)
+            fresh = dst[dist[dst] == -1]
+            dist[fresh] = d + 1
+            on_path = dist[dst] == d + 1
+            src, dst = src[on_path], dst[on_path]
+            sigma += np.bincount(dst, weights=sigma[src], minlength=n)
+            levels.append((src, dst))
+            frontier = np.unique(fresh)
+            d += 1
+
+        # Accumulate dependencies from the farthest level back
+        dependency = np.zeros(n)
+        for src, dst in reversed(levels):
+            dependency += np.bincount(src, weights=sigma[src] / sigma[dst] * (1. + dependency[dst]),
+                                      minlength=n)
+        dependency[s] = 0.
+        scores += dependency
+
+    scores *= n / len(sources)
+    if not g.directed:
+        scores /= 2
+    if normalized and n > 2:
+        scores /= (n - 1) * (n - 2) / (1 if g.directed else 2)
+    return scores
+
+def collective_influence_scores(g, ell=2):
+    """
+    Collective influence (Morone and Makse): (k_i - 1) times the sum of
+    (k_j - 1) over the nodes j at distance exactly ell from i.  Edge
+    directions and self loops are ignored.
+    :param g: A CompiledGraph
+    :param ell: Radius of the ball
+    :return: A numpy array of scores
+    """
+    indptr, indices = undirected_lists(g)
+    n = g.num_nodes
+    excess = np.diff(indptr) - 1
+    if ell == 1:
+        sources = np.repeat(np.arange(n), np.diff(indptr))
+        return excess * np.bincount(sources, weights=excess[indices], minlength=n)
+
+    scores = np.zeros(n)
+    seen = np.full(n, -1, dtype=np.int64)
+    for i in range(n):
+        if excess[i] <= 0:
+            continue
+        seen[i] = i
+        frontier = np.array([i])
+        for d in range(ell):
+            dst = expand(indptr, indices, frontier)[1]
+            frontier = np.unique(dst[seen[dst] != i])
+            seen[frontier] = i
+        scores[i] = excess[i] * excess[frontier].sum()
+    return scores
+
+# The metrics get_centrality knows, with the keyword parameters each one takes
+METRICS = {
+    'degree': degree_scores,
+    'kcore': core_numbers,
+    'pagerank': pagerank_scores,
+    'betweenness': betweenness_scores,
+    'collective_influence': collective_influence_scores,
+}
+
+class CentralityCache:
+    """
+    A directory of saved score arrays, one .npy file per graph, metric and
+    parameters.  The least recently used files are deleted once there are
+    more than max_entries of them.
+    """
+
+    def __init__(self, path=CACHE_DIR, max_entries=128):
+        """
+        Constructor for a centrality cache
+        :param path: The cache directory.  It is created if needed.
+        :param max_entries: Largest number of score arrays to keep
+        """
+        self.path = path
+        self.max_entries = max_entries
+        os.makedirs(path, exist_ok=True)
+
+    def get_file(self, key):
+        """
+        Get the file of a cache entry
+        :param key: The entry's key
+        :return: A file path
+        """
+        return os.path.join(self.path, key + '.npy')
+
+    def get(self, key):
+        """
+        Look up scores, marking them as recently used
+        :param key: The entry's key
+        :return: A numpy array, or None if the scores are not cached
+        """
+        file = self.get_file(key)
+        try:
+            scores = np.load(file)
+        except (OSError, ValueError):
+            return None
+        os.utime(file)
+        return scores
+
+    def put(self, key, scores):
+        """
+        Save scores, then evict the least recently used entries
+        :param key: The entry's key
+        :param scores: A numpy array
+        :return: None
+        """
+        # Write to a temporary file first so a reader never sees half a file
+        file = self.get_file(key)
+        tmp = file + '.tmp.npy'
+        np.save(tmp, scores)
+        os.replace(tmp, file)
+
+        entries = [os.path.join(self.path, name) for name in os.listdir(self.path)
+                   if name.endswith('.npy') and not name.endswith('.tmp.npy')]
+        if len(entries) > self.max_entries:
+            entries.sort(key=os.path.getmtime)
+            for old in entries[:len(entries) - self.max_entries]:
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+
+_default_cache = None
+
+def get_centrality(g, metric='degree', cache=True, **params):
+    """
+    Get centrality scores, from the cache if they were computed before
+    :param g: A networkx graph or a CompiledGraph
+    :param metric: One of the keys of METRICS
+    :param cache: True for the default cache in CACHE_DIR, a CentralityCache, or False
+    :param params: Keyword parameters of the metric's function
+    :return: A numpy array of scores by node id
+    """
+    global _default_cache
+    if metric not in METRICS:
+        raise ValueError(f'Unknown centrality metric {metric}')
+    if not isinstance(g, CompiledGraph):
+        g = CompiledGraph.from_networkx(g)
+    if cache is True:
+        if _default_cache is None:
+            _default_cache = CentralityCache()
+        cache = _default_cache
+    if not cache:
+        return METRICS[metric](g, **params)
+
+    key = hashlib.sha1((graph_hash(g) + metric + json.dumps(params, sort_keys=True)).encode()).hexdigest()
+    scores = cache.get(key)
+    if scores is None or len(scores) != g.num_nodes:
+        scores = METRICS[metric](g, **params)
+        cache.put(key, scores)
+    return scores
+
+def top_nodes(g, k, metric='degree', cache=True, **params):
+    """
+    Get the k nodes with the highest centrality scores
+    :param g: A networkx graph or a CompiledGraph
+    :param k: Number of nodes
+    :param metric: One of the keys of METRICS
+    :param cache: True for the default cache, a CentralityCache, or False
+    :param params: Keyword parameters of the metric's function
+    :return: A list of node labels, highest score first
+    """
+    if not isinstance(g, CompiledGraph):
+        g = CompiledGraph.from_networkx(g)
+    scores = get_centrality(g, metric, cache, **params)
+    return g.to_label(np.argsort(-scores, kind='stable')[:k])
@@ -0,0 +1,362 @@
+# Command-line entry point for running any of the models without plotting
+#
+# Examples:
+#   python cli.py voter --graph watts_strogatz --n 1000 --out counts.csv
+#   python cli.py sir --graph-file graph.bin --beta .05 --gamma .1 --summary summary.json
+#   python cli.py hk --config run.json --out opinions.npy --plot-file opinions.png
+#
+# Model modules, matplotlib, ndlib and bokeh are imported only by the runs
+# that use them.
+
+import argparse
+import csv
+import json
+import random
+import sys
+import numpy as np
+
+BINARY = ['voter', 'qvoter', 'majority', 'snazjd']
+CONTINUOUS = ['hk', 'dw']
+EPIDEMIC = ['sir', 'sirs']
+NDLIB = ['seir', 'sis', 'seis']
+MODELS = ['ic'] + BINARY + CONTINUOUS + EPIDEMIC + NDLIB
+
+
+def get_parser():
+    """
+    Build the argument parser
+    :return: An argparse.ArgumentParser
+    """
+    parser = argparse.ArgumentParser(description='Run a diffusion, opinion or epidemic model.')
+    parser.add_argument('model', nargs='?', choices=MODELS, help='the model to run')
+    parser.add_argument('--config', help='a JSON file of option values; flags override it')
+
+    graph = parser.add_argument_group('graph')
+    graph.add_argument('--graph', default='watts_strogatz',
+                       help='a graph family from sweep.FAMILIES (default watts_strogatz)')
+    graph.add_argument('--n', type=int, default=1000, help='number of nodes of a generated graph')
+    graph.add_argument('--graph-seed', type=int, default=0, help='seed of a generated graph')
+    graph.add_argument('--graph-file', help='a graph_store file, or a text edge list')
+    graph.add_argument('--directed', action='store_true', help='read a text edge list as directed')
+
+    run = parser.add_argument_group('run')
+    run.add_argument('--seed', type=int, default=0, help='seed of the run')
+    run.add_argument('--steps', type=int,
+                     help='updates to run: single-node updates for binary opinion models '
+                          '(default 100 sweeps), sweeps for hk (default 100), pair updates for '
+                          'dw (default 100 sweeps), and steps for epidemics (default 250)')
+    run.add_argument('--record-every', type=int, help='record every this many updates (default one sweep)')
+    run.add_argument('--tol', type=float, default=1e-6, help='convergence tolerance of hk and dw')
+
+    params = parser.add_argument_group('model parameters')
+    params.add_argument('--q', type=int, help='group size of qvoter and majority')
+    params.add_argument('--epsilon', type=float, default=.3, help='confidence bound of hk and dw')
+    params.add_argument('--mu', type=float, default=.5, help='convergence rate of dw')
+    params.add_argument('--prob', type=float, default=.1, help='activation probability of ic')
+    params.add_argument('--k', type=int, default=5, help='number of initially active nodes of ic')
+    params.add_argument('--metric', default='random',
+                        help="how ic picks its initial nodes: 'random' or a centrality.METRICS name")
+    params.add_argument('--beta', type=float, default=.05, help='infection probability')
+    params.add_argument('--gamma', type=float, default=.1, help='recovery probability')
+    params.add_argument('--delta', type=float, default=.05, help='loss of immunity probability of sirs')
+    params.add_argument('--alpha', type=float, default=.05, help='incubation probability of seir and seis')
+    params.add_argument('--lambda', dest='lam', type=float, default=.1,
+                        help='recovery probability of sis and seis')
+    params.add_argument('--fraction-infected', type=float, default=.05, help='initially infected fraction')
+    params.add_argument('--replicas', type=int, default=1,
+                        help='replicas of the epidemic models; more than 1 records median and quartiles')
+    params.add_argument('--processes', type=int,
+                        help='worker processes for replicas of seir, sis and seis (default every core)')
+    params.add_argument('--gillespie', action='store_true', help='run sir and sirs event by event')
+
+    out = parser.add_argument_group('output')
+    out.add_argument('--out', help='write the trajectory to this .csv or .npy file.  hk and dw '
+                                   'stream their opinions to a .npy file, with the steps in a '
+                                   '.steps.npy file, see trajectory.load_trajectory')
+    out.add_argument('--summary', help='write the summary to this .csv or .json file')
+    out.add_argument('--plot', action='store_true', help='show a plot of the trajectory')
+    out.add_argument('--plot-file', help='save a plot of the trajectory to this image file')
+    return parser
+
+def parse_args(argv=None):
+    """
+    Parse the command line, taking defaults from a JSON config file if one is given
+    :param argv: The arguments, or None for sys.argv
+    :return: An argparse.Namespace
+    """
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    if args.config is not None:
+        with open(args.config) as f:
+            config = json.load(f)
+        known = vars(args)
+        defaults = {}
+        for key, value in config.items():
+            dest = 'lam' if key == 'lambda' else key.replace('-', '_')
+            if dest not in known or dest == 'config':
+                parser.error(f'unknown option {key} in {args.config}')
+            defaults[dest] = value
+        parser.set_defaults(**defaults)
+        args = parser.parse_args(argv)
+    if args.model is None:
+        parser.error('no model given on the command line or in the config file')
+    if args.model not in MODELS:
+        parser.error(f'unknown model {args.model}')
+    return args
+
+def load_graph(args):
+    """
+    Load or generate the graph of a run
+    :param args: The parsed arguments
+    :return: A networkx graph or a CompiledGraph
+    """
+    if args.graph_file is None:
+        from sweep import FAMILIES
+
+        if args.graph not in FAMILIES:
+            raise SystemExit(f'Unknown graph family {args.graph}; choose from {", ".join(FAMILIES)}')
+        return FAMILIES[args.graph](args.n, args.graph_seed)
+
+    import graph_store
+
+    try:
+        graph_store.read_header(args.graph_file)
+    except (ValueError, UnicodeDecodeError):
+        import networkx as nx
+
+        return nx.read_edgelist(args.graph_file, create_using=nx.DiGraph if args.directed else nx.Graph)
+    return graph_store.load_graph(args.graph_file)
+
+def run_ic(g, args):
+    """
+    Run an independent cascade until no more activations are possible
+    :param g: A graph
+    :param args: The parsed arguments
+    :return: A tuple (columns, rows, summary)
+    """
+    import tw8
+
+    ic = tw8.ICModel(g, args.prob, seed=args.seed)
+    if args.metric == 'random':
+        nodes = tw8.get_k_random_nodes(ic, args.k)
+    else:
+        nodes = tw8.get_k_central_nodes(ic, args.k, args.metric)
+    ic.activate_nodes(nodes)
+
+    rows = [(0, ic.get_num_activated())]
+    while not ic.is_done():
+        ic.update()
+        rows.append((len(rows), ic.get_num_activated()))
+    spread = rows[-1][1]
+    summary = {'spread': spread, 'fraction': spread / ic.compiled.num_nodes, 'steps': len(rows) - 1}
+    return ['step', 'active'], np.array(rows), summary
+
+def run_binary(g, args):
+    """
+    Run a binary opinion model with DiffusionModel.run_async
+    :param g: A graph
+    :param args: The parsed arguments
+    :return: A tuple (columns, rows, summary)
+    """
+    from asgn8 import DiffusionModel
+
+    d = DiffusionModel(g, method=args.model, q=args.q, seed=args.seed)
+    n = d.compiled.num_nodes
+    x, ones = d.run_async(args.steps or 100 * n, args.record_every or n, stop=True)
+    summary = {'consensus': max(d.ones, n - d.ones) / n, 'converged': d.discordant == 0,
+               'time': int(x[-1]), 'flips': d.flips}
+    return ['step', 'opinion0', 'opinion1'], np.column_stack([x, n - ones, ones]), summary
+
+def run_continuous(g, args):
+    """
+    Run the hk or dw model until its opinions stop moving.  The opinions
+    are streamed into a TrajectoryRecorder, which spills them to the --out
+    file if it is a .npy file, and otherwise keeps a bounded number of frames.
+    :param g: A graph
+    :param args: The parsed arguments
+    :return: A tuple (columns, recorder, summary), with one column per agent
+    """
+    from asgn8 import DiffusionModel
+
+    d = DiffusionModel(g, method=args.model, epsilon=args.epsilon, mu=args.mu, seed=args.seed)
+    n = d.compiled.num_nodes
+    steps = args.steps or (100 if args.model == 'hk' else 100 * n)
+    stride = args.record_every or (1 if args.model == 'hk' else n)
+    path = args.out[:-len('.npy')] if args.out is not None and args.out.endswith('.npy') else None
+    recorder = d.run_test_continuous(steps, tol=args.tol, path=path, stride=stride, plot=False)
+    recorded = recorder.get_steps()
+    sizes = [size for (mean, size) in d.get_clusters()]
+    summary = {'clusters': len(sizes), 'consensus': max(sizes) / n,
+               'time': int(recorded[-1]) if len(recorded) else 0}
+    return ['step'] + [str(label) for label in d.compiled.labels], recorder, summary
+
+def run_epidemic(g, args):
+    """
+    Run the array-based SIR or SIRS model of asgn4_part2
+    :param g: A networkx graph or a CompiledGraph
+    :param args: The parsed arguments
+    :return: A tuple (columns, rows, summary)
+    """
+    import asgn4_part2 as sir
+
+    steps = args.steps or 250
+    sir.set_parameters(g, args.beta, args.gamma, args.delta if args.model == 'sirs' else 0.)
+    if args.replicas > 1:
+        x, bands = sir.run_ensemble(g, args.replicas, steps, args.fraction_infected)
+        columns = ['step'] + [f'{name}_{stat}' for name in sir.STATE_NAMES for stat in ['median', 'q25', 'q75']]
+        rows = np.column_stack([x] + [band for name in sir.STATE_NAMES for band in bands[name]])
+        counts = np.array([bands[name][0] for name in sir.STATE_NAMES])
+    else:
+        sir.set_initial_states(g, args.fraction_infected)
+        x, counts = sir.run_sim(g, steps, gillespie=args.gillespie, plot=False)
+        columns = ['step'] + list(sir.STATE_NAMES)
+        rows = np.column_stack([x, counts.T])
+
+    infected = counts[sir.I]
+    summary = {name: float(counts[state][-1]) for state, name in enumerate(sir.STATE_NAMES)}
+    summary.update({'peak_infected': float(infected.max()), 'peak_step': int(x[int(np.argmax(infected))])})
+    return columns, rows, summary
+
+def run_ndlib(g, args):
+    """
+    Run an ndlib epidemic model from asgn4_part1
+    :param g: A graph
+    :param args: The parsed arguments
+    :return: A tuple (columns, rows, summary)
+    """
+    import asgn4_part1
+
+    names = {'seir': ['beta', 'alpha', 'gamma'], 'sis': ['beta', 'lambda'], 'seis': ['beta', 'alpha', 'lambda']}
+    values = {'beta': args.beta, 'alpha': args.alpha, 'gamma': args.gamma, 'lambda': args.lam}
+    params = {name: values[name] for name in names[args.model]}
+    params['fraction_infected'] = args.fraction_infected
+
+    steps = args.steps or 250
+    if args.replicas > 1:
+        x, bands = asgn4_part1.run_ensemble(g, args.model, params, steps, args.replicas,
+                                            args.processes, args.seed)
+        columns = ['step'] + [f'{name}_{stat}' for name in bands for stat in ['median', 'q25', 'q75']]
+        summary = {name: float(band[0][-1]) for name, band in bands.items()}
+        return columns, np.column_stack([x] + [row for band in bands.values() for row in band]), summary
+
+    # ndlib draws from both the random module and numpy's global generator
+    np.random.seed(args.seed)
+    x, counts = asgn4_part1.run_model(g, args.model, params, steps, plot=False)
+    columns = ['step'] + list(counts)
+    summary = {name: int(count[-1]) for name, count in counts.items()}
+    return columns, np.column_stack([x] + list(counts.values())), summary
+
+RUNNERS = {'ic': run_ic}
+RUNNERS.update({model: run_binary for model in BINARY})
+RUNNERS.update({model: run_continuous for model in CONTINUOUS})
+RUNNERS.update({model: run_epidemic for model in EPIDEMIC})
+RUNNERS.update({model: run_ndlib for model in NDLIB})
+
+def write_rows(path, columns, rows):
+    """
+    Write a trajectory table
+    :param path: A .npy file, or a CSV file for any other extension
+    :param columns: The column names
+    :param rows: A 2D numpy array with one row per recorded step
+    :return: None
+    """
+    if path.endswith('.npy'):
+        np.save(path, rows)
+        return
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        writer.writerows(rows.tolist())
+
+def write_trajectory(path, columns, recorder, chunk=1024):
+    """
+    Write the opinions of a continuous model a chunk of frames at a time
+    :param path: A .npy file, or a CSV file for any other extension.  A .npy
+                 file holds the frames, with the steps in a .steps.npy file
+                 next to it, and is read with trajectory.load_trajectory.
+    :param columns: The column names
+    :param recorder: The TrajectoryRecorder of the run
+    :param chunk: Number of frames written at once
+    :return: None
+    """
+    if path.endswith('.npy'):
+        if recorder.path is None:
+            np.save(path, recorder.get_frames())
+            np.save(path[:-len('.npy')] + '.steps.npy', recorder.get_steps())
+        recorder.close()
+        return
+    steps, frames = recorder.get_steps(), recorder.get_frames()
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for start in range(0, len(steps), chunk):
+            block = np.column_stack([steps[start:start + chunk], np.asarray(frames[start:start + chunk])])
+            writer.writerows(block.tolist())
+
+def write_summary(path, summary):
+    """
+    Write a run summary
+    :param path: A .csv file, or a JSON file for any other extension
+    :param summary: A dictionary of results
+    :return: None
+    """
+    with open(path, 'w', newline='') as f:
+        if path.endswith('.csv'):
+            writer = csv.writer(f)
+            writer.writerow(list(summary))
+            writer.writerow(list(summary.values()))
+        else:
+            json.dump(summary, f, indent=2)
+
+def plot_rows(args, columns, rows):
+    """
+    Plot a trajectory, on screen or to a file.  Only imports matplotlib here.
+    :param args: The parsed arguments
+    :param columns: The column names
+    :param rows: A 2D numpy array with the steps in its first column, or the
+                 TrajectoryRecorder of a continuous model
+    :return: None
+    """
+    import matplotlib
+    if not args.plot:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots()
+    if args.model in CONTINUOUS:
+        rows.plot(ax=ax)
+    else:
+        for i, name in enumerate(columns[1:], 1):
+            ax.plot(rows[:, 0], rows[:, i], label=name)
+        ax.legend()
+    ax.set_xlabel('step')
+    ax.set_title(args.model)
+    if args.plot_file is not None:
+        fig.savefig(args.plot_file)
+    if args.plot:
+        plt.show()
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # The initial states of every model come from the random module
+    random.seed(args.seed)
+    g = load_graph(args)
+    columns, rows, summary = RUNNERS[args.model](g, args)
+    summary = {'model': args.model, 'nodes': g.number_of_nodes(), **summary}
+
+    if args.out is not None:
+        if args.model in CONTINUOUS:
+            write_trajectory(args.out, columns, rows)
+        else:
+            write_rows(args.out, columns, rows)
+    if args.summary is not None:
+        write_summary(args.summary, summary)
+    if args.plot or args.plot_file is not None:
+        plot_rows(args, columns, rows)
+    json.dump(summary, sys.stdout)
+    print()
+
+
+if __name__ == '__main__':
+    main()
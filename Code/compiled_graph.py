@@ -0,0 +1,322 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+
+def share_arrays(arrays):
+    """
+    Copy numpy arrays into shared memory blocks so that worker processes
+    can map them without pickling.
+    :param arrays: A list of numpy arrays
+    :return: A tuple (handles, specs).  Keep the handles alive while workers
+             run, then close and unlink them.  Pass specs to attach_arrays.
+    """
+    handles, specs = [], []
+    for arr in arrays:
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+        view[...] = arr
+        handles.append(shm)
+        specs.append((shm.name, arr.shape, arr.dtype.str))
+    return handles, specs
+
+def attach_arrays(specs):
+    """
+    Map arrays created by share_arrays in another process.
+    :param specs: The specs returned by share_arrays
+    :return: A tuple (handles, arrays)
+    """
+    handles, arrays = [], []
+    for (name, shape, dtype) in specs:
+        shm = shared_memory.SharedMemory(name=name)
+        handles.append(shm)
+        arrays.append(np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf))
+    return handles, arrays
+
+def row_positions(indptr, rows):
+    """
+    Get the positions in CSR arrays of the entries of some rows, e.g. the
+    out-edges of a set of nodes.
+    :param indptr: CSR row pointer array
+    :param rows: An array of row ids, repeats allowed
+    :return: A tuple (counts, positions): the number of entries of each row,
+             and the positions of all of their entries, row after row
+    """
+    starts = indptr[rows]
+    counts = indptr[rows + 1] - starts
+    ends = np.cumsum(counts)
+    total = int(ends[-1]) if len(ends) else 0
+    return counts, np.arange(total) + np.repeat(starts - ends + counts, counts)
+
+def csr_from_edges(sources, targets, num_nodes, weights=None):
+    """
+    Build sorted compressed sparse row arrays from an edge list.
+    :param sources: Array of edge sources (contiguous integer ids)
+    :param targets: Array of edge targets
+    :param num_nodes: Number of nodes
+    :param weights: Optional array of edge weights
+    :return: A tuple (indptr, indices, weights); weights is None if not given
+    """
+    sources = np.asarray(sources, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    order = np.lexsort((targets, sources))
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=num_nodes), out=indptr[1:])
+    indices = targets[order].astype(np.int32)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=np.float32)[order]
+    return indptr, indices, weights
+
+class CompiledGraph():
+    """
+    A graph relabeled once to contiguous integer ids 0..n-1 and stored as
+    compressed sparse row (CSR) arrays, for models whose inner loops should
+    not go through networkx dictionaries.
+
+    The out-neighbors of node i are out_indices[out_indptr[i]:out_indptr[i + 1]]
+    (sorted), and out_weights holds the matching edge weights if the graph
+    has any.  The in_* arrays hold the same for in-neighbors.  Undirected
+    edges are stored in both directions, so the in and out arrays are the
+    same.  labels[i] is the original label of node i, and index maps labels
+    back to ids.
+    """
+
+    def __init__(self, out_indptr, out_indices, out_weights=None, labels=None, directed=True,
+                 in_arrays=None):
+        """
+        Constructor for a compiled graph.  Use from_networkx or from_edges
+        unless the CSR arrays already exist.
+        :param out_indptr: CSR row pointer array
+        :param out_indices: CSR neighbor array, sorted within each row
+        :param out_weights: Optional CSR edge weight array
+        :param labels: Original node labels in id order.  Ids are the labels if None.
+        :param directed: Whether the graph is directed
+        :param in_arrays: Optional tuple (in_indptr, in_indices, in_weights) of a
+                          directed graph, if already built.  Built from the out arrays if None.
+        """
+        self.num_nodes = len(out_indptr) - 1
+        self.directed = directed
+        self.out_indptr = out_indptr
+        self.out_indices = out_indices
+        self.out_weights = out_weights
+        self.out_degree = np.diff(out_indptr)
+
+        if not directed:
+            self.in_indptr, self.in_indices, self.in_weights = out_indptr, out_indices, out_weights
+            self.in_degree = self.out_degree
+        else:
+            if in_arrays is None:
+                sources = np.repeat(np.arange(self.num_nodes), self.out_degree)
+                in_arrays = csr_from_edges(out_indices, sources, self.num_nodes, out_weights)
+            self.in_indptr, self.in_indices, self.in_weights = in_arrays
+            self.in_degree = np.diff(self.in_indptr)
+
+        # Keep labels only when they differ from the ids.  The label to id
+        # dictionary is built on first use.
+        if labels is None:
+            self.identity = True
+        elif isinstance(labels, np.ndarray):
+            self.identity = np.array_equal(labels, np.arange(self.num_nodes))
+        else:
+            self.identity = all(label == i for i, label in enumerate(labels))
+        if self.identity:
+            self.labels = range(self.num_nodes)
+        else:
+            self.labels = labels if isinstance(labels, np.ndarray) else list(labels)
+        self.index = None
+
+        # Graph attributes, like networkx's G.graph
+        self.graph = {}
+
+    @classmethod
+    def from_edges(cls, sources, targets, num_nodes, weights=None, directed=True, labels=None):
+        """
+        Compile a graph from arrays of edge endpoints given as ids.
+        :param sources: Array of edge sources
+        :param targets: Array of edge targets
+        :param num_nodes: Number of nodes
+        :param weights: Optional array of edge weights
+        :param directed: If False, each edge is stored in both directions
+        :param labels: Original node labels in id order
+        :return: A CompiledGraph
+        """
+        sources = np.asarray(sources, dtype=np.int64)
+        targets = np.asarray(targets, dtype=np.int64)
+        if not directed:
+            # Store each undirected edge once per direction, self loops once
+            loops = sources == targets
+            sources, targets = (np.concatenate([sources, targets[~loops]]),
+                                np.concatenate([targets, sources[~loops]]))
+            if weights is not None:
+                weights = np.concatenate([weights, np.asarray(weights)[~loops]])
+        indptr, indices, weights = csr_from_edges(sources, targets, num_nodes, weights)
+        return cls(indptr, indices, weights, labels=labels, directed=directed)
+
+    @classmethod
+    def from_networkx(cls, g, weight=None):
+        """
+        Compile a networkx graph.  Parallel edges of multigraphs are merged.
+        :param g: A networkx graph with any hashable node labels
+        :param weight: Name of an edge attribute to store as edge weights, or None
+        :return: A CompiledGraph
+        """
+        labels = list(g.nodes())
+        index = {label: i for i, label in enumerate(labels)}
+        sources, targets, weights = [], [], []
+        for u, nbrs in g.adjacency():
+            i = index[u]
+            for v, data in nbrs.items():
+                sources.append(i)
+                targets.append(index[v])
+                if weight is not None:
+                    if g.is_multigraph():
+                        data = next(iter(data.values()))
+                    weights.append(data.get(weight, 1.))
+        indptr, indices, weights = csr_from_edges(sources, targets, len(labels),
+                                                  weights if weight is not None else None)
+        return cls(indptr, indices, weights, labels=labels, directed=g.is_directed())
+
+    def number_of_nodes(self):
+        """
+        Get the number of nodes, as networkx graphs do.
+        :return: Number of nodes
+        """
+        return self.num_nodes
+
+    def number_of_edges(self):
+        """
+        Get the number of edges.  Undirected edges count once.
+        :return: Number of edges
+        """
+        m = len(self.out_indices)
+        if self.directed:
+            return m
+        loops = np.count_nonzero(self.out_indices == np.repeat(np.arange(self.num_nodes),
+                                                               self.out_degree))
+        return (m + loops) // 2
+
+    def is_directed(self):
+        """
+        Check whether the graph is directed, as networkx graphs do.
+        :return: True if the graph is directed
+        """
+        return self.directed
+
+    def neighbors(self, i):
+        """
+        Get the out-neighbors of a node.
+        :param i: Node id
+        :return: A numpy array of neighbor ids
+        """
+        return self.out_indices[self.out_indptr[i]:self.out_indptr[i + 1]]
+
+    def predecessors(self, i):
+        """
+        Get the in-neighbors of a node.
+        :param i: Node id
+        :return: A numpy array of neighbor ids
+        """
+        return self.in_indices[self.in_indptr[i]:self.in_indptr[i + 1]]
+
+    def get_edge_arrays(self):
+        """
+        Get the out-adjacency as a pair of edge endpoint arrays.
+        :return: A tuple (sources, targets) of id arrays
+        """
+        return np.repeat(np.arange(self.num_nodes), self.out_degree), self.out_indices
+
+    def node_id(self, label):
+        """
+        Convert a single node label to its id.
+        :param label: A node label
+        :return: The node id
+        """
+        if self.identity:
+            return label
+        return self.get_index()[label]
+
+    def node_label(self, i):
+        """
+        Convert a single node id to its label.
+        :param i: A node id
+        :return: The node label
+        """
+        if self.identity:
+            return int(i)
+        label = self.labels[i]
+        return label.item() if isinstance(label, np.generic) else label
+
+    def to_index(self, nodes):
+        """
+        Convert node labels to ids.
+        :param nodes: A list of node labels
+        :return: A list of node ids
+        """
+        if self.identity:
+            return list(nodes)
+        index = self.get_index()
+        return [index[u] for u in nodes]
+
+    def get_index(self):
+        """
+        Get the dictionary from node labels to ids, building it on first use.
+        :return: A dictionary, or None if the ids are the labels
+        """
+        if self.index is None and not self.identity:
+            labels = self.labels.tolist() if isinstance(self.labels, np.ndarray) else self.labels
+            self.index = {label: i for i, label in enumerate(labels)}
+        return self.index
+
+    def to_label(self, ids):
+        """
+        Convert node ids to labels.
+        :param ids: A list or array of node ids
+        :return: A list of node labels
+        """
+        if self.identity:
+            return [int(i) for i in ids]
+        if isinstance(self.labels, np.ndarray):
+            return self.labels[np.asarray(ids, dtype=np.int64)].tolist()
+        return [self.labels[i] for i in ids]
+
+    def to_networkx(self):
+        """
+        Export the graph to networkx with the original labels.
+        :return: A networkx Graph or DiGraph
+        """
+        import networkx as nx
+
+        g = nx.DiGraph() if self.directed else nx.Graph()
+        labels = self.labels.tolist() if isinstance(self.labels, np.ndarray) else self.labels
+        g.add_nodes_from(labels)
+        sources, targets = self.get_edge_arrays()
+        if self.out_weights is None:
+            g.add_edges_from((labels[u], labels[v]) for u, v in zip(sources.tolist(), targets.tolist()))
+        else:
+            g.add_weighted_edges_from((labels[u], labels[v], w) for u, v, w in
+                                      zip(sources.tolist(), targets.tolist(), self.out_weights.tolist()))
+        return g
+
+    def share(self):
+        """
+        Copy the out-adjacency into shared memory for worker processes.
+        :return: A tuple (handles, spec).  Keep the handles alive while
+                 workers run, then close and unlink them.  Pass spec to attach.
+        """
+        arrays = [self.out_indptr, self.out_indices]
+        if self.out_weights is not None:
+            arrays.append(self.out_weights)
+        handles, specs = share_arrays(arrays)
+        labels = None if self.identity else self.labels
+        return handles, (specs, labels, self.directed)
+
+    @classmethod
+    def attach(cls, spec):
+        """
+        Map a compiled graph shared by another process with share.
+        :param spec: The spec returned by share
+        :return: A tuple (handles, CompiledGraph).  Keep the handles alive while using the graph.
+        """
+        specs, labels, directed = spec
+        handles, arrays = attach_arrays(specs)
+        weights = arrays[2] if len(arrays) > 2 else None
+        return handles, cls(arrays[0], arrays[1], weights, labels=labels, directed=directed)
@@ -0,0 +1,196 @@
+# Random graph generators that build edge arrays directly, without networkx
+
+import numpy as np
+from compiled_graph import CompiledGraph
+
+
+def distinct(keys):
+    """
+    Sort an integer array and drop repeats.  Same as np.unique, which is
+    much slower on very large int64 arrays in recent numpy versions.
+    :param keys: A numpy integer array
+    :return: The sorted distinct values
+    """
+    keys = np.sort(keys)
+    if len(keys) == 0:
+        return keys
+    keep = np.empty(len(keys), dtype=bool)
+    keep[0] = True
+    np.not_equal(keys[1:], keys[:-1], out=keep[1:])
+    return keys[keep]
+
+def contains(sorted_keys, keys):
+    """
+    Check which keys are in a sorted array
+    :param sorted_keys: A sorted numpy array
+    :param keys: A numpy array of keys to look up
+    :return: A boolean array
+    """
+    if len(sorted_keys) == 0:
+        return np.zeros(len(keys), dtype=bool)
+    pos = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    return sorted_keys[pos] == keys
+
+def finish(sources, targets, n, directed, as_networkx):
+    """
+    Compile generated edges, dropping self loops and repeated edges
+    :param sources: Array of edge sources
+    :param targets: Array of edge targets
+    :param n: Number of nodes
+    :param directed: If False, (u, v) and (v, u) are the same edge
+    :param as_networkx: If True, export the result to networkx
+    :return: A CompiledGraph, or a networkx Graph or DiGraph
+    """
+    sources = np.asarray(sources, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    keep = sources != targets
+    sources, targets = sources[keep], targets[keep]
+    if not directed:
+        sources, targets = np.minimum(sources, targets), np.maximum(sources, targets)
+    keys = distinct(sources * n + targets)
+    g = CompiledGraph.from_edges(keys // n, keys % n, n, directed=directed)
+    return g.to_networkx() if as_networkx else g
+
+def rewire(sources, targets, n, p, rng):
+    """
+    Rewire edges the way networkx's Watts-Strogatz and relaxed caveman
+    generators do: with probability p, an edge (u, v) becomes (u, w) for a
+    uniformly random node w.  Rewirings that would make a self loop or
+    repeat an existing edge are redrawn a few times, then left as they were.
+    :param sources: Array of edge sources, left as is
+    :param targets: Array of edge targets
+    :param n: Number of nodes
+    :param p: Rewiring probability
+    :param rng: A numpy Generator
+    :return: The new array of edge targets
+    """
+    targets = targets.copy()
+    pending = np.flatnonzero(rng.random(len(targets)) < p)
+    existing = distinct(np.concatenate([sources * n + targets, targets * n + sources]))
+    added = np.empty(0, dtype=np.int64)
+    for attempt in range(8):
+        if len(pending) == 0:
+            break
+        u = sources[pending]
+        new = rng.integers(0, n, len(pending))
+        keys = u * n + new
+        ok = (new != u) & ~contains(existing, keys) & ~contains(added, keys)
+
+        # Two rewirings in this round may also pick the same new edge
+        pair = np.minimum(u, new) * n + np.maximum(u, new)
+        order = np.argsort(pair, kind='stable')
+        repeat = np.zeros(len(pair), dtype=bool)
+        repeat[order[1:]] = pair[order[1:]] == pair[order[:-1]]
+        ok &= ~repeat
+
+        targets[pending[ok]] = new[ok]
+        added = distinct(np.concatenate([added, keys[ok], new[ok] * n + u[ok]]))
+        pending = pending[~ok]
+    return targets
+
+def erdos_renyi_graph(n, p, seed=None, directed=False, as_networkx=False):
+    """
+    Create a G(n, p) random graph.  The number of edges is drawn from its
+    binomial distribution, then that many distinct node pairs are drawn,
+    so the cost is O(edges) rather than O(n^2).
+    :param n: Number of nodes
+    :param p: Probability of each edge
+    :param seed: Seed for the random number generator
+    :param directed: If True, (u, v) and (v, u) are separate possible edges
+    :param as_networkx: If True, return a networkx graph instead of a CompiledGraph
+    :return: A CompiledGraph, or a networkx graph
+    """
+    rng = np.random.default_rng(seed)
+    pairs = n * (n - 1) if directed else n * (n - 1) // 2
+    m = rng.binomial(pairs, p) if pairs > 0 else 0
+
+    # Draw distinct pair indices, topping up after removing repeats
+    keys = np.empty(0, dtype=np.int64)
+    while len(keys) < m:
+        keys = distinct(np.concatenate([keys, rng.integers(0, pairs, int((m - len(keys)) * 1.1) + 1)]))
+    keys = rng.permutation(keys)[:m]
+
+    if directed:
+        sources, targets = keys // (n - 1), keys % (n - 1)
+        targets += targets >= sources
+    else:
+        # Pair k is (u, v) with u < v, counting pairs by v first
+        targets = np.floor((1 + np.sqrt(1 + 8. * keys)) / 2).astype(np.int64)
+        targets -= targets * (targets - 1) // 2 > keys
+        targets += (targets + 1) * targets // 2 <= keys
+        sources = keys - targets * (targets - 1) // 2
+    return finish(sources, targets, n, directed, as_networkx)
+
+def scale_free_graph(n, m=3, exponent=2.5, seed=None, directed=False, as_networkx=False):
+    """
+    Create a scale-free graph with the static model of Goh, Kahng and Kim:
+    node i gets weight (i + 1)^(-1 / (exponent - 1)), and about m * n edges
+    join endpoints drawn in proportion to their weights, so degrees follow
+    a power law with the given exponent.  Self loops and repeated edges are
+    dropped, so large hubs end up with slightly fewer edges than drawn.
+    :param n: Number of nodes
+    :param m: Number of edges per node
+    :param exponent: Exponent of the degree distribution, greater than 2
+    :param seed: Seed for the random number generator
+    :param directed: If True, keep each edge in the direction it was drawn
+    :param as_networkx: If True, return a networkx graph instead of a CompiledGraph
+    :return: A CompiledGraph, or a networkx graph
+    """
+    rng = np.random.default_rng(seed)
+    weights = np.arange(1, n + 1, dtype=np.float64) ** (-1. / (exponent - 1))
+    cumulative = np.cumsum(weights)
+    cumulative /= cumulative[-1]
+    ends = np.searchsorted(cumulative, rng.random(2 * m * n), side='right')
+    ends = np.minimum(ends, n - 1)
+
+    # Shuffle labels so that hubs are not always the lowest ids
+    labels = rng.permutation(n)
+    return finish(labels[ends[:m * n]], labels[ends[m * n:]], n, directed, as_networkx)
+
+def undirected_scale_free_graph(n, seed=None):
+    """
+    Create an undirected scale free networkx graph.
+    :param n: Number of nodes
+    :param seed: Seed for the random number generator
+    :return: A networkx graph
+    """
+    return scale_free_graph(n, seed=seed, as_networkx=True)
+
+def watts_strogatz_graph(n, k, p, seed=None, directed=False, as_networkx=False):
+    """
+    Create a Watts-Strogatz small world graph: a ring where every node is
+    joined to its k nearest neighbors, with each edge rewired with probability p.
+    :param n: Number of nodes
+    :param k: Number of neighbors in the ring (rounded down to even)
+    :param p: Rewiring probability
+    :param seed: Seed for the random number generator
+    :param directed: If True, keep each edge once, from its first node
+    :param as_networkx: If True, return a networkx graph instead of a CompiledGraph
+    :return: A CompiledGraph, or a networkx graph
+    """
+    rng = np.random.default_rng(seed)
+    nodes = np.arange(n, dtype=np.int64)
+    sources = np.tile(nodes, k // 2)
+    targets = (sources + np.repeat(np.arange(1, k // 2 + 1), n)) % n
+    targets = rewire(sources, targets, n, p, rng)
+    return finish(sources, targets, n, directed, as_networkx)
+
+def relaxed_caveman_graph(l, k, p, seed=None, directed=False, as_networkx=False):
+    """
+    Create a relaxed caveman graph: l cliques of k nodes, with each edge
+    rewired to a random node with probability p.
+    :param l: Number of cliques
+    :param k: Number of nodes per clique
+    :param p: Rewiring probability
+    :param seed: Seed for the random number generator
+    :param directed: If True, keep each edge once, from its first node
+    :param as_networkx: If True, return a networkx graph instead of a CompiledGraph
+    :return: A CompiledGraph, or a networkx graph
+    """
+    rng = np.random.default_rng(seed)
+    u, v = np.triu_indices(k, 1)
+    offsets = np.repeat(np.arange(l, dtype=np.int64) * k, len(u))
+    sources = np.tile(u, l) + offsets
+    targets = np.tile(v, l) + offsets
+    targets = rewire(sources, targets, l * k, p, rng)
+    return finish(sources, targets, l * k, directed, as_networkx)
@@ -0,0 +1,483 @@
+# A binary on-disk graph format that loads by memory-mapping
+
+import numpy as np
+import json
+import os
+from itertools import islice
+from compiled_graph import CompiledGraph
+
+# Files start with MAGIC, then a JSON header padded to HEADER_SIZE bytes.
+# Sections follow, each starting on a multiple of ALIGN bytes.
+MAGIC = b'CSRGRAPH'
+HEADER_SIZE = 4096
+ALIGN = 64
+
+
+def write_graph(path, g):
+    """
+    Save a compiled graph in the binary format read by load_graph
+    :param path: The file to write
+    :param g: A CompiledGraph, or a networkx graph
+    :return: None
+    """
+    if not isinstance(g, CompiledGraph):
+        g = CompiledGraph.from_networkx(g)
+    sections = {'indptr': g.out_indptr.astype(np.int64), 'indices': g.out_indices.astype(np.int32)}
+    if g.out_weights is not None:
+        sections['weights'] = g.out_weights.astype(np.float32)
+    if g.directed:
+        sections['in_indptr'] = g.in_indptr.astype(np.int64)
+        sections['in_indices'] = g.in_indices.astype(np.int32)
+        if g.in_weights is not None:
+            sections['in_weights'] = g.in_weights.astype(np.float32)
+
+    label_kind = None
+    if not g.identity:
+        labels = g.labels
+        if isinstance(labels, np.ndarray) or all(isinstance(label, (int, np.integer)) for label in labels):
+            label_kind = 'int'
+            sections['labels'] = np.asarray(labels, dtype=np.int64)
+        else:
+            label_kind = 'str'
+            sections['label_data'], sections['label_offsets'] = encode_labels(labels)
+
+    with GraphWriter(path, g.num_nodes, g.directed, label_kind) as writer:
+        for name, arr in sections.items():
+            writer.add(name, arr)
+
+def encode_labels(labels):
+    """
+    Pack string labels into one UTF-8 buffer
+    :param labels: A list of labels, converted with str
+    :return: A tuple (data, offsets) of numpy arrays; label i is data[offsets[i]:offsets[i + 1]]
+    """
+    encoded = [str(label).encode('utf-8') for label in labels]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+def decode_labels(data, offsets):
+    """
+    Unpack labels packed by encode_labels
+    :param data: The UTF-8 buffer
+    :param offsets: The label offsets
+    :return: A list of strings
+    """
+    text = bytes(data)
+    offsets = offsets.tolist()
+    return [text[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+
+class GraphWriter:
+    """
+    Writes the sections of a graph file one after another, then the header.
+    """
+
+    def __init__(self, path, num_nodes, directed, label_kind=None):
+        """
+        Start a graph file
+        :param path: The file to write
+        :param num_nodes: Number of nodes
+        :param directed: Whether the graph is directed
+        :param label_kind: None if the ids are the labels, 'int' or 'str'
+        """
+        self.file = open(path, 'wb')
+        self.file.write(bytes(HEADER_SIZE))
+        self.header = {'num_nodes': int(num_nodes), 'directed': bool(directed),
+                       'labels': label_kind, 'sections': {}}
+
+    def add(self, name, arr, chunk=1 << 24):
+        """
+        Append a section
+        :param name: The section name
+        :param arr: A numpy array, or a memmap that is copied a chunk at a time
+        :param chunk: Number of entries copied at once
+        :return: None
+        """
+        pad = -self.file.tell() % ALIGN
+        self.file.write(bytes(pad))
+        self.header['sections'][name] = {'offset': self.file.tell(), 'dtype': arr.dtype.str,
+                                         'length': int(len(arr))}
+        for start in range(0, len(arr), chunk):
+            np.ascontiguousarray(arr[start:start + chunk]).tofile(self.file)
+
+    def close(self):
+        """
+        Write the header and close the file
+        :return: None
+        """
+        header = json.dumps(self.header).encode('utf-8')
+        if len(MAGIC) + len(header) > HEADER_SIZE:
+            raise ValueError('Graph file header is too large')
+        self.file.seek(0)
+        self.file.write(MAGIC + header)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def read_header(path):
+    """
+    Read the header of a graph file
+    :param path: The graph file
+    :return: The header dictionary
+    """
+    with open(path, 'rb') as f:
+        head = f.read(HEADER_SIZE)
+    if not head.startswith(MAGIC):
+        raise ValueError(f'{path} is not a graph file')
+    return json.loads(head[len(MAGIC):].rstrip(b'\0').decode('utf-8'))
+
+def load_graph(path):
+    """
+    Load a graph file without copying it: every array is a read-only memory
+    map of the file, so startup does not depend on the number of edges and
+    processes that load the same file share its pages.
+    :param path: The graph file
+    :return: A CompiledGraph
+    """
+    header = read_header(path)
+    arrays = {}
+    for name, section in header['sections'].items():
+        if section['length'] == 0:
+            arrays[name] = np.empty(0, dtype=np.dtype(section['dtype']))
+        else:
+            arrays[name] = np.memmap(path, dtype=np.dtype(section['dtype']), mode='r',
+                                     offset=section['offset'], shape=(section['length'],))
+
+    labels = None
+    if header['labels'] == 'int':
+        labels = arrays['labels']
+    elif header['labels'] == 'str':
+        labels = decode_labels(arrays['label_data'], arrays['label_offsets'])
+
+    in_arrays = None
+    if header['directed']:
+        in_arrays = (arrays['in_indptr'], arrays['in_indices'], arrays.get('in_weights'))
+    return CompiledGraph(arrays['indptr'], arrays['indices'], arrays.get('weights'), labels=labels,
+                         directed=header['directed'], in_arrays=in_arrays)
+
+def read_edge_chunks(path, comments='#%', delimiter=None, chunk_lines=1 << 20):
+    """
+    Read an edge list text file a chunk of lines at a time
+    :param path: The text file, one 'source target [weight]' edge per line
+    :param comments: Lines starting with any of these characters are skipped
+    :param delimiter: Field separator, or None for any whitespace
+    :param chunk_lines: Number of lines per chunk
+    :return: A generator of (sources, targets, weights) lists of strings; weights is None
+             if the file has two columns
+    """
+    comments = tuple(comments)
+    with open(path) as f:
+        while True:
+            lines = list(islice(f, chunk_lines))
+            if not lines:
+                break
+            lines = [line for line in lines if line.strip() and not line.startswith(comments)]
+            if not lines:
+                continue
+
+            # Splitting the whole chunk at once is much faster than line by line
+            columns = len(lines[0].split(delimiter))
+            if delimiter is None:
+                tokens = ''.join(lines).split()
+            else:
+                tokens = delimiter.join(line.rstrip('\r\n') for line in lines).split(delimiter)
+            if len(tokens) != columns * len(lines):
+                raise ValueError(f'Lines of {path} have different numbers of columns')
+            yield tokens[0::columns], tokens[1::columns], tokens[2::columns] if columns > 2 else None
+
+class ScratchArray:
+    """
+    An array that grows by appending to a temporary file.
+    """
+
+    def __init__(self, path, dtype):
+        """
+        Start an empty scratch array
+        :param path: The temporary file
+        :param dtype: numpy type of the entries
+        """
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.length = 0
+        self.file = open(path, 'wb')
+
+    def append(self, arr):
+        """
+        Append entries
+        :param arr: A numpy array
+        :return: None
+        """
+        np.ascontiguousarray(arr, dtype=self.dtype).tofile(self.file)
+        self.length += len(arr)
+
+    def open(self, mode='r'):
+        """
+        Map the written entries
+        :param mode: 'r' to read, 'r+' to also write
+        :return: A numpy memmap, or an empty array
+        """
+        self.file.flush()
+        if self.length == 0:
+            return np.empty(0, dtype=self.dtype)
+        return np.memmap(self.path, dtype=self.dtype, mode=mode, shape=(self.length,))
+
+    @classmethod
+    def filled(cls, path, dtype, length):
+        """
+        Make a scratch array of a given length, to be written through open('r+')
+        :param path: The temporary file
+        :param dtype: numpy type of the entries
+        :param length: Number of entries
+        :return: A ScratchArray
+        """
+        scratch = cls(path, dtype)
+        scratch.file.truncate(length * scratch.dtype.itemsize)
+        scratch.length = length
+        return scratch
+
+    def remove(self):
+        """
+        Delete the temporary file
+        :return: None
+        """
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def fill_rows(sources, targets, weights, counts, path, chunk, scratch):
+    """
+    Counting sort of an edge list into CSR arrays kept in temporary files
+    :param sources: Array (or memmap) of edge sources
+    :param targets: Array of edge targets
+    :param weights: Array of edge weights, or None
+    :param counts: Number of edges of each source
+    :param path: Prefix of the temporary files
+    :param chunk: Number of edges handled at once
+    :param scratch: A list the new ScratchArrays are added to, for cleanup
+    :return: A tuple (indptr, indices, weights) with indices and weights as ScratchArrays
+    """
+    n = len(counts)
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    m = int(indptr[-1])
+    indices = ScratchArray.filled(path + '.indices', np.int32, m)
+    scratch.append(indices)
+    values = None
+    if weights is not None:
+        values = ScratchArray.filled(path + '.weights', np.float32, m)
+        scratch.append(values)
+    out, out_w = indices.open('r+'), values.open('r+') if values is not None else None
+
+    cursor = indptr[:-1].copy()
+    for start in range(0, len(sources), chunk):
+        src = np.asarray(sources[start:start + chunk])
+        order = np.argsort(src, kind='stable')
+        src = src[order]
+
+        # Rank of each edge among the edges of its source in this chunk
+        first = np.flatnonzero(np.r_[True, src[1:] != src[:-1]])
+        rank = np.arange(len(src)) - np.repeat(first, np.diff(np.r_[first, len(src)]))
+        pos = cursor[src] + rank
+        out[pos] = np.asarray(targets[start:start + chunk])[order]
+        if out_w is not None:
+            out_w[pos] = np.asarray(weights[start:start + chunk])[order]
+        cursor += np.bincount(src, minlength=n)
+    if m:
+        out.flush()
+        if out_w is not None:
+            out_w.flush()
+    return indptr, indices, values
+
+def sort_rows(indptr, indices, weights, chunk):
+    """
+    Sort the neighbors within every CSR row and drop repeated edges, a
+    block of rows at a time, in place.  The first weight of a repeated
+    edge is kept.
+    :param indptr: CSR row pointer array, rewritten for the remaining edges
+    :param indices: ScratchArray of neighbors
+    :param weights: ScratchArray of weights, or None
+    :param chunk: Number of edges handled at once
+    :return: The number of remaining edges
+    """
+    n = len(indptr) - 1
+    idx = indices.open('r+')
+    w = weights.open('r+') if weights is not None else None
+    write = 0
+    row = 0
+    new_counts = np.zeros(n, dtype=np.int64)
+    while row < n:
+        # Take whole rows adding up to about chunk edges
+        end = max(row + 1, int(np.searchsorted(indptr, indptr[row] + chunk, side='right')) - 1)
+        end = min(end, n)
+        lo, hi = int(indptr[row]), int(indptr[end])
+        rows = np.repeat(np.arange(row, end), np.diff(indptr[row:end + 1]))
+        keys = (rows - row) * n + np.asarray(idx[lo:hi])
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        block, rows = (keys % n).astype(np.int32), keys // n + row
+        keep = np.ones(len(keys), dtype=bool)
+        np.not_equal(keys[1:], keys[:-1], out=keep[1:])
+        kept = int(keep.sum())
+        idx[write:write + kept] = block[keep]
+        if w is not None:
+            w[write:write + kept] = np.asarray(w[lo:hi])[order][keep]
+        new_counts[row:end] = np.bincount(rows[keep] - row, minlength=end - row)
+        write += kept
+        row = end
+    indptr[1:] = np.cumsum(new_counts)
+    return write
+
+def intern_int_labels(known, known_ids, tokens):
+    """
+    Give ids to integer labels.  Labels not seen before get the next free
+    ids, in increasing order of label within the chunk.
+    :param known: A sorted numpy array of the labels seen so far
+    :param known_ids: The ids of the labels in known
+    :param tokens: A list of label strings
+    :return: A tuple (known, known_ids, ids) with the updated arrays and the ids of the tokens
+    :raises ValueError: If a token is not an integer
+    """
+    values = np.fromiter(map(int, tokens), dtype=np.int64, count=len(tokens))
+    low = int(values.min()) if len(values) else 0
+    span = int(values.max()) - low + 1 if len(values) else 0
+    if span <= 2 * len(values):
+        # Dense labels: a bitmap over their range avoids sorting the chunk
+        present = np.zeros(span, dtype=bool)
+        present[values - low] = True
+        distinct_values = np.flatnonzero(present) + low
+        inverse = (np.cumsum(present) - 1)[values - low]
+    else:
+        distinct_values, inverse = np.unique(values, return_inverse=True)
+    pos = np.searchsorted(known, distinct_values)
+    found = pos < len(known)
+    found[found] = known[pos[found]] == distinct_values[found]
+    ids = np.empty(len(distinct_values), dtype=np.int64)
+    ids[found] = known_ids[pos[found]]
+    new_ids = np.arange(len(known), len(known) + np.count_nonzero(~found))
+    ids[~found] = new_ids
+    known = np.insert(known, pos[~found], distinct_values[~found])
+    known_ids = np.insert(known_ids, pos[~found], new_ids)
+    return known, known_ids, ids[inverse]
+
+def convert_edge_list(src_path, path, directed=True, comments='#%', delimiter=None,
+                      int_labels=None, chunk=1 << 22):
+    """
+    Convert an edge list text file into a graph file in one pass over the
+    text.  Edges are streamed to temporary files as ids, then counting
+    sorted into CSR rows, so memory holds a chunk of edges and per-node
+    arrays, never the whole edge list.  Repeated edges are merged.
+    :param src_path: The text file, one 'source target [weight]' edge per line
+    :param path: The graph file to write
+    :param directed: If False, every edge is stored in both directions
+    :param comments: Lines starting with any of these characters are skipped
+    :param delimiter: Field separator, or None for any whitespace
+    :param int_labels: If True, labels must be integers, and ids follow their
+                       order.  If False, labels are strings.  If None, labels
+                       are read as integers until one is not, then every
+                       label is kept as a string (integers in their decimal form).
+    :param chunk: Number of lines or edges handled at once
+    :return: The loaded CompiledGraph
+    """
+    tmp = path + '.tmp'
+    scratch = []
+    try:
+        sources = ScratchArray(tmp + '.src', np.int64)
+        scratch.append(sources)
+        targets = ScratchArray(tmp + '.dst', np.int64)
+        scratch.append(targets)
+        weights = None
+        strict = int_labels is True
+        int_labels = int_labels is not False
+        known, known_ids = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        index = {}
+
+        for src, dst, w in read_edge_chunks(src_path, comments, delimiter, chunk):
+            if int_labels:
+                try:
+                    known, known_ids, ids = intern_int_labels(known, known_ids, src + dst)
+                except ValueError:
+                    if strict:
+                        raise
+                    # A label that is not an integer: keep every label as a string
+                    int_labels = False
+                    by_id = np.empty(len(known), dtype=np.int64)
+                    by_id[known_ids] = known
+                    index = {str(label): i for i, label in enumerate(by_id.tolist())}
+            if not int_labels:
+                ids = np.array([index.setdefault(label, len(index)) for label in src + dst], dtype=np.int64)
+            sources.append(ids[:len(src)])
+            targets.append(ids[len(src):])
+            if w is not None:
+                if weights is None:
+                    # Edges read before the first weighted line get weight 1
+                    weights = ScratchArray(tmp + '.w', np.float32)
+                    scratch.append(weights)
+                    weights.append(np.ones(sources.length - len(src), dtype=np.float32))
+                weights.append(np.fromiter(map(float, w), dtype=np.float32, count=len(w)))
+            elif weights is not None:
+                weights.append(np.ones(len(src), dtype=np.float32))
+
+        labels = known if int_labels else list(index)
+        n = len(labels)
+        del index
+
+        # Give ids to integer labels in increasing order
+        src, dst = sources.open(), targets.open()
+        w = weights.open() if weights is not None else None
+        if int_labels:
+            remap = np.empty(n, dtype=np.int64)
+            remap[known_ids] = np.arange(n)
+            for array in (sources, targets):
+                view = array.open('r+')
+                for start in range(0, len(view), chunk):
+                    view[start:start + chunk] = remap[view[start:start + chunk]]
+                if len(view):
+                    view.flush()
+            del remap
+            src, dst = sources.open(), targets.open()
+
+        # Undirected edges go both ways; self loops are stored once
+        if not directed:
+            for start in range(0, len(src), chunk):
+                s, d = np.asarray(src[start:start + chunk]), np.asarray(dst[start:start + chunk])
+                keep = s != d
+                sources.append(d[keep])
+                targets.append(s[keep])
+                if weights is not None:
+                    weights.append(np.asarray(w[start:start + chunk])[keep])
+            src, dst = sources.open(), targets.open()
+            w = weights.open() if weights is not None else None
+
+        def counts_of(arr):
+            counts = np.zeros(n, dtype=np.int64)
+            for start in range(0, len(arr), chunk):
+                counts += np.bincount(np.asarray(arr[start:start + chunk]), minlength=n)
+            return counts
+
+        graph = {}
+        parts = [('', src, dst)] + ([('in_', dst, src)] if directed else [])
+        for prefix, a, b in parts:
+            indptr, idx, vals = fill_rows(a, b, w, counts_of(a), tmp + '.' + prefix, chunk, scratch)
+            m = sort_rows(indptr, idx, vals, chunk)
+            graph[prefix] = (indptr, idx, vals, m)
+
+        with GraphWriter(path, n, directed, 'int' if int_labels else 'str') as writer:
+            for prefix, (indptr, idx, vals, m) in graph.items():
+                writer.add(prefix + 'indptr', indptr)
+                writer.add(prefix + 'indices', idx.open()[:m])
+                if vals is not None:
+                    writer.add(prefix + 'weights', vals.open()[:m])
+            if int_labels:
+                writer.add('labels', labels)
+            else:
+                data, offsets = encode_labels(labels)
+                writer.add('label_data', data)
+                writer.add('label_offsets', offsets)
+    finally:
+        for array in scratch:
+            array.remove()
+    return load_graph(path)
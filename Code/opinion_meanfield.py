@@ -0,0 +1,300 @@
+# Mean-field approximations of the binary opinion models in asgn8
+
+import numpy as np
+from math import comb, log
+from compiled_graph import CompiledGraph
+
+
+def get_degree_distribution(g):
+    """
+    Get the degree distribution of a graph.  Directed graphs use out-degrees,
+    since an updating node looks at its out-neighbors.
+    :param g: a networkx graph, a CompiledGraph, or a sequence of node degrees
+    :return: a tuple (degrees, probs) of numpy arrays
+    """
+    if isinstance(g, CompiledGraph):
+        seq = g.out_degree
+    elif hasattr(g, 'degree'):
+        seq = [d for (node, d) in (g.out_degree() if g.is_directed() else g.degree())]
+    else:
+        seq = g
+    degrees, counts = np.unique(np.asarray(seq, dtype=np.int64), return_counts=True)
+    return degrees, counts / counts.sum()
+
+def flip_probability(method, q, f):
+    """
+    Get the probability that an updated node changes its opinion, as in
+    asgn8.flip_rate, but for a fraction f of disagreeing neighbors
+    :param method: 'voter', 'qvoter' or 'majority'
+    :param q: number of neighbors drawn per update
+    :param f: a number or numpy array of disagreeing fractions
+    :return: the flip probabilities
+    """
+    f = np.asarray(f, dtype=np.float64)
+    if method == 'voter':
+        return f
+    if method == 'qvoter':
+        return f ** q
+    if method == 'majority':
+        return sum(comb(q, j) * f ** j * (1 - f) ** (q - j) for j in range(q // 2 + 1, q + 1))
+    raise ValueError(f'No mean-field equations for the {method} model')
+
+def rk4(f, y, tau, dt):
+    """
+    Integrate dy/dtau = f(y) with the classic fourth order Runge-Kutta method
+    :param f: function from a numpy array to its time derivative
+    :param y: the state at the start
+    :param tau: length of time to integrate over
+    :param dt: time step
+    :return: the state at the end
+    """
+    steps = max(1, int(np.ceil(tau / dt)))
+    h = tau / steps
+    for i in range(steps):
+        k1 = f(y)
+        k2 = f(y + h / 2 * k1)
+        k3 = f(y + h / 2 * k2)
+        k4 = f(y + h * k3)
+        y = y + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+    return y
+
+class MeanFieldModel:
+    """
+    Heterogeneous mean-field (HMF) and homogeneous pair approximation (PA)
+    equations for the 'voter', 'qvoter' and 'majority' models.
+
+    HMF follows the fraction rho_k of agents with opinion 1 in each degree
+    class k.  Neighbors are drawn in proportion to their degree, so an
+    updated agent sees opinion 1 with probability omega = sum k P(k) rho_k / <k>.
+
+    PA treats the graph as k-regular with k the mean degree, and follows
+    the fraction rho of agents with opinion 1 and the fraction b of
+    discordant (active) edges.  The number of active edges of an agent is
+    binomial, which captures the correlations between neighbors that HMF
+    misses.
+
+    Time is counted in single-node updates, as in DiffusionModel.run_async:
+    n updates make one sweep.
+    """
+
+    def __init__(self, g, method='voter', q=None, approximation='hmf', n=None):
+        """
+        Constructor for a mean-field model
+        :param g: a networkx graph, a CompiledGraph, or a sequence of node degrees
+        :param method: 'voter', 'qvoter' or 'majority'
+        :param q: group size for 'qvoter' and 'majority' (3 and 5 if None, as in DiffusionModel)
+        :param approximation: 'hmf' or 'pair'
+        :param n: number of agents.  Taken from g if None.
+        """
+        if method not in ['voter', 'qvoter', 'majority']:
+            raise ValueError(f'No mean-field equations for the {method} model')
+        if approximation not in ['hmf', 'pair']:
+            raise ValueError(f'Unknown approximation {approximation}')
+        if q is None:
+            q = 5 if method == 'majority' else 3
+        self.method = method
+        self.q = 1 if method == 'voter' else q
+        self.approximation = approximation
+        self.degrees, self.probs = get_degree_distribution(g)
+        if n is None:
+            n = g.number_of_nodes() if hasattr(g, 'number_of_nodes') else len(g)
+        self.n = n
+        self.mean_degree = float(np.dot(self.degrees, self.probs))
+
+        # Neighbors are drawn in proportion to their degree
+        self.weights = self.degrees * self.probs / self.mean_degree
+
+        # Binomial tables of the pair approximation, for the mean degree
+        k = max(1, int(round(self.mean_degree)))
+        self.k = k
+        self.active = np.arange(k + 1)
+        self.binomials = np.array([comb(k, i) for i in range(k + 1)], dtype=np.float64)
+        self.flips = flip_probability(self.method, self.q, self.active / k)
+
+    def derivative_hmf(self, rho):
+        """
+        Time derivative, per sweep, of the HMF state
+        :param rho: numpy array of the fraction of agents with opinion 1 in each degree class
+        :return: the derivative of rho
+        """
+        omega = np.dot(self.weights, rho)
+        up = flip_probability(self.method, self.q, omega)
+        down = flip_probability(self.method, self.q, 1 - omega)
+        return (1 - rho) * up - rho * down
+
+    def derivative_pair(self, state):
+        """
+        Time derivative, per sweep, of the pair approximation state
+        :param state: numpy array [rho, b]
+        :return: the derivative of the state
+        """
+        rho, b = np.clip(state, 1e-12, 1 - 1e-12)
+        k, i = self.k, self.active
+
+        # Chance that an edge of an agent with opinion 1 (row 0) or 0 (row 1) is active
+        share = np.array([rho, 1 - rho])
+        theta = np.minimum(b / (2 * share), 1.)[:, None]
+        p = self.binomials * theta ** i * (1 - theta) ** (k - i) * self.flips
+        flips = share * p.sum(axis=1)
+        return np.array([flips[1] - flips[0], 2 * np.dot(share, p @ (k - 2 * i)) / k])
+
+    def get_initial_state(self, rho0):
+        """
+        Get the starting state for a given fraction of agents with opinion 1,
+        placed at random
+        :param rho0: fraction of agents with opinion 1
+        :return: the state as a numpy array
+        """
+        if self.approximation == 'hmf':
+            return np.full(len(self.degrees), rho0, dtype=np.float64)
+        return np.array([rho0, 2 * rho0 * (1 - rho0)])
+
+    def get_observables(self, state):
+        """
+        Get the observables of a state
+        :param state: a state from get_initial_state or the derivative functions
+        :return: a tuple (ones, discordant): the expected number of agents with
+                 opinion 1 and fraction of discordant edges
+        """
+        if self.approximation == 'hmf':
+            rho = np.dot(self.probs, state)
+            omega = np.dot(self.weights, state)
+            return self.n * rho, 2 * omega * (1 - omega)
+        return self.n * state[0], state[1]
+
+    def solve(self, rho0=.5, steps=None, record_every=1000, dt=.2):
+        """
+        Integrate the equations, recording the same observables as
+        DiffusionModel.run_test_discrete
+        :param rho0: initial fraction of agents with opinion 1
+        :param steps: number of single-node updates to cover.  100 sweeps if None.
+        :param record_every: record the observables every this many updates
+        :param dt: integration time step, in sweeps
+        :return: a tuple (x, y, discordant) of numpy arrays: update counts, a
+                 2 x len(x) array of the expected number of agents with
+                 opinion 0 and 1, and the expected fraction of discordant edges
+        """
+        if steps is None:
+            steps = 100 * self.n
+        derivative = self.derivative_hmf if self.approximation == 'hmf' else self.derivative_pair
+        state = self.get_initial_state(rho0)
+        x = list(range(0, steps, record_every)) + [steps]
+        ones, discordant = [], []
+        for i in range(len(x)):
+            if i > 0:
+                state = rk4(derivative, state, (x[i] - x[i - 1]) / self.n, dt)
+            count, active = self.get_observables(state)
+            ones.append(count)
+            discordant.append(active)
+        ones = np.array(ones)
+        return np.array(x), np.array([self.n - ones, ones]), np.array(discordant)
+
+    def exit_probability(self, rho0):
+        """
+        Get the probability that a run ends with everyone holding opinion 1.
+        For the voter model on an uncorrelated graph the degree-weighted
+        fraction omega is conserved, so it is the exit probability.  The
+        nonlinear models flow deterministically towards the majority side.
+        :param rho0: initial fraction of agents with opinion 1, placed at random
+        :return: the exit probability
+        """
+        if self.method == 'voter':
+            return rho0
+        if rho0 == .5:
+            return .5
+        return float(rho0 > .5)
+
+    def consensus_time(self, rho0=.5, dt=.2, max_sweeps=10 ** 4):
+        """
+        Get the expected number of updates until consensus.  For the voter
+        model this is the Sood-Redner formula -N_eff [w ln w + (1 - w) ln(1 - w)]
+        sweeps with N_eff = N <k>^2 / <k^2>.  For the nonlinear models it is
+        the time for the mean-field flow to come within one agent of
+        consensus; it is infinite from rho0 = 0.5, where only fluctuations
+        break the symmetry.
+        :param rho0: initial fraction of agents with opinion 1
+        :param dt: integration time step, in sweeps
+        :param max_sweeps: give up after this many sweeps
+        :return: the number of single-node updates, or None if consensus is not reached
+        """
+        if rho0 <= 0 or rho0 >= 1:
+            return 0
+        if self.method == 'voter':
+            n_eff = self.n * self.mean_degree ** 2 / np.dot(self.degrees ** 2, self.probs)
+            entropy = rho0 * log(rho0) + (1 - rho0) * log(1 - rho0)
+            return -n_eff * entropy * self.n
+
+        derivative = self.derivative_hmf if self.approximation == 'hmf' else self.derivative_pair
+        state = self.get_initial_state(rho0)
+        for sweep in range(max_sweeps):
+            count = self.get_observables(state)[0]
+            if min(count, self.n - count) < .5:
+                return sweep * self.n
+            state = rk4(derivative, state, 1., dt)
+        return None
+
+
+def validate(g, method='voter', q=None, approximation='hmf', rho0=.5, runs=20, steps=None,
+             record_every=1000, seed=0, plot=False):
+    """
+    Compare a mean-field model with the average of simulated runs
+    :param g: a networkx graph or a CompiledGraph
+    :param method: 'voter', 'qvoter' or 'majority'
+    :param q: group size for 'qvoter' and 'majority'
+    :param approximation: 'hmf' or 'pair'
+    :param rho0: initial fraction of agents with opinion 1
+    :param runs: number of simulated runs
+    :param steps: number of single-node updates.  100 sweeps if None.
+    :param record_every: compare the observables every this many updates
+    :param seed: seed of the first run; run i uses seed + i
+    :param plot: if True, plot the solution over the simulated averages
+    :return: a dictionary with the largest absolute differences of the
+             fraction of agents with opinion 1 ('ones') and of discordant
+             edges ('discordant') between the solver and the simulations
+    """
+    from asgn8 import DiffusionModel
+
+    model = MeanFieldModel(g, method, q, approximation)
+    n = model.n
+    x, y, discordant = model.solve(rho0, steps, record_every)
+
+    # Average the simulated observables at the same update counts
+    ones = np.zeros(len(x))
+    active = np.zeros(len(x))
+    for run in range(runs):
+        d = DiffusionModel(g, method=method, q=q, seed=seed + run)
+        opinions = (d.rng.random(n) < rho0).astype(int).tolist()
+        d.opinions = opinions
+        d.reset_observables()
+        edges = len(d.indices)
+        for i in range(len(x)):
+            if i > 0:
+                d.run_async(x[i] - x[i - 1], record_every=x[i] - x[i - 1], stop=False)
+            ones[i] += d.ones / runs
+            active[i] += d.discordant / edges / runs
+
+    if plot:
+        import matplotlib.pyplot as plt
+
+        plt.plot(x, y[1] / n, label=f'{approximation} opinion=1')
+        plt.plot(x, ones / n, '--', label='simulated opinion=1')
+        plt.plot(x, discordant, label=f'{approximation} discordant edges')
+        plt.plot(x, active, '--', label='simulated discordant edges')
+        plt.legend()
+        plt.show()
+
+    return {'ones': float(np.max(np.abs(y[1] - ones)) / n),
+            'discordant': float(np.max(np.abs(discordant - active)))}
+
+
+def main():
+    import networkx as nx
+
+    g = nx.random_regular_graph(6, 1000)
+    for method in ['voter', 'qvoter', 'majority']:
+        for approximation in ['hmf', 'pair']:
+            print(method, approximation, validate(g, method, approximation=approximation, rho0=.6))
+
+
+if __name__ == '__main__':
+    main()
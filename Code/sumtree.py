@@ -0,0 +1,95 @@
+import numpy as np
+
+
+class SumTree():
+    """
+    A binary tree over n non-negative weights where every internal node
+    holds the sum of its children.  Changing a weight and drawing an index
+    with probability proportional to its weight both take O(log n), which
+    is what event-driven (Gillespie) simulations need to pick the next event.
+
+    The tree is stored in a flat list: the root is at 1, the children of i
+    are at 2i and 2i + 1, and weight i is the leaf at size + i.
+    """
+
+    def __init__(self, weights):
+        """
+        Constructor for a sum tree
+        :param weights: A sequence of n non-negative weights
+        """
+        weights = np.asarray(weights, dtype=np.float64)
+        self.n = len(weights)
+        self.size = 1
+        while self.size < self.n:
+            self.size *= 2
+
+        # Build the levels bottom up with numpy, then keep a list for fast scalar updates
+        levels = [np.zeros(self.size)]
+        levels[0][:self.n] = weights
+        while len(levels[-1]) > 1:
+            levels.append(levels[-1].reshape(-1, 2).sum(axis=1))
+        tree = [0.]
+        for level in reversed(levels):
+            tree += level.tolist()
+        self.tree = tree
+
+    def total(self):
+        """
+        Get the sum of all weights
+        :return: The total weight
+        """
+        return self.tree[1]
+
+    def get(self, i):
+        """
+        Get a weight
+        :param i: Index of the weight
+        :return: The weight
+        """
+        return self.tree[self.size + i]
+
+    def update(self, i, weight):
+        """
+        Set a weight.  Parents are recomputed from their children rather
+        than adjusted by the difference, so rounding errors do not pile up.
+        :param i: Index of the weight
+        :param weight: The new non-negative weight
+        :return: None
+        """
+        tree = self.tree
+        i += self.size
+        tree[i] = weight
+        i //= 2
+        while i:
+            tree[i] = tree[2 * i] + tree[2 * i + 1]
+            i //= 2
+
+    def find(self, u):
+        """
+        Find the index whose weight interval contains u, so that for u drawn
+        uniformly from [0, total()), index i comes up with probability
+        proportional to its weight.
+        :param u: A number in [0, total())
+        :return: The index of the weight
+        """
+        tree = self.tree
+        size = self.size
+        i = 1
+        while i < size:
+            i *= 2
+            # Never step into an empty subtree, which rounding could otherwise do
+            if u >= tree[i] and tree[i + 1] > 0:
+                u -= tree[i]
+                i += 1
+        return i - size
+
+    def sample(self, u):
+        """
+        Draw an index with probability proportional to its weight
+        :param u: A uniform random number in [0, 1)
+        :return: The index of the weight, or None if all weights are zero
+        """
+        total = self.tree[1]
+        if total <= 0:
+            return None
+        return self.find(u * total)
@@ -0,0 +1,282 @@
+# Parameter sweeps over DiffusionModel
+
+import networkx as nx
+import numpy as np
+import hashlib
+import json
+import random
+import sqlite3
+from itertools import product
+from multiprocessing import Pool
+import generators
+from compiled_graph import CompiledGraph
+from asgn8 import DiffusionModel
+
+# Graph families a sweep can use, as functions of the size and a seed
+FAMILIES = {
+    'watts_strogatz': lambda n, seed: generators.watts_strogatz_graph(n, 10, .1, seed=seed),
+    'scale_free': lambda n, seed: generators.scale_free_graph(n, 5, seed=seed),
+    'barabasi_albert': lambda n, seed: nx.barabasi_albert_graph(n, 5, seed=seed),
+    'erdos_renyi': lambda n, seed: generators.erdos_renyi_graph(n, min(1., 10 / n), seed=seed),
+    'relaxed_caveman': lambda n, seed: generators.relaxed_caveman_graph(max(1, n // 10), 10, .1, seed=seed),
+    'complete': lambda n, seed: nx.complete_graph(n),
+}
+
+# Parameters of a cell that are not given in the grid
+DEFAULTS = {'method': 'voter', 'q': None, 'epsilon': .3, 'mu': .5, 'family': 'watts_strogatz',
+            'n': 100, 'graph_seed': 0, 'seed': 0, 'steps': None, 'tol': 1e-6}
+
+
+def expand_grid(grid):
+    """
+    Expand a parameter grid into the list of its cells
+    :param grid: a dictionary from parameter names to a list of values, or a single value
+    :return: a list of parameter dictionaries, with DEFAULTS filled in
+    """
+    names = list(grid)
+    values = [v if isinstance(v, (list, tuple, range)) else [v] for v in grid.values()]
+    cells = []
+    for combo in product(*values):
+        cell = dict(DEFAULTS)
+        cell.update(zip(names, combo))
+        cells.append(cell)
+    return cells
+
+def get_key(params):
+    """
+    Hash the parameters of a cell
+    :param params: a parameter dictionary
+    :return: a hex digest that identifies the cell
+    """
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+def run_cell(g, params, cache=None):
+    """
+    Run one cell of a sweep until it converges or runs out of steps.
+    :param g: the CompiledGraph to run on
+    :param params: a parameter dictionary
+    :param cache: a dictionary kept per topology, so that the Python adjacency
+                  lists of g are built once and shared by all of its cells
+    :return: a dictionary of results: consensus (fraction of agents in the
+             largest opinion group), converged, time (number of updates run)
+             and clusters (number of opinion groups)
+    """
+    # The initial opinions come from the random module
+    random.seed(params['seed'])
+    d = DiffusionModel(g, method=params['method'], q=params['q'], epsilon=params['epsilon'],
+                       mu=params['mu'], seed=params['seed'])
+    if cache is not None:
+        d.lists = cache.get('lists')
+    n = g.num_nodes
+    steps = params['steps'] or 100 * n
+
+    if d.ones is not None:
+        x, y = d.run_async(steps, record_every=n, stop=True)
+        sizes = [size for size in d.get_counts() if size > 0]
+        converged = d.discordant == 0
+        time = int(x[-1])
+    else:
+        # Check for convergence once per sweep, or once per n pair updates
+        window = 1 if params['method'] == 'hk' else n
+        time = 0
+        converged = False
+        d.is_converged(params['tol'])
+        while time < steps and not converged:
+            if params['method'] == 'dw':
+                d.run_pairs(window)
+            else:
+                d.update()
+            time += window
+            converged = d.is_converged(params['tol'])
+        sizes = [size for (mean, size) in d.get_clusters()]
+
+    if cache is not None and d.lists is not None:
+        cache['lists'] = d.lists
+    return {'consensus': max(sizes) / n, 'converged': bool(converged),
+            'time': time, 'clusters': len(sizes)}
+
+_worker_graphs = {}
+_worker_caches = {}
+
+def _run_task(task):
+    """
+    Process pool task: run one cell on a graph in shared memory.  Each
+    worker maps a topology once and keeps it, with its run_cell cache, for
+    later cells.
+    :param task: a tuple (key, params, spec) with the spec from CompiledGraph.share
+    :return: a tuple (key, params, results)
+    """
+    key, params, spec = task
+    name = spec[0][0][0]
+    if name not in _worker_graphs:
+        _worker_graphs[name] = CompiledGraph.attach(spec)
+        _worker_caches[name] = {}
+    return key, params, run_cell(_worker_graphs[name][1], params, _worker_caches[name])
+
+class ResultStore:
+    """
+    A sqlite table with one row per finished cell, keyed by the hash of its
+    parameters, so an interrupted sweep can pick up where it stopped.
+    """
+
+    def __init__(self, path='sweep.db'):
+        """
+        Open or create a result store
+        :param path: the sqlite database file
+        """
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, params TEXT, '
+                        'consensus REAL, converged INTEGER, time INTEGER, clusters INTEGER)')
+
+    def has(self, key):
+        """
+        Check whether a cell has already been run
+        :param key: the hash of the cell's parameters
+        :return: True if the store has a row for the cell
+        """
+        return self.db.execute('SELECT 1 FROM results WHERE key = ?', (key,)).fetchone() is not None
+
+    def put(self, key, params, results):
+        """
+        Write the results of a cell
+        :param key: the hash of the cell's parameters
+        :param params: a parameter dictionary
+        :param results: the dictionary returned by run_cell
+        :return: None
+        """
+        self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                        (key, json.dumps(params, sort_keys=True), results['consensus'],
+                         int(results['converged']), results['time'], results['clusters']))
+        self.db.commit()
+
+    def get_rows(self, cells=None):
+        """
+        Get stored results
+        :param cells: a list of parameter dictionaries, or None for every row
+        :return: a list of dictionaries holding the parameters and results of each cell
+        """
+        rows = []
+        query = 'SELECT params, consensus, converged, time, clusters FROM results'
+        if cells is None:
+            found = self.db.execute(query).fetchall()
+        else:
+            found = [self.db.execute(query + ' WHERE key = ?', (get_key(cell),)).fetchone() for cell in cells]
+        for row in found:
+            if row is None:
+                continue
+            params, consensus, converged, time, clusters = row
+            row = json.loads(params)
+            row.update({'consensus': consensus, 'converged': bool(converged),
+                        'time': time, 'clusters': clusters})
+            rows.append(row)
+        return rows
+
+    def close(self):
+        """
+        Close the database
+        :return: None
+        """
+        self.db.close()
+
+def run_sweep(grid, path='sweep.db', processes=None):
+    """
+    Run every cell of a parameter grid that is not in the result store yet.
+    Each topology (family, n, graph_seed) is built and compiled once in
+    this process and shared with the workers through shared memory.
+    :param grid: a dictionary from parameter names to lists of values, see expand_grid
+    :param path: the sqlite database file of the result store
+    :param processes: number of worker processes.  Runs in this process if 1, uses every core if None.
+    :return: the summary table of the grid, see summarize
+    """
+    cells = expand_grid(grid)
+    store = ResultStore(path)
+    todo = [(get_key(cell), cell) for cell in cells]
+    todo = [(key, cell) for (key, cell) in todo if not store.has(key)]
+
+    graphs = {}
+    for key, cell in todo:
+        topology = (cell['family'], cell['n'], cell['graph_seed'])
+        if topology not in graphs:
+            g = FAMILIES[cell['family']](cell['n'], cell['graph_seed'])
+            if not isinstance(g, CompiledGraph):
+                g = CompiledGraph.from_networkx(g)
+            graphs[topology] = g
+
+    if processes == 1:
+        caches = {topology: {} for topology in graphs}
+        for key, cell in todo:
+            topology = (cell['family'], cell['n'], cell['graph_seed'])
+            store.put(key, cell, run_cell(graphs[topology], cell, caches[topology]))
+    elif todo:
+        handles, specs = [], {}
+        try:
+            for topology, g in graphs.items():
+                h, specs[topology] = g.share()
+                handles += h
+            tasks = [(key, cell, specs[(cell['family'], cell['n'], cell['graph_seed'])])
+                     for (key, cell) in todo]
+            with Pool(processes) as pool:
+                # Write every cell as it finishes, so an interrupted sweep keeps its work
+                for key, cell, results in pool.imap_unordered(_run_task, tasks):
+                    store.put(key, cell, results)
+        finally:
+            for shm in handles:
+                shm.close()
+                shm.unlink()
+
+    rows = store.get_rows(cells)
+    store.close()
+    return summarize(rows)
+
+def summarize(rows, over=('seed',)):
+    """
+    Average the results of cells that differ only in the given parameters
+    :param rows: a list of rows from ResultStore.get_rows
+    :param over: the parameters to average over
+    :return: a list of dictionaries with the remaining parameters, the number
+             of runs, the mean consensus fraction, the fraction of converged
+             runs, the mean convergence time of converged runs (None if none
+             converged) and the mean number of clusters
+    """
+    groups = {}
+    for row in rows:
+        params = {name: value for name, value in row.items()
+                  if name in DEFAULTS and name not in over}
+        groups.setdefault(json.dumps(params, sort_keys=True), (params, []))[1].append(row)
+
+    table = []
+    for params, group in groups.values():
+        times = [row['time'] for row in group if row['converged']]
+        entry = dict(params)
+        entry.update({
+            'runs': len(group),
+            'consensus': float(np.mean([row['consensus'] for row in group])),
+            'converged': float(np.mean([row['converged'] for row in group])),
+            'time': float(np.mean(times)) if times else None,
+            'clusters': float(np.mean([row['clusters'] for row in group])),
+        })
+        table.append(entry)
+    return table
+
+def print_summary(table, columns=('method', 'family', 'n', 'q', 'epsilon', 'mu')):
+    """
+    Print a summary table from summarize
+    :param table: a list of dictionaries from summarize
+    :param columns: the parameter columns to show
+    :return: None
+    """
+    columns = list(columns) + ['runs', 'consensus', 'converged', 'time', 'clusters']
+    print('\t'.join(columns))
+    for entry in table:
+        print('\t'.join(f'{entry[c]:.3g}' if isinstance(entry[c], float) else str(entry[c])
+                        for c in columns))
+
+
+def main():
+    grid = {'method': ['voter', 'majority', 'dw'], 'family': ['watts_strogatz', 'barabasi_albert'],
+            'n': [200], 'seed': range(10)}
+    print_summary(run_sweep(grid))
+
+
+if __name__ == '__main__':
+    main()
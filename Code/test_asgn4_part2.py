@@ -0,0 +1,47 @@
+# Checks of the SIR/SIRS engines in asgn4_part2, run with pytest
+
+import random
+import numpy as np
+import asgn4_part2 as sir
+from generators import undirected_scale_free_graph
+
+
+def run_gillespie_sim(beta, gamma, delta=0.):
+    random.seed(0)
+    G = undirected_scale_free_graph(300, seed=1)
+    sir.set_parameters(G, beta, gamma, delta)
+    sir.set_initial_states(G, .05)
+    x, counts = sir.run_sim(G, 20, gillespie=True, plot=False)
+    state = sir.get_sir(G)
+    assert (counts.sum(axis=0) == 300).all()
+    assert state.counts == [int(np.count_nonzero(state.states == s)) for s in (sir.S, sir.I, sir.R)]
+    return counts
+
+def test_gillespie_beta_one():
+    # Every node reachable from a spreader is infected at once
+    counts = run_gillespie_sim(1., .1)
+    assert counts[sir.S, 0] < 300 - 15
+
+def test_gillespie_gamma_one():
+    # Spreaders recover at once, after infecting no one, unlike step
+    counts = run_gillespie_sim(.1, 1.)
+    assert counts[sir.I, 0] == 0
+    assert counts[sir.S, 0] == 300 - 15
+
+def test_gillespie_beta_and_gamma_one():
+    # With beta == 1 too, spreaders infect their neighbors before recovering
+    counts = run_gillespie_sim(1., 1.)
+    assert counts[sir.I, 0] == 0
+    assert counts[sir.S, 0] < 300 - 15
+
+def test_get_sir_per_graph():
+    # A copy gets its own state, and changing the edges makes a new one
+    G = undirected_scale_free_graph(100, seed=1)
+    sir.set_parameters(G, .3, .1)
+    sir.set_initial_states(G, .1)
+    H = G.copy()
+    assert sir.get_sir(H) is not sir.get_sir(G)
+    assert sir.get_num_i(G) == 10 and sir.get_num_i(H) == 0
+    state = sir.get_sir(G)
+    G.remove_edge(*next(iter(G.edges)))
+    assert sir.get_sir(G) is not state
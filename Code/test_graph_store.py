@@ -0,0 +1,23 @@
+# Checks of the edge list converter in graph_store, run with pytest
+
+from graph_store import convert_edge_list
+
+
+def edges_of(g):
+    sources, targets = g.get_edge_arrays()
+    return sorted(zip(g.to_label(sources), g.to_label(targets)))
+
+def test_convert_int_labels(tmp_path):
+    src = tmp_path / 'edges.txt'
+    src.write_text('10 20\n5 10\n1000000000000000 5\n')
+    g = convert_edge_list(str(src), str(tmp_path / 'g'), chunk=1)
+    assert list(g.to_label(range(4))) == [5, 10, 20, 10 ** 15]
+    assert edges_of(g) == [(5, 10), (10, 20), (10 ** 15, 5)]
+
+def test_convert_mixed_labels(tmp_path):
+    # The first string label turns every label into a string, across chunks
+    src = tmp_path / 'edges.txt'
+    src.write_text('10 20\n5 10\na 5\n20 b\n')
+    g = convert_edge_list(str(src), str(tmp_path / 'g'), chunk=1)
+    assert edges_of(g) == [('10', '20'), ('20', 'b'), ('5', '10'), ('a', '5')]
+    assert sorted(tmp_path.iterdir()) == [tmp_path / 'edges.txt', tmp_path / 'g']
@@ -0,0 +1,189 @@
+import numpy as np
+
+# Size in bytes of the .npy header written by TrajectoryRecorder.  It is
+# fixed so that the header can be rewritten in place once the number of
+# frames is known.
+HEADER_SIZE = 128
+
+
+def npy_header(shape, dtype):
+    """
+    Build a version 1.0 .npy header of exactly HEADER_SIZE bytes.
+    :param shape: Shape of the stored array
+    :param dtype: numpy dtype of the stored array
+    :return: The header as bytes
+    """
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': %r, }" % (np.dtype(dtype).str, tuple(shape))
+    header = header.ljust(HEADER_SIZE - 10 - 1) + '\n'
+    return b'\x93NUMPY\x01\x00' + len(header).to_bytes(2, 'little') + header.encode('latin1')
+
+def load_trajectory(path):
+    """
+    Load a trajectory written by TrajectoryRecorder, without reading the
+    frames into memory.
+    :param path: The path given to the recorder
+    :return: A tuple (steps, frames): the recorded update counts, and a
+             read-only memory-mapped (frames x agents) array of opinions
+    """
+    steps = np.load(path + '.steps.npy')
+    frames = np.load(path + '.npy', mmap_mode='r')
+    return steps, frames
+
+class TrajectoryRecorder():
+    """
+    Records the opinions of every agent over a run into a preallocated
+    float32 buffer instead of one Python list per agent.
+
+    The buffer holds as many frames as fit in budget bytes.  When it fills
+    up, the frames are either appended to a .npy file on disk (if a path is
+    given) and the buffer is reused, or, without a path, every other frame
+    is dropped and the stride doubles, so memory stays bounded either way.
+    """
+
+    def __init__(self, num_agents, path=None, stride=1, budget=1 << 27, dtype=np.float32):
+        """
+        Constructor for a trajectory recorder
+        :param num_agents: Number of opinions in each frame
+        :param path: If given, spill frames to path.npy and steps to path.steps.npy
+        :param stride: Record only every stride-th update
+        :param budget: Largest number of bytes of frames to keep in memory
+        :param dtype: numpy type of the stored opinions
+        """
+        self.num_agents = num_agents
+        self.path = path
+        self.stride = stride
+        self.dtype = np.dtype(dtype)
+        capacity = max(2, budget // max(1, num_agents * self.dtype.itemsize))
+        self.buffer = np.empty((capacity, num_agents), dtype=self.dtype)
+        self.steps = []
+        self.size = 0
+        self.spilled = 0
+        self.file = None
+        if path is not None:
+            self.file = open(path + '.npy', 'wb')
+            self.file.write(npy_header((0, num_agents), self.dtype))
+
+    def record(self, step, opinions, force=False):
+        """
+        Record the opinions after an update, if the step is on the stride
+        :param step: The number of updates run so far
+        :param opinions: Sequence of the current opinions of all agents
+        :param force: If True, record even off the stride, e.g. the final state
+        :return: None
+        """
+        if step % self.stride != 0 and not force:
+            return
+        if self.steps and self.steps[-1] == step:
+            return
+        if self.size == len(self.buffer):
+            if self.file is not None:
+                self.flush()
+            else:
+                self.decimate()
+                if step % self.stride != 0 and not force:
+                    return
+        self.buffer[self.size] = opinions
+        self.steps.append(step)
+        self.size += 1
+
+    def decimate(self):
+        """
+        Drop every other frame held in memory and double the stride
+        :return: None
+        """
+        keep = [i for i, step in enumerate(self.steps) if step % (2 * self.stride) == 0]
+        self.buffer[:len(keep)] = self.buffer[keep]
+        self.steps = [self.steps[i] for i in keep]
+        self.size = len(keep)
+        self.stride *= 2
+
+    def flush(self):
+        """
+        Append the frames held in memory to the file on disk
+        :return: None
+        """
+        if self.file is None or self.size == 0:
+            return
+        self.buffer[:self.size].tofile(self.file)
+        self.spilled += self.size
+        self.size = 0
+
+    def close(self):
+        """
+        Write out the remaining frames and the steps, and fix the shape in
+        the file header.  The recorder can still be read after closing.
+        :return: None
+        """
+        if self.file is None:
+            return
+        self.flush()
+        self.file.seek(0)
+        self.file.write(npy_header((self.spilled, self.num_agents), self.dtype))
+        self.file.close()
+        self.file = None
+        np.save(self.path + '.steps.npy', np.array(self.steps, dtype=np.int64))
+
+    def get_steps(self):
+        """
+        Get the update counts of the recorded frames
+        :return: A numpy array of update counts
+        """
+        return np.array(self.steps, dtype=np.int64)
+
+    def get_frames(self):
+        """
+        Get the recorded opinions.  Closes the recorder if it writes to disk.
+        :return: A (frames x agents) numpy array, memory-mapped if on disk
+        """
+        if self.path is None:
+            return self.buffer[:self.size]
+        self.close()
+        return np.load(self.path + '.npy', mmap_mode='r')
+
+    def plot(self, ax=None, mode=None, bins=100, value_range=(0., 1.), max_points=10 ** 6, chunk=1024):
+        """
+        Plot the trajectories, either as one LineCollection holding a line
+        per agent or as a heatmap of the opinion density at each frame.
+        :param ax: A matplotlib axes to draw on, or None for the current axes
+        :param mode: 'lines', 'density', or None to draw lines only up to max_points points
+        :param bins: Number of opinion bins of the heatmap
+        :param value_range: A tuple (low, high) of the opinion range of the heatmap
+        :param max_points: Largest number of points to draw as lines when mode is None
+        :param chunk: Number of frames binned at once for the heatmap
+        :return: The matplotlib artist that was added
+        """
+        import matplotlib.pyplot as plt
+        from matplotlib.collections import LineCollection
+
+        if ax is None:
+            ax = plt.gca()
+        steps = self.get_steps()
+        frames = self.get_frames()
+        if mode is None:
+            mode = 'lines' if frames.size <= max_points else 'density'
+
+        if mode == 'lines':
+            segments = np.empty((self.num_agents, len(steps), 2), dtype=np.float32)
+            segments[:, :, 0] = steps
+            segments[:, :, 1] = np.asarray(frames).T
+            artist = ax.add_collection(LineCollection(segments, alpha=0.5, linewidths=0.5))
+            ax.autoscale()
+            return artist
+
+        # Count the agents in each opinion bin, a chunk of frames at a time
+        low, high = value_range
+        density = np.zeros((bins, len(steps)), dtype=np.int64)
+        for start in range(0, len(steps), chunk):
+            block = np.asarray(frames[start:start + chunk])
+            idx = ((block - low) * (bins / (high - low))).astype(np.int64)
+            np.clip(idx, 0, bins - 1, out=idx)
+            idx += np.arange(len(block))[:, None] * bins
+            counts = np.bincount(idx.ravel(), minlength=len(block) * bins)
+            density[:, start:start + len(block)] = counts.reshape(len(block), bins).T
+        extent = (steps[0], steps[-1], low, high) if len(steps) else None
+        return ax.imshow(density, origin='lower', aspect='auto', extent=extent,
+                         interpolation='nearest', cmap='viridis')
+
+    def __del__(self):
+        if getattr(self, 'file', None) is not None:
+            self.close()
@@ -1,6 +1,15 @@
 import networkx as nx
-import matplotlib.pyplot as plt
+import numpy as np
+import os
+from array import array
+from collections.abc import MutableMapping
+from heapq import heapify, heappop, heapreplace, nlargest
+from math import ceil, e, lgamma, log, log2, sqrt
+from multiprocessing import Pool, cpu_count
 from random import random, shuffle
+from compiled_graph import CompiledGraph, attach_arrays, row_positions, share_arrays
+from centrality import top_nodes
+from generators import contains, distinct, relaxed_caveman_graph, watts_strogatz_graph
 
 def union(list1, list2):
     """
@@ -40,35 +49,29 @@ def coin_flip(prob_of_heads):
         return True
     return False
   
-def get_directed_caveman_graph(m, n, p):
+def get_directed_caveman_graph(m, n, p, seed=None, compiled=False):
     """
     Create a directed caveman graph
     :param m: Number of communities
     :param n: Number of nodes per community
     :param p: Rewiring probability
+    :param seed: Seed for the random number generator
+    :param compiled: If True, return a CompiledGraph and skip networkx entirely
     :return: A directed caveman graph
     """
-    h = nx.relaxed_caveman_graph(m, n, p)
-    g = nx.DiGraph()
-    for (u, v) in h.edges():
-        g.add_edge(u, v)
-    del h
-    return g
+    return relaxed_caveman_graph(m, n, p, seed=seed, directed=True, as_networkx=not compiled)
 
-def get_directed_small_world_graph(n, k, p):
+def get_directed_small_world_graph(n, k, p, seed=None, compiled=False):
     """
     Create a directed small world graph
     :param n: number of nodes
     :param k: number of neighbors
     :param p: rewiring probability
-    :return: A networkx DiGraph object
+    :param seed: Seed for the random number generator
+    :param compiled: If True, return a CompiledGraph and skip networkx entirely
+    :return: A networkx DiGraph object, or a CompiledGraph
     """
-    h = nx.watts_strogatz_graph(n, k, p)
-    g = nx.DiGraph()
-    for (u, v) in list(h.edges()):
-        g.add_edge(u, v)
-    del h
-    return g
+    return watts_strogatz_graph(n, k, p, seed=seed, directed=True, as_networkx=not compiled)
 
 def get_k_random_nodes(ic, k):
     """
@@ -77,7 +80,7 @@ def get_k_random_nodes(ic, k):
     :param k: The number of nodes to find
     :return: A set of the most influential nodes
     """
-    nodes = list(range(ic.graph.number_of_nodes()))
+    nodes = list(ic.compiled.labels)
     shuffle(nodes)
     return nodes[:k]
   
@@ -93,6 +96,8 @@ def update_plot(fig, ax, pos, ic, speed='lo'):
     :return: None
     """
 
+    import matplotlib.pyplot as plt
+
     # Clear anything off the current plot
     ax.clear()
     fig.canvas.flush_events()
@@ -101,7 +106,7 @@ def update_plot(fig, ax, pos, ic, speed='lo'):
 
     # Calculate colors for all nodes
     colors = []
-    for i in range(ic.graph.number_of_nodes()):
+    for i in ic.compiled.labels:
         if ic.node_stats[i]:
             colors.append((1., 0., 0., .5))
         else:
@@ -111,7 +116,7 @@ def update_plot(fig, ax, pos, ic, speed='lo'):
                 colors.append((0., 1., 0., .5))
 
     # Draw the network
-    nx.draw_networkx(ic.graph, node_color=colors, pos=pos)
+    nx.draw_networkx(ic.get_networkx(), node_color=colors, pos=pos)
     fig.canvas.draw()
 
     # Wait a different amount of time based on the speed requested
@@ -122,77 +127,403 @@ def update_plot(fig, ax, pos, ic, speed='lo'):
     if speed == 'lo':
         plt.pause(1.)
 
-def run_simulation(ic, animate=False):
+class CascadeRenderer():
+    """
+    Animates an independent cascade without redrawing the whole network on
+    every step.  Node and edge artists are created once; each frame only
+    recolors the nodes whose state changed.  On screen, the static edges are
+    cached as a background image and only the nodes are blitted over it.
+    Given a path, frames are rendered off-screen with the Agg canvas (no
+    interactive backend needed) and written to a video, a gif, or a
+    directory of PNG files at a fixed frame rate.
+    """
+
+    # Colors for inactive, active, and never-activated-after-finishing nodes
+    COLORS = np.array([(0., 0., 1., .5), (1., 0., 0., .5), (0., 1., 0., .5)])
+
+    # Seconds to wait between on-screen frames
+    DELAYS = {'hi': .2, 'med': .5, 'lo': 1.}
+
+    def __init__(self, ic, pos=None, path=None, fps=5, dpi=100, max_detail=500):
+        """
+        Constructor for the cascade renderer
+        :param ic: An independent cascade object
+        :param pos: A dictionary of [node]-->[x, y coordinates].  If None, a spring
+                    layout, or a circular layout above max_detail nodes.
+        :param path: Where to write frames off-screen.  A file ending in .gif
+                     or a video extension, or a directory for PNG frames.
+                     Frames are shown on screen if None.
+        :param fps: Frame rate of the written animation
+        :param dpi: Resolution of the written frames
+        :param max_detail: Graphs with more nodes are drawn without labels or arrows
+        """
+        self.ic = ic
+        self.path = path
+        self.writer = None
+        self.frame = 0
+        n = ic.compiled.num_nodes
+
+        if path is None:
+            import matplotlib.pyplot as plt
+
+            self.fig, self.ax = plt.subplots()
+        else:
+            from matplotlib.figure import Figure
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            self.fig = Figure(dpi=dpi)
+            FigureCanvasAgg(self.fig)
+            self.ax = self.fig.add_subplot()
+        self.ax.set_axis_off()
+
+        # A spring layout is far too slow for large graphs, so they go on a
+        # circle in id order
+        small = n <= max_detail
+        if pos is None and small:
+            pos = nx.spring_layout(ic.get_networkx())
+        if pos is None:
+            angles = 2 * np.pi * np.arange(n) / max(n, 1)
+            xy = np.column_stack([np.cos(angles), np.sin(angles)])
+        else:
+            xy = np.array([pos[label] for label in ic.compiled.labels])
+
+        # Draw the edges once
+        if small:
+            edges = nx.draw_networkx_edges(ic.get_networkx(), pos=pos, ax=self.ax)
+            edges = edges if isinstance(edges, list) else [edges]
+        else:
+            from matplotlib.collections import LineCollection
+            indptr, indices, weights = ic.get_edge_arrays()
+            sources = np.repeat(np.arange(n), np.diff(indptr))
+            segments = np.stack([xy[sources], xy[indices]], axis=1)
+            edges = [self.ax.add_collection(LineCollection(segments, colors='k',
+                                                           linewidths=.2, alpha=.3))]
+
+        # Draw the nodes once, and keep their colors to update in place
+        self.codes = np.zeros(n, dtype=np.int8)
+        self.colors = self.COLORS[self.codes]
+        self.nodes = self.ax.scatter(xy[:, 0], xy[:, 1], c=self.colors,
+                                     s=300 if small else 4, zorder=2)
+        self.labels = []
+        if small:
+            self.labels = list(nx.draw_networkx_labels(ic.get_networkx(), pos=pos,
+                                                       ax=self.ax).values())
+        self.ax.autoscale_view()
+
+        if path is None:
+            # Cache everything except the nodes and labels as a background
+            self.nodes.set_animated(True)
+            for label in self.labels:
+                label.set_animated(True)
+            self.fig.canvas.draw()
+            self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        else:
+            # Render the edges once into a fixed image behind the nodes, so
+            # writing a frame only has to rasterize the nodes and labels
+            self.ax.set_xlim(self.ax.get_xlim())
+            self.ax.set_ylim(self.ax.get_ylim())
+            for artist in [self.nodes] + self.labels:
+                artist.set_visible(False)
+            self.fig.canvas.draw()
+            background = np.asarray(self.fig.canvas.buffer_rgba()).copy()
+            for artist in edges:
+                artist.remove()
+            self.fig.figimage(background, zorder=-1)
+            for artist in [self.nodes] + self.labels:
+                artist.set_visible(True)
+
+            if path.endswith('.gif'):
+                from matplotlib.animation import PillowWriter
+                self.writer = PillowWriter(fps=fps)
+                self.writer.setup(self.fig, path, dpi=dpi)
+            elif path.endswith(('.mp4', '.avi', '.mov', '.mkv', '.webm')):
+                from matplotlib.animation import FFMpegWriter
+                self.writer = FFMpegWriter(fps=fps)
+                self.writer.setup(self.fig, path, dpi=dpi)
+            else:
+                os.makedirs(path, exist_ok=True)
+
+    def draw(self, speed='lo'):
+        """
+        Recolor the nodes whose state changed and show or write the frame.
+        :param speed: How fast to animate on screen.  Can be 'lo', 'med', or 'hi'
+        :return: None
+        """
+        ic = self.ic
+        active = ic.node_stamp == ic.node_epoch
+        codes = np.where(active, 1, 2 if ic.is_done() else 0).astype(np.int8)
+        changed = np.flatnonzero(codes != self.codes)
+        if len(changed) > 0:
+            self.colors[changed] = self.COLORS[codes[changed]]
+            self.codes = codes
+            self.nodes.set_facecolor(self.colors)
+
+        if self.path is None:
+            canvas = self.fig.canvas
+            canvas.restore_region(self.background)
+            self.ax.draw_artist(self.nodes)
+            for label in self.labels:
+                self.ax.draw_artist(label)
+            canvas.blit(self.fig.bbox)
+            canvas.flush_events()
+            canvas.start_event_loop(self.DELAYS[speed])
+        elif self.writer is not None:
+            self.writer.grab_frame()
+        else:
+            self.fig.savefig(os.path.join(self.path, f'frame_{self.frame:05d}.png'))
+        self.frame += 1
+
+    def close(self):
+        """
+        Finish writing the animation, or keep the final frame on screen.
+        :return: None
+        """
+        if self.writer is not None:
+            self.writer.finish()
+        elif self.path is None:
+            self.nodes.set_animated(False)
+            for label in self.labels:
+                label.set_animated(False)
+            import matplotlib.pyplot as plt
+
+            plt.show()
+
+def run_simulation(ic, animate=False, path=None, fps=5, pos=None):
     """
     Run a single simulation on an independent cascade model
     :param ic: An independent cascade object
     :param animate: Boolean, whether or not to animate the simulation
+    :param path: If given, render the animation off-screen to this file or
+                 directory (see CascadeRenderer) instead of showing it
+    :param fps: Frame rate used when writing to path
+    :param pos: A dictionary of [node]-->[x, y coordinates] for the animation, see CascadeRenderer
     :return: None
     """
 
     ic.reset()
     
-    # Initialize fig, ax, plot
-    # Create plot if desired
-    fig, ax, pos = None, None, None
-    if animate:
-        fig, ax = plt.subplots()
-        pos = nx.spring_layout(ic.graph)
-        update_plot(fig, ax, pos, ic)
+    # Create the renderer if desired
+    renderer = None
+    if animate or path is not None:
+        renderer = CascadeRenderer(ic, pos=pos, path=path, fps=fps)
+        renderer.draw()
 
     # Update the model as long as there are still possible
     # activations
     while not ic.is_done():
         ic.update()
-        if animate:
-            update_plot(fig, ax, pos, ic)
+        if renderer is not None:
+            renderer.draw()
 
     # Plot final state of the network if desired
-    if animate:
-        update_plot(fig, ax, pos, ic, speed='hi')
-        plt.show()
+    if renderer is not None:
+        renderer.draw(speed='hi')
+        renderer.close()
+
+class NodeStatsView(MutableMapping):
+    """
+    Dictionary-style view of node activation status, backed by the
+    epoch-stamped arrays of an ICModel.  ic.node_stats[u] is True if u is
+    active.
+    """
+
+    def __init__(self, ic):
+        self.ic = ic
+
+    def __getitem__(self, u):
+        return bool(self.ic.node_stamp[self.ic.compiled.node_id(u)] == self.ic.node_epoch)
+
+    def __setitem__(self, u, value):
+        ic = self.ic
+        u = ic.compiled.node_id(u)
+        if value and ic.node_stamp[u] != ic.node_epoch:
+            # A node activated by hand can activate others next round
+            ic.node_stamp[u] = ic.node_epoch
+            ic.frontier = np.append(ic.frontier, u)
+        elif not value:
+            # A deactivated node no longer activates others
+            ic.node_stamp[u] = 0
+            ic.frontier = ic.frontier[ic.frontier != u]
+
+    def __delitem__(self, u):
+        raise TypeError('nodes cannot be removed from node_stats')
+
+    def __iter__(self):
+        return iter(self.ic.compiled.labels)
+
+    def __len__(self):
+        return len(self.ic.node_stamp)
+
+class EdgeStatsView(MutableMapping):
+    """
+    Dictionary-style view of edge status, backed by the epoch-stamped
+    arrays of an ICModel.  ic.edge_stats[u, v] is True if edge (u, v) has
+    not been tried yet.
+    """
+
+    def __init__(self, ic):
+        self.ic = ic
+
+    def __getitem__(self, edge):
+        j = self.ic.get_edge_index(*edge)
+        return bool(self.ic.edge_stamp[j] != self.ic.edge_epoch)
+
+    def __setitem__(self, edge, value):
+        ic = self.ic
+        j = ic.get_edge_index(*edge)
+        ic.edge_stamp[j] = 0 if value else ic.edge_epoch
+        u = ic.compiled.node_id(edge[0])
+        if value and ic.node_stamp[u] == ic.node_epoch and not (ic.frontier == u).any():
+            # An active node with an untried edge can activate others next round
+            ic.frontier = np.append(ic.frontier, u)
+
+    def __delitem__(self, edge):
+        raise TypeError('edges cannot be removed from edge_stats')
+
+    def __iter__(self):
+        return self.ic.iter_edges()
+
+    def __len__(self):
+        return len(self.ic.indices)
+
+class EdgeWeightsView(MutableMapping):
+    """
+    Dictionary-style view of edge activation probabilities, backed by the
+    weight array of an ICModel.  ic.edge_weights[u, v] is the probability
+    that u activates v.
+    """
+
+    def __init__(self, ic):
+        self.ic = ic
+
+    def __getitem__(self, edge):
+        return float(self.ic.weights[self.ic.get_edge_index(*edge)])
+
+    def __setitem__(self, edge, value):
+        self.ic.weights[self.ic.get_edge_index(*edge)] = value
+
+    def __delitem__(self, edge):
+        raise TypeError('edges cannot be removed from edge_weights')
+
+    def __iter__(self):
+        return self.ic.iter_edges()
+
+    def __len__(self):
+        return len(self.ic.indices)
 
 class ICModel():
     """
     A class to carry out Independent Cascade diffusion
     """
 
-    def __init__(self, g, activation_prob):
+    def __init__(self, g, activation_prob, seed=None):
         """
         Constructor for Independent Cascade model
-        :param g: A networkx graph
-        :param nodes: A list of nodes to be activated at the beginning
-        :param activation_prob: The probability for each edge to activate a neighbor
+        :param g: A networkx graph or a CompiledGraph, with any node labels
+        :param activation_prob: The probability for each edge to activate a neighbor.
+                                If None, the edge weights are used: a CompiledGraph's
+                                weights, or the 'weight' attribute of a networkx graph.
+        :param seed: Seed for the model's random number generator
+        :raises ValueError: If activation_prob is None and an edge has no weight
         """
 
-        # Store information about node and edge activation status
-        # A node u is 'active' if self.node_stats[u]['active'] == True
-        # An edge (u,v) is 'active' if self.edge_stats[u,v]['active'] == True
-        # Edge weights are the probability that u will activate v
+        # The graph is stored in compressed sparse row form over contiguous
+        # node ids: the out-neighbors of u are indices[indptr[u]:indptr[u + 1]],
+        # sorted, and weights holds the probability that u will activate
+        # each one.  Undirected edges are stored in both directions.  Node
+        # labels are only used at the boundary of the model.
         self.graph = g
-        self.node_stats = {}
-        self.edge_stats = {}
-        self.edge_weights = {}
+        if isinstance(g, CompiledGraph):
+            self.compiled = g
+        elif activation_prob is None:
+            if not all('weight' in data for u, v, data in g.edges(data=True)):
+                raise ValueError("activation_prob is None but an edge has no 'weight'")
+            self.compiled = CompiledGraph.from_networkx(g, weight='weight')
+        else:
+            self.compiled = CompiledGraph.from_networkx(g)
+        n = self.compiled.num_nodes
+        self.indptr = self.compiled.out_indptr
+        self.indices = self.compiled.out_indices
+        if activation_prob is None:
+            if self.compiled.out_weights is None:
+                raise ValueError('activation_prob is None but the graph has no edge weights')
+            self.weights = np.array(self.compiled.out_weights, dtype=np.float32)
+        else:
+            self.weights = np.full(len(self.indices), activation_prob, dtype=np.float32)
+
+        # A node u is active if node_stamp[u] == node_epoch, and an edge
+        # has been tried if its edge_stamp equals edge_epoch.  Resetting
+        # only has to increment the epoch.
+        self.node_epoch = 0
+        self.edge_epoch = 0
+        self.node_stamp = np.zeros(n, dtype=np.uint32)
+        self.edge_stamp = np.zeros(len(self.indices), dtype=np.uint32)
+
+        # Dictionary-style access to the arrays above
+        self.node_stats = NodeStatsView(self)
+        self.edge_stats = EdgeStatsView(self)
+        self.edge_weights = EdgeWeightsView(self)
 
         # Store references to initial conditions
         self.initial_nodes = []
         self.initial_activation_prob = activation_prob
+        self.rng = np.random.default_rng(seed)
+
+        # Nodes that became active in the most recent round.  Only these
+        # nodes can still activate anyone, so each round only needs to
+        # look at their outgoing edges.
+        self.frontier = np.zeros(0, dtype=np.int64)
 
-        # Set all nodes' and edges' active status, as well as activation
-        # probabilities
+        # Set all nodes' and edges' active status
         self.reset()
 
+    def get_networkx(self):
+        """
+        Get the model's graph as a networkx graph, e.g. for drawing.
+        :return: A networkx graph
+        """
+        if isinstance(self.graph, CompiledGraph):
+            self.graph = self.graph.to_networkx()
+        return self.graph
+
+    def get_edge_index(self, u, v):
+        """
+        Find the position of edge (u, v) in the edge arrays.
+        :param u: Source node label
+        :param v: Destination node label
+        :return: Index into indices, weights and edge_stamp
+        """
+        u, v = self.compiled.node_id(u), self.compiled.node_id(v)
+        lo, hi = self.indptr[u], self.indptr[u + 1]
+        j = lo + np.searchsorted(self.indices[lo:hi], v)
+        if j == hi or self.indices[j] != v:
+            raise KeyError((u, v))
+        return j
+
+    def iter_edges(self):
+        """
+        Iterate over all stored edges.
+        :return: A generator of (u, v) label tuples
+        """
+        label = self.compiled.node_label
+        for u in range(len(self.indptr) - 1):
+            for j in range(self.indptr[u], self.indptr[u + 1]):
+                yield (label(u), label(self.indices[j]))
+
     def set_initial_node_status(self):
         """
         Set initial statuses to False for all nodes not in the list
         nodes.  Set status to True for all nodes in the list nodes.
         :return: None
         """
-        for i in range(self.graph.number_of_nodes()):
-            if i in self.initial_nodes:
-                self.node_stats[i] = True
-            else:
-                self.node_stats[i] = False
+        self.node_epoch += 1
+        if self.node_epoch == np.iinfo(np.uint32).max:
+            self.node_stamp[:] = 0
+            self.node_epoch = 1
+
+        # The initially active nodes are the first frontier
+        self.frontier = np.unique(np.asarray(self.compiled.to_index(self.initial_nodes),
+                                             dtype=np.int64))
+        self.node_stamp[self.frontier] = self.node_epoch
 
     def activate_nodes(self, nodes):
         """
@@ -207,11 +538,13 @@ class ICModel():
         """
         Set initial activation status of all edges to True.
         If an edge's status is True, the edge can still be used.
+        Edge weights are left as they are.
         :return: None
         """
-        for i in self.graph.edges():
-            self.edge_stats[i] = True
-            self.edge_weights[i] = self.initial_activation_prob
+        self.edge_epoch += 1
+        if self.edge_epoch == np.iinfo(np.uint32).max:
+            self.edge_stamp[:] = 0
+            self.edge_epoch = 1
 
     def reset(self):
         """
@@ -226,132 +559,934 @@ class ICModel():
         Calculate the number of active nodes.
         :return: Number of active nodes
         """
-        stats = [self.node_stats[key] for key in self.node_stats]
-        return stats.count(True)
+        return int(np.count_nonzero(self.node_stamp == self.node_epoch))
     
     def get_activated_nodes(self):
         """
-        Get the indexes of all activated nodes.
-        :return: List of node indexes
+        Get the labels of all activated nodes.
+        :return: List of node labels
+        """
+        return self.compiled.to_label(np.flatnonzero(self.node_stamp == self.node_epoch))
+
+    def get_edge_arrays(self):
+        """
+        Get the graph and edge weights as compressed sparse row arrays over
+        node ids.  The out-neighbors of node u are indices[indptr[u]:indptr[u + 1]],
+        and weights holds the activation probability of each of those edges.
+        :return: A tuple (indptr, indices, weights) of numpy arrays
         """
-        return [i for i in range(self.graph.number_of_nodes() if self.node_stats[i])]
+        return self.indptr, self.indices, self.weights
 
     def is_done(self):
         """
         Checks to see if there are any more possible activations.
+        Every edge out of an older active node has already been tried,
+        so activations are only possible from the current frontier.
         :return: True if there are no more activations possible, False otherwise
         """
+        return len(self.frontier) == 0
+
+    def update(self):
+        """
+        Update activation statuses of all nodes and edges.  Only the
+        outgoing edges of the frontier (nodes activated last round) are
+        examined.
+        :return: None
+        """
 
-        # Iterate through all edges
-        for (u, v) in self.graph.edges():
-            u_active = self.node_stats[u]
-            v_active = self.node_stats[v]
-            edge_active = self.edge_stats[u, v]
+        # Gather the edges leaving the frontier
+        edges = row_positions(self.indptr, self.frontier)[1]
 
-            # If the source node is activated, the destination node is
-            # not, and the edge can still be used, then there is another
-            # potential activation waiting to be tried.
-            if (u_active) and (not v_active) and (edge_active):
-                return False
+        # Skip edges into active nodes and edges that were already tried
+        edges = edges[self.node_stamp[self.indices[edges]] != self.node_epoch]
+        edges = edges[self.edge_stamp[edges] != self.edge_epoch]
 
-        # If no potential activations, we are done.
-        return True
+        # Flip a coin for every remaining edge and mark it as tried
+        heads = self.rng.random(len(edges)) < self.weights[edges]
+        self.edge_stamp[edges] = self.edge_epoch
 
-    def update(self):
+        # The newly activated nodes become the frontier for the next round
+        self.frontier = np.unique(self.indices[edges[heads]]).astype(np.int64)
+        self.node_stamp[self.frontier] = self.node_epoch
+
+def edge_coins(seed, reps, edges, num_edges):
+    """
+    Uniform random numbers that depend only on the seed, the replicate and
+    the edge (a splitmix64 hash of the three), so the same replicate always
+    gets the same coin on the same edge, whatever order edges are reached in
+    :param seed: An integer seed
+    :param reps: Array of replicate numbers
+    :param edges: Array of edge indices into the CSR arrays
+    :param num_edges: Number of edges
+    :return: An array of floats in [0, 1)
+    """
+    with np.errstate(over='ignore'):
+        x = reps.astype(np.uint64) * np.uint64(num_edges) + edges.astype(np.uint64)
+        x += np.uint64(seed & 0xFFFFFFFFFFFFFFFF) * np.uint64(0x9E3779B97F4A7C15)
+        x ^= x >> np.uint64(30)
+        x *= np.uint64(0xBF58476D1CE4E5B9)
+        x ^= x >> np.uint64(27)
+        x *= np.uint64(0x94D049BB133111EB)
+        x ^= x >> np.uint64(31)
+    return (x >> np.uint64(11)) * (1. / (1 << 53))
+
+def simulate_cascades(indptr, indices, weights, nodes, numreps, rng=None, coin_seed=None):
+    """
+    Run numreps independent cascades from the same initial nodes at once.
+    Replicates are stored as rows of a boolean (numreps x nodes) matrix, and
+    each round only expands the (replicate, node) pairs activated in the
+    previous round, flipping all of their edge coins in one vectorized draw.
+    :param indptr: CSR row pointer array, as returned by ICModel.get_edge_arrays
+    :param indices: CSR neighbor array
+    :param weights: CSR activation probability array
+    :param nodes: The list of nodes to activate initially
+    :param numreps: Number of replicates to run
+    :param rng: A numpy Generator.  A fresh one is made if None.
+    :param coin_seed: If given, coins come from edge_coins instead of rng, so
+                      replicate r has the same live edges for any initial nodes
+    :return: A boolean array where entry [r, v] is True if v was activated in replicate r
+    """
+    if rng is None and coin_seed is None:
+        rng = np.random.default_rng()
+
+    n = len(indptr) - 1
+    active = np.zeros((numreps, n), dtype=bool)
+    active[:, nodes] = True
+    reps, frontier = np.nonzero(active)
+
+    while len(frontier) > 0:
+        # Expand every (replicate, frontier node) pair into its out-edges
+        counts, edges = row_positions(indptr, frontier)
+        total = len(edges)
+        if total == 0:
+            break
+        reps = np.repeat(reps, counts)
+
+        # Flip a coin for every edge, keep hits on inactive nodes
+        if coin_seed is None:
+            coins = rng.random(total)
+        else:
+            coins = edge_coins(coin_seed, reps, edges, len(indices))
+        heads = coins < weights[edges]
+        reps, targets = reps[heads], indices[edges[heads]]
+        fresh = ~active[reps, targets]
+        keys = np.unique(reps[fresh] * n + targets[fresh])
+
+        # The newly activated pairs form the next frontier
+        reps, frontier = keys // n, keys % n
+        active[reps, frontier] = True
+
+    return active
+
+# Bytes of (replicates x nodes) activation matrix simulated at once, by default
+BATCH_BUDGET = 1 << 24
+
+def get_batch_size(num_nodes, batch_size=None, budget=BATCH_BUDGET):
+    """
+    Choose how many cascades to simulate together.  Each replicate takes
+    one byte per node, so large graphs get fewer replicates per batch.
+    :param num_nodes: Number of nodes
+    :param batch_size: If given, used as is
+    :param budget: Largest activation matrix in bytes
+    :return: The number of replicates per batch, between 1 and 256
+    """
+    if batch_size is not None:
+        return batch_size
+    return max(1, min(256, budget // max(num_nodes, 1)))
+
+def get_activation_batches(ic, nodes, numreps, batch_size=None, rng=None):
+    """
+    Generate activation matrices for numreps cascades from 'nodes', at most
+    batch_size replicates at a time so memory stays bounded.
+    :param ic: An independent cascade object
+    :param nodes: The list of node labels to activate initially
+    :param numreps: Total number of replicates
+    :param batch_size: Maximum number of replicates simulated together.  From
+                       get_batch_size if None.
+    :param rng: A numpy Generator.  A fresh one is made if None.
+    :return: A generator of boolean (replicates x nodes) arrays
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    indptr, indices, weights = ic.get_edge_arrays()
+    nodes = ic.compiled.to_index(nodes)
+    batch_size = get_batch_size(ic.compiled.num_nodes, batch_size)
+    done = 0
+    while done < numreps:
+        reps = min(batch_size, numreps - done)
+        yield simulate_cascades(indptr, indices, weights, nodes, reps, rng)
+        done += reps
+
+class CoActivationCounter():
+    """
+    Streaming counter of how often each node is activated by a source node.
+    Cascades are folded into a single count array as they finish, so memory
+    does not grow with the number of repetitions.  If a path is given, each
+    finished source's counts are appended to disk as one sparse row of a
+    source x target co-activation matrix, which load_coactivation reads back.
+    Nodes are given as ids of the model's compiled graph.
+    """
+
+    def __init__(self, num_nodes, path=None):
+        """
+        Constructor for the co-activation counter
+        :param num_nodes: Number of nodes in the graph
+        :param path: Prefix for the on-disk matrix files, or None to keep nothing
+        """
+        self.counts = np.zeros(num_nodes, dtype=np.int64)
+        self.source = None
+        self.numreps = 0
+        self.path = path
+        if path is not None:
+            self.target_file = open(path + '.targets', 'wb')
+            self.count_file = open(path + '.counts', 'wb')
+            self.row_sources = []
+            self.row_lengths = []
+
+    def start(self, source):
         """
-        Update activation statuses of all nodes and edges.
+        Begin counting cascades from a new source node.
+        :param source: The source node
         :return: None
         """
+        self.flush()
+        self.counts[:] = 0
+        self.source = source
+        self.numreps = 0
 
-        # Store updates to execute later.
-        updates = []
-        edges = list(self.graph.edges())
+    def add(self, active):
+        """
+        Fold finished cascades into the counts.
+        :param active: A boolean array over nodes for one cascade, or a
+                       (replicates x nodes) array for several
+        :return: None
+        """
+        active = np.asarray(active, dtype=bool)
+        if active.ndim == 1:
+            self.counts += active
+            self.numreps += 1
+        else:
+            self.counts += active.sum(axis=0)
+            self.numreps += active.shape[0]
+
+    def add_nodes(self, nodes):
+        """
+        Fold one finished cascade, given as a list of activated nodes.
+        :param nodes: The activated nodes
+        :return: None
+        """
+        self.counts[nodes] += 1
+        self.numreps += 1
 
-        # Iterate over all edges
-        for (u, v) in edges:
-            # Do nothing if u is not currently active
-            if not self.node_stats[u]:
-                continue
-            # Do nothing if v is already activated
-            if self.node_stats[v]:
-                continue
-            # Do nothing if edge (u, v) has already been
-            # tried but failed
-            if not self.edge_stats[u, v]:
-                continue
+    def top(self, k=None):
+        """
+        Get the nodes the current source influenced most often.
+        :param k: Number of nodes to return.  All influenced nodes if None.
+        :return: A list of nodes, most frequently influenced first
+        """
+        influenced = np.flatnonzero(self.counts)
+        influenced = influenced[influenced != self.source]
+        if k is None:
+            order = np.lexsort((influenced, -self.counts[influenced]))
+            return influenced[order].tolist()
+        best = nlargest(k, zip(self.counts[influenced].tolist(), (-influenced).tolist()))
+        return [-v for (c, v) in best]
+
+    def flush(self):
+        """
+        Append the current source's counts to the on-disk matrix.
+        :return: None
+        """
+        if self.path is None or self.source is None:
+            return
+        targets = np.flatnonzero(self.counts)
+        targets.astype(np.int32).tofile(self.target_file)
+        self.counts[targets].astype(np.int32).tofile(self.count_file)
+        self.row_sources.append(self.source)
+        self.row_lengths.append(len(targets))
+        self.source = None
+
+    def close(self):
+        """
+        Flush the last source and write the row index of the on-disk matrix.
+        :return: None
+        """
+        if self.path is None:
+            return
+        self.flush()
+        self.target_file.close()
+        self.count_file.close()
+        np.savez(self.path + '.rows.npz', sources=np.array(self.row_sources, dtype=np.int64),
+                 lengths=np.array(self.row_lengths, dtype=np.int64),
+                 shape=np.array([len(self.counts)] * 2))
 
-            # Otherwise, flip a coin and update v if necessary.
-            heads = coin_flip(self.edge_weights[u, v])
-            if heads:
-                updates.append(v)
-            self.edge_stats[u, v] = False
+def load_coactivation(path):
+    """
+    Load a co-activation matrix written by CoActivationCounter.  Entry
+    [u, v] is the number of cascades from u that activated v.
+    :param path: The path prefix given to CoActivationCounter
+    :return: A scipy sparse CSR array
+    """
+    from scipy.sparse import coo_array
 
-        # Perform all queued updates
-        for node in updates:
-            self.node_stats[node] = True
+    rows = np.load(path + '.rows.npz')
+    targets = np.fromfile(path + '.targets', dtype=np.int32)
+    counts = np.fromfile(path + '.counts', dtype=np.int32)
+    sources = np.repeat(rows['sources'], rows['lengths'])
+    return coo_array((counts, (sources, targets)), shape=tuple(rows['shape'])).tocsr()
 
-def get_average_influence_set_size(ic, node, numreps=20):
+def get_average_influence_set_size(ic, node, numreps=20, batched=False, rng=None):
     """
     Calculate the average number of nodes activated, directly and
     indirectly, by 'node'
     :param ic: The independent cascade object to examine
     :param node: The node to affect initially
     :param numreps: Number of steps to average over
+    :param batched: If True, run the repetitions together with simulate_cascades
+    :param rng: A numpy Generator used when batched is True
     :return: The average number of other nodes activated by 'node'
     """
-    
-    # TODO: Task 1
-    # The loop below resets the graph for each repetition and then activates
-    # the node indicated.  You must fill in the rest of the code to store
-    # activation set sizes.
-    
+    if batched:
+        sizes = []
+        for active in get_activation_batches(ic, [node], numreps, rng=rng):
+            sizes.extend(active.sum(axis=1) - 1)
+        return mean(sizes)
+
+    sizes = []
     for i in range(numreps):
         ic.reset()
         ic.activate_nodes([node])
-  
-def get_influenced_neighbors(ic, node, numreps=20):
+        while not ic.is_done():
+            ic.update()
+        sizes.append(ic.get_num_activated() - 1)
+    return mean(sizes)
+
+def get_influenced_neighbors(ic, node, numreps=20, k=None, batched=False, rng=None, counter=None):
     """
     Record all nodes activated by 'node' over numreps different runs.
+    Each cascade is folded into a CoActivationCounter as soon as it
+    finishes, so memory does not depend on numreps.
     :param ic: The independent cascade object to examine
     :param node: The node to affect initially
     :param numreps: Number of steps to average over
+    :param k: Number of nodes to return.  All influenced nodes if None.
+    :param batched: If True, run the repetitions together with simulate_cascades
+    :param rng: A numpy Generator used when batched is True
+    :param counter: A CoActivationCounter to reuse, e.g. one writing to disk
     :return: A list of the k most frequently influenced nodes
     """
+    if counter is None:
+        counter = CoActivationCounter(ic.compiled.num_nodes)
+    counter.start(ic.compiled.node_id(node))
 
-    # TODO: Task 2
-    # The loop below resets the graph for each repetition and then activates
-    # the node indicated.  You must fill in the rest of the code to store
-    # neighbor sets.
-    
-    for i in range(numreps):
-        ic.reset()
-        ic.activate_nodes([node])
+    if batched:
+        for active in get_activation_batches(ic, [node], numreps, rng=rng):
+            counter.add(active)
+    else:
+        for i in range(numreps):
+            ic.reset()
+            ic.activate_nodes([node])
+            while not ic.is_done():
+                ic.update()
+            counter.add(ic.node_stamp == ic.node_epoch)
 
-def get_k_influential_nodes_a(ic, k):
+    return ic.compiled.to_label(counter.top(k))
+
+def get_k_influential_nodes_a(ic, k, numreps=20, batched=False, processes=None, seed=None):
     """
     Return the k most influential nodes in ic's graph, based on the
     function get_average_influence_set_size
     :param ic: An independent cascade object
     :param k: The number of nodes to find
+    :param numreps: Number of repetitions to average each node's spread over
+    :param batched: If True, estimate each node's spread with simulate_cascades
+    :param processes: If given, estimate spreads with estimate_influence on this many processes
+    :param seed: Master seed used with processes
     :return: A set of the most influential nodes
     """
-    
-    # TODO: Task 3
-    
-    pass
+    if processes is not None:
+        spreads, neighbors = estimate_influence(ic, numreps=numreps, seed=seed,
+                                                processes=processes)
+    else:
+        spreads = {}
+        for node in ic.compiled.labels:
+            spreads[node] = get_average_influence_set_size(ic, node, numreps, batched=batched)
+    ranked = sorted(spreads, key=lambda v: spreads[v], reverse=True)
+    return ranked[:k]
 
-def get_k_influential_nodes_b(ic, k):
+def get_k_influential_nodes_b(ic, k, numreps=20, batched=False, processes=None, seed=None,
+                              path=None):
     """
     Return the k most influential nodes in ic's graph, based on the
-    function get_influenced_neighbors
+    function get_influenced_neighbors.  With p_u(v) the fraction of u's
+    cascades that activated v, nodes are picked greedily to maximize the
+    coverage of a seed set averaged per replicate,
+    sum over v of 1 - prod over seeds u of (1 - p_u(v)), treating the
+    cascades of different seeds as independent.  The union of the
+    influenced nodes over all replicates would saturate after a few seeds.
     :param ic: An independent cascade object
     :param k: The number of nodes to find
+    :param numreps: Number of repetitions per node
+    :param batched: If True, run each node's repetitions with simulate_cascades
+    :param processes: If given, collect neighbors with estimate_influence on this many processes
+    :param seed: Master seed used with processes
+    :param path: If given, also write the co-activation matrix to disk (serial runs only)
     :return: A set of the most influential nodes
     """
-    
-    # TODO: Task 4
-    
-    pass
+    n = ic.compiled.num_nodes
+
+    # Each node's influenced nodes, with the node itself, and the fraction
+    # of its cascades that activated them, as flat arrays
+    sizes = np.zeros(n + 1, dtype=np.int64)
+    members, probs = [], []
+    if processes is not None:
+        spreads, neighbors = estimate_influence(ic, numreps=numreps, seed=seed, processes=processes,
+                                                neighbors=True, counts=True)
+        for i, node in enumerate(ic.compiled.labels):
+            nodes, hits = neighbors[node]
+            members.append(np.r_[i, ic.compiled.to_index(nodes)].astype(np.int32))
+            probs.append(np.r_[1., np.asarray(hits, dtype=np.float64) / numreps])
+            sizes[i + 1] = len(members[-1])
+        del neighbors
+    else:
+        counter = CoActivationCounter(n, path)
+        for i, node in enumerate(ic.compiled.labels):
+            get_influenced_neighbors(ic, node, numreps, batched=batched, counter=counter)
+            ids = np.flatnonzero(counter.counts)
+            members.append(ids.astype(np.int32))
+            probs.append(counter.counts[ids] / counter.numreps)
+            sizes[i + 1] = len(ids)
+        counter.close()
+    offsets = np.cumsum(sizes)
+    members = np.concatenate(members) if members else np.empty(0, dtype=np.int32)
+    probs = np.concatenate(probs) if probs else np.empty(0)
+
+    # Coverage oracle for celf_select.  celf_select asks for its current
+    # seeds plus one candidate, so the chance that the seeds miss each node
+    # is kept and only rebuilt when the seeds change.
+    missed = np.ones(n)
+    prefix = []
+    prefix_total = 0.
+
+    def coverage(seeds):
+        nonlocal prefix, prefix_total
+        if seeds[:-1] != prefix:
+            missed[:] = 1.
+            for u in seeds[:-1]:
+                missed[members[offsets[u]:offsets[u + 1]]] *= 1. - probs[offsets[u]:offsets[u + 1]]
+            prefix = list(seeds[:-1])
+            prefix_total = n - float(missed.sum())
+        u = seeds[-1]
+        lo, hi = offsets[u], offsets[u + 1]
+        return prefix_total + float(np.dot(missed[members[lo:hi]], probs[lo:hi]))
+
+    chosen, stats = celf_select(list(range(n)), min(k, n), coverage)
+    return ic.compiled.to_label(chosen)
+
+# The graph arrays seen by a worker process, set by _init_worker
+_worker_handles = []
+_worker_arrays = None
+
+def _init_worker(specs):
+    """
+    Process pool initializer: attach to the shared graph arrays once.
+    :param specs: The specs returned by share_arrays
+    :return: None
+    """
+    global _worker_handles, _worker_arrays
+    _worker_handles, _worker_arrays = attach_arrays(specs)
+
+def _estimate_node(arrays, node, numreps, seed, neighbors, batch_size=None):
+    """
+    Estimate the spread of a single node.  The random stream depends only
+    on the master seed and the node, so results do not depend on how the
+    nodes were split between workers.
+    :param arrays: A tuple (indptr, indices, weights)
+    :param node: The node to start cascades from
+    :param numreps: Number of cascades
+    :param seed: Master seed
+    :param neighbors: If True, also rank the nodes this node influenced
+    :param batch_size: Maximum number of replicates simulated together.  From
+                       get_batch_size if None.
+    :return: A tuple (node, average influence set size, influenced nodes or None,
+             number of cascades that activated each of them or None)
+    """
+    indptr, indices, weights = arrays
+    batch_size = get_batch_size(len(indptr) - 1, batch_size)
+    rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(node,)))
+    counter = CoActivationCounter(len(indptr) - 1)
+    counter.start(node)
+    done = 0
+    while done < numreps:
+        reps = min(batch_size, numreps - done)
+        counter.add(simulate_cascades(indptr, indices, weights, [node], reps, rng))
+        done += reps
+
+    total = counter.counts.sum() - numreps
+    ranked = counter.top() if neighbors else None
+    hits = counter.counts[ranked] if neighbors else None
+    return node, float(total) / max(numreps, 1), ranked, hits
+
+def _estimate_shard(task):
+    """
+    Process pool task: estimate the spread of a shard of nodes.
+    :param task: A tuple (nodes, numreps, seed, neighbors, batch_size)
+    :return: A list of results from _estimate_node
+    """
+    nodes, numreps, seed, neighbors, batch_size = task
+    return [_estimate_node(_worker_arrays, node, numreps, seed, neighbors, batch_size) for node in nodes]
+
+def estimate_influence(ic, nodes=None, numreps=20, seed=None, processes=None, neighbors=False,
+                       batch_size=None, counts=False):
+    """
+    Estimate the average influence set size of many nodes, sharding the
+    nodes over a process pool.  The graph is copied into shared memory
+    once and mapped by every worker, and each node gets its own random
+    stream derived from the master seed, so a run with processes=1 gives
+    exactly the same answer as a parallel run with the same seed.
+    :param ic: An independent cascade object
+    :param nodes: The nodes to estimate.  All nodes if None.
+    :param numreps: Number of cascades per node
+    :param seed: Master seed.  A random one is drawn if None.
+    :param processes: Number of worker processes.  Uses every core if None.
+    :param neighbors: If True, also return each node's influenced nodes,
+                      ranked as in get_influenced_neighbors
+    :param batch_size: Cascades simulated together per node.  From get_batch_size if None.
+    :param counts: If True, each entry of neighbors is a tuple (influenced nodes, array
+                   of the number of cascades that activated each of them)
+    :return: A tuple of dictionaries (spreads, neighbors); neighbors is None unless requested
+    """
+    if nodes is None:
+        nodes = list(ic.compiled.labels)
+    nodes = ic.compiled.to_index(nodes)
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    arrays = ic.get_edge_arrays()
+
+    if processes == 1:
+        results = [_estimate_node(arrays, node, numreps, seed, neighbors, batch_size) for node in nodes]
+    else:
+        handles, specs = share_arrays(arrays)
+        try:
+            with Pool(processes, initializer=_init_worker, initargs=(specs,)) as pool:
+                # Several shards per worker keeps the load balanced
+                size = max(1, ceil(len(nodes) / (4 * (processes or cpu_count()))))
+                tasks = [(nodes[i:i + size], numreps, seed, neighbors, batch_size)
+                         for i in range(0, len(nodes), size)]
+                results = [r for shard in pool.imap_unordered(_estimate_shard, tasks) for r in shard]
+        finally:
+            for shm in handles:
+                shm.close()
+                shm.unlink()
+
+    label = ic.compiled.node_label
+    spreads = {label(node): spread for (node, spread, ranked, hits) in results}
+    influenced = None
+    if neighbors:
+        influenced = {}
+        for (node, spread, ranked, hits) in results:
+            ranked = ic.compiled.to_label(ranked)
+            influenced[label(node)] = (ranked, hits) if counts else ranked
+    return spreads, influenced
+
+def reverse_edge_arrays(indptr, indices, weights):
+    """
+    Transpose CSR edge arrays so that row v lists the in-neighbors of v.
+    :param indptr: CSR row pointer array
+    :param indices: CSR neighbor array
+    :param weights: CSR edge weight array
+    :return: A tuple (indptr, indices, weights) for the reversed graph
+    """
+    n = len(indptr) - 1
+    sources = np.repeat(np.arange(n), np.diff(indptr))
+    order = np.argsort(indices, kind='stable')
+    rev_indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(indices, minlength=n), out=rev_indptr[1:])
+    return rev_indptr, sources[order], weights[order]
+
+def log_binomial(n, k):
+    """
+    Natural log of the binomial coefficient n choose k
+    :param n: Number of items
+    :param k: Number of items chosen
+    :return: log(n choose k)
+    """
+    return lgamma(n + 1) - lgamma(k + 1) - lgamma(n - k + 1)
+
+class RRIndex():
+    """
+    A reverse-reachable (RR) set index over an independent cascade model.
+
+    An RR set is the set of nodes that can reach a random root node over
+    edges that are kept with their activation probability.  The chance that
+    a seed set hits a random RR set is its expected spread divided by the
+    number of nodes, so top-k seeds can be found by greedy max coverage over
+    a sample of RR sets.  Sets are sampled once and stored flat, along with
+    an inverted index from each node to the ids of the sets containing it,
+    so many queries with different k or budgets can share one sample.
+    """
+
+    def __init__(self, ic, seed=None):
+        """
+        Constructor for the RR set index
+        :param ic: An independent cascade object.  Its graph and edge weights are read once.
+        :param seed: Seed for the random number generator
+        """
+        self.compiled = ic.compiled
+        self.num_nodes = ic.compiled.num_nodes
+        in_indptr, in_nodes, in_weights = reverse_edge_arrays(*ic.get_edge_arrays())
+        self.in_indptr = in_indptr
+        self.in_nodes = in_nodes.astype(np.int32)
+        self.in_weights = in_weights.astype(np.float32)
+        self.rng = np.random.default_rng(seed)
+
+        # RR sets are stored back to back in members, with set i
+        # occupying members[ends[i - 1]:ends[i]]
+        self.members = array('i')
+        self.ends = array('q')
+
+        # Inverted index, rebuilt lazily after new sets are sampled
+        self.node_indptr = None
+        self.node_sets = None
+
+    def get_num_sets(self):
+        """
+        Get the number of RR sets sampled so far.
+        :return: Number of RR sets
+        """
+        return len(self.ends)
+
+    def sample(self, num_sets, batch=1 << 12):
+        """
+        Sample more RR sets and add them to the index.  A batch of sets is
+        grown at once, one breadth-first level at a time, as (set, node)
+        pairs, with all of a level's edge coins drawn in one call.
+        :param num_sets: The number of RR sets to add
+        :param batch: The number of RR sets grown together
+        :return: None
+        """
+        ptr, nodes, weights = self.in_indptr, self.in_nodes, self.in_weights
+        n = self.num_nodes
+        for first in range(0, num_sets, batch):
+            size = min(batch, num_sets - first)
+            sets = np.arange(size, dtype=np.int64)
+            frontier = self.rng.integers(0, n, size)
+            found_sets, found_nodes = [sets], [frontier]
+
+            # Keys set * n + node of the pairs reached so far, sorted
+            visited = sets * n + frontier
+            while len(frontier) > 0:
+                counts, edges = row_positions(ptr, frontier)
+                total = len(edges)
+                if total == 0:
+                    break
+                live = self.rng.random(total) < weights[edges]
+                keys = distinct(np.repeat(sets, counts)[live] * n + nodes[edges[live]])
+                keys = keys[~contains(visited, keys)]
+                visited = np.sort(np.concatenate([visited, keys]))
+                sets, frontier = keys // n, keys % n
+                found_sets.append(sets)
+                found_nodes.append(frontier)
+
+            # Store the sets back to back, each starting with its root
+            found_sets = np.concatenate(found_sets)
+            order = np.argsort(found_sets, kind='stable')
+            start = len(self.members)
+            self.members.frombytes(np.concatenate(found_nodes)[order].astype(np.int32).tobytes())
+            ends = start + np.cumsum(np.bincount(found_sets, minlength=size))
+            self.ends.frombytes(ends.astype(np.int64).tobytes())
+        self.node_indptr = None
+
+    def sample_until(self, num_sets):
+        """
+        Sample RR sets until the index holds at least num_sets of them.
+        :param num_sets: The number of RR sets required
+        :return: None
+        """
+        missing = ceil(num_sets) - self.get_num_sets()
+        if missing > 0:
+            self.sample(missing)
+
+    def build_index(self):
+        """
+        Build the inverted index from nodes to the RR sets containing them.
+        :return: None
+        """
+        members = np.frombuffer(self.members, dtype=np.int32)
+        set_ids = np.repeat(np.arange(len(self.ends)), np.diff(self.get_offsets()))
+        order = np.argsort(members, kind='stable')
+        self.node_indptr = np.zeros(self.num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(members, minlength=self.num_nodes), out=self.node_indptr[1:])
+        self.node_sets = set_ids[order]
+
+    def get_offsets(self):
+        """
+        Get the start of every RR set in the flat member array.
+        :return: A numpy array of length get_num_sets() + 1
+        """
+        offsets = np.zeros(len(self.ends) + 1, dtype=np.int64)
+        offsets[1:] = np.frombuffer(self.ends, dtype=np.int64)
+        return offsets
+
+    def estimate_spread(self, seeds):
+        """
+        Estimate the expected number of nodes activated by a seed set.
+        :param seeds: A list of seed nodes
+        :return: The estimated spread
+        """
+        if self.node_indptr is None:
+            self.build_index()
+        hit = np.zeros(self.get_num_sets(), dtype=bool)
+        for node in set(self.compiled.to_index(seeds)):
+            hit[self.node_sets[self.node_indptr[node]:self.node_indptr[node + 1]]] = True
+        return self.num_nodes * hit.sum() / max(self.get_num_sets(), 1)
+
+    def ensure_accuracy(self, k, epsilon=.1, ell=1.):
+        """
+        Sample enough RR sets for greedy selection of k seeds to be within a
+        (1 - 1/e - epsilon) factor of optimal with probability at least
+        1 - n^-ell.  This is the sampling phase of IMM (Tang et al., 2015).
+        Sets already in the index are reused, so calling this again for a
+        k that is already covered costs nothing but a few coverage queries.
+        :param k: The number of seeds that will be selected (at most the number of nodes)
+        :param epsilon: Approximation error
+        :param ell: Confidence parameter
+        :return: The number of RR sets in the index
+        """
+        n = self.num_nodes
+        k = min(k, n)
+        if n < 2:
+            self.sample_until(1)
+            return self.get_num_sets()
+        ell = ell * (1 + log(2) / log(n))
+        log_nk = log_binomial(n, k)
+
+        # Find a lower bound on the optimal spread by testing n/2, n/4, ...
+        eps_prime = sqrt(2) * epsilon
+        lam_prime = ((2 + 2 / 3 * eps_prime) *
+                     (log_nk + ell * log(n) + log(log2(n))) * n / eps_prime ** 2)
+        lower = 1.
+        for i in range(1, int(log2(n))):
+            x = n / 2 ** i
+            self.sample_until(lam_prime / x)
+            seeds, spread = self.select_seeds(k)
+            if spread >= (1 + eps_prime) * x:
+                lower = spread / (1 + eps_prime)
+                break
+
+        alpha = sqrt(ell * log(n) + log(2))
+        beta = sqrt((1 - 1 / e) * (log_nk + ell * log(n) + log(2)))
+        lam_star = 2 * n * ((1 - 1 / e) * alpha + beta) ** 2 / epsilon ** 2
+        self.sample_until(lam_star / lower)
+        return self.get_num_sets()
+
+    def select_seeds(self, k=None, budget=None, costs=None, epsilon=None):
+        """
+        Choose seeds by greedy maximum coverage of the sampled RR sets.
+        With k, the k seeds covering the most sets are chosen.  With a
+        budget, nodes are added by coverage gained per unit cost while they
+        fit in the budget and still cover new sets, and the result is
+        compared against the best single affordable node.  Nodes of cost 0
+        that cover new sets are taken first.
+        :param k: The number of seeds to choose
+        :param budget: Total cost allowed instead of a fixed k
+        :param costs: A list or array of non-negative per-node costs in node id order, used with budget
+        :param epsilon: If given, first sample enough sets for this accuracy (requires k)
+        :return: A tuple (seeds, estimated spread)
+        :raises ValueError: If a cost is negative
+        """
+        if epsilon is not None:
+            self.ensure_accuracy(k, epsilon)
+        if self.node_indptr is None:
+            self.build_index()
+
+        n = self.num_nodes
+        num_sets = max(self.get_num_sets(), 1)
+        offsets = self.get_offsets()
+        members = np.frombuffer(self.members, dtype=np.int32)
+        covered = np.zeros(self.get_num_sets(), dtype=bool)
+        gains = np.diff(self.node_indptr).astype(np.float64)
+        if budget is not None:
+            costs = np.ones(n) if costs is None else np.asarray(costs, dtype=np.float64)
+            if (costs < 0).any():
+                raise ValueError('node costs must be non-negative')
+            remaining = float(budget)
+
+        seeds = []
+        total = 0
+        while len(seeds) < (n if k is None else k):
+            if budget is None:
+                node = int(np.argmax(gains))
+            else:
+                # Stop once no affordable node covers a new set
+                affordable = (costs <= remaining) & (gains > 0)
+                if not affordable.any():
+                    break
+                ratio = np.full(n, -1.)
+                np.divide(gains, costs, out=ratio, where=affordable & (costs > 0))
+                ratio[affordable & (costs == 0)] = np.inf
+                node = int(np.argmax(ratio))
+                remaining -= costs[node]
+            if gains[node] < 0:
+                break
+
+            # Cover this node's sets and take their members' gains away
+            sets = self.node_sets[self.node_indptr[node]:self.node_indptr[node + 1]]
+            sets = sets[~covered[sets]]
+            covered[sets] = True
+            total += len(sets)
+            touched = members[row_positions(offsets, sets)[1]]
+            gains -= np.bincount(touched, minlength=n)
+            gains[node] = -1.
+            seeds.append(node)
+
+        if budget is not None:
+            # The best single affordable node can beat cost-effective greedy
+            sizes = np.diff(self.node_indptr).astype(np.float64)
+            sizes[costs > budget] = -1.
+            best = int(np.argmax(sizes))
+            if sizes[best] > total:
+                return self.compiled.to_label([best]), n * sizes[best] / num_sets
+
+        return self.compiled.to_label(seeds), n * total / num_sets
+
+def get_k_influential_nodes_rr(ic, k, epsilon=.1, index=None):
+    """
+    Return the k most influential nodes in ic's graph, based on greedy
+    coverage of reverse-reachable sets.  The index can be passed in so
+    one sample of RR sets is shared between many queries.
+    :param ic: An independent cascade object
+    :param k: The number of nodes to find
+    :param epsilon: Approximation error for the (1 - 1/e - epsilon) guarantee
+    :param index: An RRIndex built on ic, or None to build a new one
+    :return: A list of the most influential nodes
+    """
+    if index is None:
+        index = RRIndex(ic)
+    seeds, spread = index.select_seeds(k, epsilon=epsilon)
+    return seeds
+
+def get_spread_oracle(ic, numreps=100, seed=0):
+    """
+    Make a Monte Carlo spread oracle for seed sets on ic's graph.  Coins
+    are keyed by (replicate, edge) with edge_coins (common random numbers),
+    so every call sees the same live edges in each replicate, and the
+    marginal gains of different candidates are compared on the same coin
+    flips and are much less noisy than independent estimates.
+    :param ic: An independent cascade object
+    :param numreps: Number of cascades to average over per call
+    :param seed: Seed for the random number generator used in every call
+    :return: A function mapping a list of seed nodes to their average spread
+    """
+    indptr, indices, weights = ic.get_edge_arrays()
+
+    def spread(seeds):
+        if len(seeds) == 0:
+            return 0.
+        active = simulate_cascades(indptr, indices, weights, ic.compiled.to_index(seeds),
+                                   numreps, coin_seed=seed)
+        return active.sum(axis=1).mean()
+
+    return spread
+
+def celf_select(candidates, k, spread, lookahead=False):
+    """
+    Greedy seed selection with lazy evaluation (CELF, or CELF++ when
+    lookahead is True).  Marginal gains are kept in a priority queue and
+    only the head is re-evaluated when its cached gain is stale; since
+    gains can only shrink as seeds are added, a fresh head is the true
+    greedy choice.  CELF++ also caches each node's gain with respect to the
+    current best candidate, which is reused if that candidate becomes the
+    next seed.  With a black-box oracle the lookahead costs an extra call,
+    so it only pays off when the ranking is very stable.
+    :param candidates: A list of candidate nodes
+    :param k: The number of seeds to choose
+    :param spread: An oracle mapping a list of seeds to their (estimated) spread
+    :param lookahead: If True, use the CELF++ lookahead gains
+    :return: A tuple (seeds, stats), where stats is a dictionary with the
+             final spread, the oracle calls made, the calls plain greedy
+             would have made, and the number of calls saved
+    """
+    cache = {}
+
+    def evaluate(seeds):
+        key = frozenset(seeds)
+        if key not in cache:
+            cache[key] = spread(list(seeds))
+        return cache[key]
+
+    # Heap entries are [-gain, tiebreak, node, lookahead gain, best node
+    # when computed, number of seeds when computed]
+    heap = [[-evaluate([u]), order, u, None, None, 0]
+            for order, u in enumerate(candidates)]
+    heapify(heap)
+
+    seeds = []
+    total = 0.
+    last_seed = None
+    cur_best, cur_gain = None, None
+    while len(heap) > 0 and len(seeds) < k:
+        entry = heap[0]
+        neg_gain, order, u, gain2, prev_best, flag = entry
+
+        # A gain computed against the current seed set is exact
+        if flag == len(seeds):
+            heappop(heap)
+            seeds.append(u)
+            total += -neg_gain
+            last_seed = u
+            cur_best, cur_gain = None, None
+            continue
+
+        if lookahead and prev_best == last_seed and flag == len(seeds) - 1 and gain2 is not None:
+            gain = gain2
+            gain2 = None
+        else:
+            gain = evaluate(seeds + [u]) - total
+            gain2 = None
+            if lookahead and cur_best is not None:
+                gain2 = evaluate(seeds + [cur_best, u]) - evaluate(seeds + [cur_best])
+
+        entry[0], entry[3], entry[4], entry[5] = -gain, gain2, cur_best, len(seeds)
+        heapreplace(heap, entry)
+        if cur_gain is None or gain > cur_gain:
+            cur_best, cur_gain = u, gain
+
+    n = len(candidates)
+    greedy_calls = sum(n - i for i in range(min(k, n)))
+    stats = {'spread': float(total),
+             'oracle_calls': len(cache),
+             'greedy_calls': greedy_calls,
+             'saved_calls': greedy_calls - len(cache)}
+    return seeds, stats
+
+def get_k_influential_nodes_celf(ic, k, numreps=100, lookahead=False):
+    """
+    Return the k most influential nodes in ic's graph, chosen by lazy
+    greedy selection over a Monte Carlo spread oracle.
+    :param ic: An independent cascade object
+    :param k: The number of nodes to find
+    :param numreps: Number of cascades per spread estimate
+    :param lookahead: If True, use CELF++ instead of CELF
+    :return: A list of the most influential nodes
+    """
+    spread = get_spread_oracle(ic, numreps)
+    candidates = list(ic.compiled.labels)
+    seeds, stats = celf_select(candidates, k, spread, lookahead=lookahead)
+    return seeds
+
+def get_k_central_nodes(ic, k, metric='degree', cache=True, **params):
+    """
+    Return the k most central nodes in ic's graph, a fast heuristic for
+    seed selection.  Scores are cached on disk per graph, see centrality.py.
+    :param ic: An independent cascade object
+    :param k: The number of nodes to find
+    :param metric: 'degree', 'kcore', 'pagerank', 'betweenness' or 'collective_influence'
+    :param cache: True for the default cache, a CentralityCache, or False
+    :param params: Keyword parameters of the metric, e.g. pivots for betweenness
+    :return: A list of the most central nodes
+    """
+    return top_nodes(ic.compiled, k, metric, cache, **params)
 
 def main():
 
@@ -380,4 +1515,5 @@ def main():
     
     # TODO: Task 7
 
-main()
+if __name__ == '__main__':
+    main()